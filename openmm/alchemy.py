@@ -63,6 +63,8 @@ import simtk.openmm as openmm
 
 from sets import Set
 
+import systemregistry
+
 #=============================================================================================
 # AlchemicalState
 #=============================================================================================
@@ -151,8 +153,11 @@ class AbsoluteAlchemicalFactory(object):
         
         """
 
-        # Store serialized form of reference system.
-        self.reference_system = copy.deepcopy(reference_system)
+        # Store a copy of the reference system, which is only read; a shared System is immutable, so it need not be copied.
+        if systemregistry.default_registry.is_shared(reference_system):
+            self.reference_system = reference_system
+        else:
+            self.reference_system = copy.deepcopy(reference_system)
 
         # Store copy of atom sets.
         self.ligand_atoms = copy.deepcopy(ligand_atoms)
@@ -494,6 +499,11 @@ class AbsoluteAlchemicalFactory(object):
 
         alchemical_state (AlchemicalState) - the alchemical state to create from the reference system
 
+        RETURNS
+
+        system (simtk.openmm.System) - the perturbed System, a new object owned by the caller; pass share_system=True to
+           ThermodynamicState to share it among identical states without copying
+
         TODO
 
         * Start from a deep copy of the system, rather than building copy through Python interface.
@@ -227,6 +227,198 @@ def read_amber_energy_frame(infile):
 
     return energies
 
+def get_positions_interval(ncfile):
+    """Return the spacing (in records) between records for which positions were stored.
+
+    ARGUMENTS
+       ncfile (NetCDF) - NetCDF file object for input file
+
+    RETURNS
+       interval (int) - positions are stored for records 0, interval, 2*interval, ...
+    """
+    return int(getattr(ncfile.variables['positions'], 'write_interval', 1))
+
+def get_full_energy_records(ncfile):
+    """Return a mask of the records for which the full energy matrix was evaluated.
+
+    ARGUMENTS
+       ncfile (NetCDF) - NetCDF file object for input file
+
+    RETURNS
+       full (numpy array of bool) - full[iteration] is True if energies[iteration,:,:] contains no unevaluated (NaN) entries
+    """
+    niterations = ncfile.variables['energies'].shape[0]
+    if 'energies_full' not in ncfile.variables:
+        return numpy.ones([niterations], numpy.bool_)
+    return numpy.array(ncfile.variables['energies_full'][:], numpy.bool_)
+
+class ReplicaExchangeDataset(object):
+    """
+    Energies, states, and mixing statistics of a replica-exchange store, read in bulk and shared by the analysis functions.
+
+    Arrays are read from the NetCDF file in blocks of 'chunk_size' records the first time they are needed, and derived
+    arrays (the deconvoluted reduced potentials u_kln, the timeseries u_n, and the mixing statistics) are computed once
+    with vectorized operations and cached.
+
+    EXAMPLES
+
+    Read a store once and share it among several analyses.
+
+    >>> ncfile = netcdf.Dataset('repex.nc', 'r') # doctest: +SKIP
+    >>> dataset = ReplicaExchangeDataset(ncfile) # doctest: +SKIP
+    >>> [nequil, g_t, Neff_max] = detect_equilibration(extract_u_n(dataset)) # doctest: +SKIP
+    >>> [Deltaf_ij, dDeltaf_ij] = estimate_free_energies(dataset, ndiscard=nequil) # doctest: +SKIP
+
+    NOTES
+
+    Cached arrays are shared and must not be modified by the caller; slice or copy them first.
+
+    """
+
+    def __init__(self, ncfile, chunk_size=1024):
+        """
+        Prepare to read a replica-exchange store.
+
+        ARGUMENTS
+           ncfile (NetCDF) - NetCDF file object for input file
+
+        OPTIONAL ARGUMENTS
+           chunk_size (int) - number of records read from the file at a time (default: 1024)
+
+        """
+
+        self.ncfile = ncfile
+        self.chunk_size = chunk_size
+
+        # Get dimensions.
+        [self.niterations, self.nreplicas, self.nstates] = ncfile.variables['energies'].shape
+
+        self._cache = dict()
+
+        return
+
+    def _read(self, name, dtype):
+        """
+        Read a whole variable whose first dimension is the record, 'chunk_size' records at a time.
+
+        """
+
+        variable = self.ncfile.variables[name]
+        array = numpy.zeros(variable.shape, dtype)
+        for start in range(0, variable.shape[0], self.chunk_size):
+            stop = min(start + self.chunk_size, variable.shape[0])
+            array[start:stop] = variable[start:stop]
+        return array
+
+    def _cached(self, name, compute):
+        """
+        Return the cached array 'name', calling compute() to create it the first time.
+
+        """
+
+        if name not in self._cache:
+            self._cache[name] = compute()
+        return self._cache[name]
+
+    @property
+    def energies(self):
+        """energies[n,r,l] is the reduced potential of replica r at iteration n evaluated at state l (kT)."""
+        return self._cached('energies', lambda : self._read('energies', numpy.float64))
+
+    @property
+    def states(self):
+        """states[n,r] is the state of replica r at iteration n."""
+        return self._cached('states', lambda : self._read('states', numpy.int32))
+
+    @property
+    def full(self):
+        """full[n] is True if the full energy matrix was evaluated at iteration n."""
+        return self._cached('full', lambda : get_full_energy_records(self.ncfile))
+
+    @property
+    def u_kln_replica(self):
+        """u_kln_replica[r,l,n] is the reduced potential of replica r at iteration n evaluated at state l."""
+        return numpy.transpose(self.energies, (1,2,0))
+
+    @property
+    def u_kln(self):
+        """u_kln[k,l,n] is the reduced potential of the configuration sampled from state k at iteration n evaluated at state l."""
+        def compute():
+            # Deconvolute all iterations at once: the replica in state k at iteration n supplies row k.
+            u_nkl = numpy.zeros(self.energies.shape, numpy.float64)
+            u_nkl[numpy.arange(self.niterations)[:,numpy.newaxis], self.states, :] = self.energies
+            return numpy.transpose(u_nkl, (1,2,0))
+        return self._cached('u_kln', compute)
+
+    @property
+    def u_n(self):
+        """u_n[n] is the total reduced potential of all replicas in their current states at iteration n, -log q(x_n)."""
+        def compute():
+            replicas = numpy.arange(self.nreplicas)[numpy.newaxis,:]
+            iterations = numpy.arange(self.niterations)[:,numpy.newaxis]
+            return self.energies[iterations, replicas, self.states].sum(1)
+        return self._cached('u_n', compute)
+
+    @property
+    def proposed(self):
+        """proposed[n,i,j] is the number of swaps between states i and j proposed since the previous record."""
+        return self._cached('proposed', lambda : self._read('proposed', numpy.int64))
+
+    @property
+    def accepted(self):
+        """accepted[n,i,j] is the number of swaps between states i and j accepted since the previous record."""
+        return self._cached('accepted', lambda : self._read('accepted', numpy.int64))
+
+    def transition_counts(self, nequil=0):
+        """
+        Return the symmetrized counts of state-to-state transitions of replicas between consecutive iterations.
+
+        OPTIONAL ARGUMENTS
+           nequil (int) - only iterations nequil:end are counted (default: 0)
+
+        RETURNS
+           Nij (numpy array of nstates x nstates) - Nij[i,j] is half the number of transitions i->j plus half the number j->i
+
+        """
+
+        def compute():
+            states = self.states[nequil:,:]
+            Nij = numpy.bincount((states[:-1,:] * self.nstates + states[1:,:]).ravel(), minlength=self.nstates*self.nstates)
+            Nij = numpy.array(Nij, numpy.float64).reshape([self.nstates, self.nstates])
+            return 0.5 * (Nij + Nij.T)
+        return self._cached(('transition_counts', nequil), compute)
+
+    def acceptance_probabilities(self, nequil=0):
+        """
+        Return the fraction of proposed swaps between each pair of states that were accepted.
+
+        OPTIONAL ARGUMENTS
+           nequil (int) - only records nequil:end are used (default: 0)
+
+        RETURNS
+           Pij (numpy array of nstates x nstates) - Pij[i,j] is the acceptance probability of swaps between states i and j, or 0 if none were proposed
+
+        """
+
+        def compute():
+            proposed = self.proposed[nequil:,:,:].sum(0)
+            accepted = self.accepted[nequil:,:,:].sum(0)
+            return numpy.array(accepted, numpy.float64) / numpy.maximum(proposed, 1)
+        return self._cached(('acceptance_probabilities', nequil), compute)
+
+def get_dataset(source):
+    """Return a ReplicaExchangeDataset for a NetCDF file, or the given dataset itself.
+
+    ARGUMENTS
+       source (NetCDF or ReplicaExchangeDataset) - NetCDF file object for input file, or a dataset already reading it
+
+    RETURNS
+       dataset (ReplicaExchangeDataset) - the dataset; pass it to several analysis functions to read the file only once
+    """
+    if isinstance(source, ReplicaExchangeDataset):
+        return source
+    return ReplicaExchangeDataset(source)
+
 def write_netcdf_replica_trajectories(directory, prefix, title, ncfile):
     """Write out replica trajectories in AMBER NetCDF format.
 
@@ -247,53 +439,203 @@ def write_netcdf_replica_trajectories(directory, prefix, title, ncfile):
         output_filename = os.path.join(directory, '%s-%03d.nc' % (prefix, replica))
         ncoutfile = netcdf.Dataset(output_filename, 'w')
         initialize_netcdf(ncoutfile, title + " (replica %d)" % replica, natoms)
-        for iteration in range(niterations):
+        for (frame, iteration) in enumerate(range(0, niterations, get_positions_interval(ncfile))):
             coordinates = numpy.array(ncfile.variables['positions'][iteration,replica,:,:])
             coordinates *= 10.0 # convert nm to angstroms
-            write_netcdf_frame(ncoutfile, iteration, time = 1.0 * iteration, coordinates = coordinates)
+            write_netcdf_frame(ncoutfile, frame, time = 1.0 * iteration, coordinates = coordinates)
         ncoutfile.close()
 
     return
 
-def compute_torsion_trajectories(ncfile, filename):
-    """Write out torsion trajectories for Val 111.
+class Distance(object):
+    """
+    Distance between two atoms, such as the ring-closure distance of a bond that is broken in a ring-opening transformation.
+
+    EXAMPLES
+
+    >>> observable = Distance(0, 5)
+    >>> observable.compute(numpy.array([[0.0, 0.0, 0.0], [3.0, 4.0, 0.0]]))
+    5.0
+
+    """
+
+    units = 'nm'
+
+    def __init__(self, atom1, atom2, name=None):
+        """
+        ARGUMENTS
+           atom1, atom2 (int) - indices of the atoms
+
+        OPTIONAL ARGUMENTS
+           name (string) - name of the observable (default: 'distance-<atom1>-<atom2>')
+
+        """
+        self.atoms = [atom1, atom2]
+        self.name = name or ('distance-%d-%d' % (atom1, atom2))
+
+    def compute(self, x):
+        """Return distances from x[...,i,:], the positions of self.atoms[i] for any number of frames."""
+        return numpy.sqrt(((x[...,1,:] - x[...,0,:])**2).sum(-1))
+
+class Angle(object):
+    """
+    Angle formed by three atoms, in degrees.
+
+    """
+
+    units = 'degrees'
+
+    def __init__(self, atom1, atom2, atom3, name=None):
+        """
+        ARGUMENTS
+           atom1, atom2, atom3 (int) - indices of the atoms, with atom2 at the vertex
+
+        OPTIONAL ARGUMENTS
+           name (string) - name of the observable (default: 'angle-<atom1>-<atom2>-<atom3>')
+
+        """
+        self.atoms = [atom1, atom2, atom3]
+        self.name = name or ('angle-%d-%d-%d' % (atom1, atom2, atom3))
+
+    def compute(self, x):
+        """Return angles from x[...,i,:], the positions of self.atoms[i] for any number of frames."""
+        vBA = x[...,0,:] - x[...,1,:]
+        vBC = x[...,2,:] - x[...,1,:]
+        sin_theta = numpy.sqrt((numpy.cross(vBA, vBC)**2).sum(-1))
+        cos_theta = (vBA * vBC).sum(-1)
+        return numpy.degrees(numpy.arctan2(sin_theta, cos_theta))
+
+class Torsion(object):
+    """
+    Signed torsion angle formed by four atoms, in degrees in the range [-180, 180].
+
+    """
+
+    units = 'degrees'
+
+    def __init__(self, atom1, atom2, atom3, atom4, name=None):
+        """
+        ARGUMENTS
+           atom1, atom2, atom3, atom4 (int) - indices of the atoms, with the torsion about the atom2-atom3 bond
+
+        OPTIONAL ARGUMENTS
+           name (string) - name of the observable (default: 'torsion-<atom1>-<atom2>-<atom3>-<atom4>')
+
+        """
+        self.atoms = [atom1, atom2, atom3, atom4]
+        self.name = name or ('torsion-%d-%d-%d-%d' % (atom1, atom2, atom3, atom4))
+
+    def compute(self, x):
+        """Return torsions from x[...,i,:], the positions of self.atoms[i] for any number of frames."""
+        b1 = x[...,1,:] - x[...,0,:]
+        b2 = x[...,2,:] - x[...,1,:]
+        b3 = x[...,3,:] - x[...,2,:]
+        n1 = numpy.cross(b1, b2)
+        n2 = numpy.cross(b2, b3)
+        sin_term = numpy.sqrt((b2**2).sum(-1)) * (b1 * n2).sum(-1)
+        cos_term = (n1 * n2).sum(-1)
+        return numpy.degrees(numpy.arctan2(sin_term, cos_term))
+
+def compute_observables(ncfile, observables, ncoutfile=None, max_memory=2**28):
+    """Compute geometric observables for all replicas and all stored positions, reading positions in large chunks.
 
     ARGUMENTS
        ncfile (NetCDF) - NetCDF file object for input file
-       filename (string) - name of file to be written
+       observables (list) - observables to compute, such as Distance, Angle, or Torsion objects; each must have
+          'atoms' and 'name' attributes and a vectorized 'compute' method, and names must be unique and not 'records'
+
+    OPTIONAL ARGUMENTS
+       ncoutfile (NetCDF) - if specified, values are written to a variable named after each observable in this
+          NetCDF file (or group) as they are computed, rather than held in memory (default: None)
+       max_memory (int) - approximate maximum number of bytes of positions held in memory at once (default: 256 MB)
+
+    RETURNS
+       records (numpy array of int) - records[frame] is the record index in the store of each frame with positions
+       values (dict) - values[name][frame,replica] is the value of observable 'name' for replica 'replica' at
+          frame 'frame'; these are NetCDF variables if 'ncoutfile' is specified, and numpy arrays otherwise
+
+    NOTES
+       Only the atoms used by the observables are read, for all replicas and as many frames at a time as fit in
+       'max_memory', and each observable is evaluated for the whole chunk with array operations.  Records for which
+       positions were not stored (see get_positions_interval) are skipped.
+
+    EXAMPLES
+
+    Monitor a ring-closure distance and a torsion for every replica.
+
+    >>> ncfile = netcdf.Dataset('repex.nc', 'r') # doctest: +SKIP
+    >>> observables = [Distance(10, 15, name='ring-closure'), Torsion(1735, 1737, 1739, 1741)] # doctest: +SKIP
+    >>> [records, values] = compute_observables(ncfile, observables) # doctest: +SKIP
+    >>> ring_closure = values['ring-closure'] # doctest: +SKIP
+
     """
-    atoms = [1735, 1737, 1739, 1741] # N-CA-CB-CG1 of Val 111        
+
+    names = [ observable.name for observable in observables ]
+    if len(set(names)) != len(names):
+        raise ValueError("Observable names must be unique: %s" % str(names))
+    if 'records' in names:
+        raise ValueError("The observable name 'records' is reserved for the record indices of the frames.")
 
     # Get current dimensions.
-    niterations = ncfile.variables['positions'].shape[0]
-    nstates = ncfile.variables['positions'].shape[1]
-    natoms = ncfile.variables['positions'].shape[2]
+    positions = ncfile.variables['positions']
+    [nrecords, nreplicas, natoms, nspatial] = positions.shape
+    interval = get_positions_interval(ncfile)
+    records = numpy.arange(0, nrecords, interval)
+    nframes = len(records)
+
+    # Determine the atoms to read, and where each observable's atoms are among them.
+    atoms = numpy.unique(numpy.concatenate([ numpy.array(observable.atoms, numpy.int64) for observable in observables ]))
+    atom_index = dict([ (atom, index) for (index, atom) in enumerate(atoms) ])
+    observable_atoms = [ [ atom_index[atom] for atom in observable.atoms ] for observable in observables ]
+
+    # Allocate storage for values.
+    values = dict()
+    if ncoutfile is None:
+        for observable in observables:
+            values[observable.name] = numpy.zeros([nframes, nreplicas], numpy.float64)
+    else:
+        if 'frame' not in ncoutfile.dimensions:
+            ncoutfile.createDimension('frame', nframes)
+        elif len(ncoutfile.dimensions['frame']) != nframes:
+            raise ValueError("The 'frame' dimension of ncoutfile has length %d, but the store has %d frames with positions." % (len(ncoutfile.dimensions['frame']), nframes))
+        if 'replica' not in ncoutfile.dimensions:
+            ncoutfile.createDimension('replica', nreplicas)
+        if 'records' not in ncoutfile.variables:
+            ncoutfile.createVariable('records', 'i', ('frame',))
+        ncoutfile.variables['records'][:] = records
+        for observable in observables:
+            ncvar = ncoutfile.createVariable(observable.name, 'f', ('frame','replica'))
+            setattr(ncvar, 'units', getattr(observable, 'units', 'none'))
+            setattr(ncvar, 'atoms', numpy.array(observable.atoms, numpy.int32))
+            values[observable.name] = ncvar
+
+    # Compute observables a chunk of frames at a time.
+    nchunk = max(1, max_memory // (nreplicas * len(atoms) * nspatial * 8))
+    for start in range(0, nframes, nchunk):
+        stop = min(start + nchunk, nframes)
+        x = numpy.array(positions[records[start]:records[stop-1]+1:interval, :, list(atoms), :], numpy.float64)
+        for (observable, indices) in zip(observables, observable_atoms):
+            values[observable.name][start:stop,:] = observable.compute(x[:,:,indices,:])
+
+    return (records, values)
+
+def compute_torsion_trajectories(ncfile, filename, atoms=(1735, 1737, 1739, 1741)):
+    """Write out torsion trajectories, by default for Val 111.
 
-    # Compute torsion angle
-    def compute_torsion(positions, atoms):
-        # Compute vectors from cross products        
-        vBA = positions[atoms[0],:] - positions[atoms[1],:]
-        vBC = positions[atoms[2],:] - positions[atoms[1],:]
-        vCB = positions[atoms[1],:] - positions[atoms[2],:]
-        vCD = positions[atoms[3],:] - positions[atoms[2],:]
-        v1 = numpy.cross(vBA,vBC)
-        v2 = numpy.cross(vCB,vCD)
-        cos_theta = numpy.dot(v1,v2) / numpy.sqrt(numpy.dot(v1,v1) * numpy.dot(v2,v2))
-        theta = arccos(cos_theta) * 180.0 / math.pi
-        return theta
-                
-    # Compute torsion angles for each replica
-    contents = ""
-    for iteration in range(niterations):
-        for replica in range(nstates):
-            # Compute torsion
-            torsion = compute_torsion(array(ncfile.variables['positions'][iteration,replica,:,:]), atoms)
-            # Write torsion
-            contents += "%8.1f" % torsion
-        contents += "\n"
+    ARGUMENTS
+       ncfile (NetCDF) - NetCDF file object for input file
+       filename (string) - name of file to be written
 
-    # Write contents.
-    write_file(filename, contents)
+    OPTIONAL ARGUMENTS
+       atoms (tuple of int) - indices of the four atoms defining the torsion (default: N-CA-CB-CG1 of Val 111)
+
+    NOTES
+       Each line of the file holds the signed torsion angle (in degrees) of each replica for one frame with stored positions.
+    """
+
+    torsion = Torsion(*atoms)
+    [records, values] = compute_observables(ncfile, [torsion])
+    numpy.savetxt(filename, values[torsion.name], fmt='%8.1f', delimiter='')
 
     return
 
@@ -322,7 +664,7 @@ def write_pdb_replica_trajectories(basepdb, directory, prefix, title, ncfile, tr
         	file_name= "%s-%03d.pdb" % (prefix,state_index)
 		full_filename=directory+'/'+file_name
 		outfile = open(full_filename, 'w')
-		for iteration in range(niterations):
+		for iteration in range(0, niterations, get_positions_interval(ncfile)):
         		state_indices = ncfile.variables['states'][iteration,:]
         		replica_index = list(state_indices).index(state_index)
     			outfile.write('MODEL     %4d\n' % (iteration+1))                        
@@ -337,7 +679,7 @@ def write_pdb_replica_trajectories(basepdb, directory, prefix, title, ncfile, tr
 		file_name="R-%s-%03d.pdb" % (prefix,replica_index)
 		full_filename=directory+'/'+file_name
 		outfile = open(full_filename, 'w')
-		for iteration in range(niterations):
+		for iteration in range(0, niterations, get_positions_interval(ncfile)):
                     outfile.write('MODEL     %4d\n' % (iteration+1))                                            
                     write_pdb(atom_list,outfile,iteration,replica_index,title,ncfile,trajectory_by_state=False)
                     outfile.write('ENDMDL\n')                    
@@ -452,7 +794,7 @@ def show_mixing_statistics(ncfile, cutoff=0.05, nequil=0):
 
     ARGUMENTS
 
-    ncfile (netCDF4.Dataset) - NetCDF file
+    ncfile (netCDF4.Dataset or ReplicaExchangeDataset) - NetCDF file, or a dataset reading it
     
     OPTIONAL ARGUMENTS
 
@@ -461,21 +803,12 @@ def show_mixing_statistics(ncfile, cutoff=0.05, nequil=0):
     
     """
     
-    # Get dimensions.
-    niterations = ncfile.variables['states'].shape[0]
-    nstates = ncfile.variables['states'].shape[1]
+    dataset = get_dataset(ncfile)
+    nstates = dataset.nstates
 
     # Compute statistics of transitions.
-    Nij = numpy.zeros([nstates,nstates], numpy.float64)
-    for iteration in range(nequil, niterations-1):
-        for ireplica in range(nstates):
-            istate = ncfile.variables['states'][iteration,ireplica]
-            jstate = ncfile.variables['states'][iteration+1,ireplica]
-            Nij[istate,jstate] += 0.5
-            Nij[jstate,istate] += 0.5
-    Tij = numpy.zeros([nstates,nstates], numpy.float64)
-    for istate in range(nstates):
-        Tij[istate,:] = Nij[istate,:] / Nij[istate,:].sum()
+    Nij = dataset.transition_counts(nequil)
+    Tij = Nij / Nij.sum(1)[:,numpy.newaxis]
 
     # Print observed transition probabilities.
     print "Cumulative symmetrized state mixing transition matrix:"
@@ -507,19 +840,17 @@ def analyze_acceptance_probabilities(ncfile, cutoff = 0.4):
     """Analyze acceptance probabilities.
 
     ARGUMENTS
-       ncfile (NetCDF) - NetCDF file to be analyzed.
+       ncfile (NetCDF or ReplicaExchangeDataset) - NetCDF file to be analyzed, or a dataset reading it.
 
     OPTIONAL ARGUMENTS
        cutoff (float) - cutoff for showing acceptance probabilities as blank (default: 0.4)
     """
 
-    # Get current dimensions.
-    niterations = ncfile.variables['mixing'].shape[0]
-    nstates = ncfile.variables['mixing'].shape[1]
+    dataset = get_dataset(ncfile)
+    nstates = dataset.nstates
 
-    # Compute mean.
-    mixing = ncfile.variables['mixing'][:,:,:]
-    Pij = mean(mixing, 0)
+    # Compute fraction of proposed swaps that were accepted.
+    Pij = dataset.acceptance_probabilities()
 
     # Write title.
     print "Average state-to-state acceptance probabilities"
@@ -550,27 +881,25 @@ def check_energies(ncfile, atoms):
     Examine energy history for signs of instability (nans).
 
     ARGUMENTS
-       ncfile (NetCDF) - input YANK netcdf file
+       ncfile (NetCDF or ReplicaExchangeDataset) - input YANK netcdf file, or a dataset reading it
+
+    NOTES
+       Records without a full energy matrix (see get_full_energy_records) contain NaN for states that were not evaluated.
+       Only the energy of each replica in its current state, which is always evaluated, and the entries of full
+       records are checked.
     """
 
+    dataset = get_dataset(ncfile)
+    ncfile = dataset.ncfile
+
     # Get current dimensions.
-    niterations = ncfile.variables['energies'].shape[0]
-    nstates = ncfile.variables['energies'].shape[1]
+    niterations = dataset.niterations
+    nstates = dataset.nstates
 
     # Extract energies.
     print "Reading energies..."
-    energies = ncfile.variables['energies']
-    u_kln_replica = numpy.zeros([nstates, nstates, niterations], numpy.float64)
-    for n in range(niterations):
-        u_kln_replica[:,:,n] = energies[n,:,:]
-    print "Done."
-
-    # Deconvolute replicas
-    print "Deconvoluting replicas..."
-    u_kln = numpy.zeros([nstates, nstates, niterations], numpy.float64)
-    for iteration in range(niterations):
-        state_indices = ncfile.variables['states'][iteration,:]
-        u_kln[state_indices,:,iteration] = energies[iteration,:,:]
+    energies = dataset.energies
+    states = dataset.states
     print "Done."
 
     # Show all self-energies
@@ -579,16 +908,21 @@ def check_energies(ncfile, atoms):
         print 'all self-energies for all replicas'
         for iteration in range(niterations):
             for replica in range(nstates):
-                state = int(ncfile.variables['states'][iteration,replica])
+                state = int(states[iteration,replica])
                 print '%12.1f' % energies[iteration, replica, state],
             print ''
 
-    # If no energies are 'nan', we're clean.
-    if not numpy.any(numpy.isnan(energies[:,:,:])):
+    # Extract the energy of each replica in its current state.
+    u_nk = energies[numpy.arange(niterations)[:,numpy.newaxis], numpy.arange(nstates)[numpy.newaxis,:], states]
+
+    # If no evaluated energies are 'nan', we're clean.
+    nan_nk = numpy.isnan(u_nk)
+    foreign_nan = numpy.any(numpy.isnan(energies[dataset.full,:,:]))
+    if not (numpy.any(nan_nk) or foreign_nan):
         return
 
     # There are some energies that are 'nan', so check if the first iteration has nans in their *own* energies:
-    u_k = numpy.diag(energies[0,:,:])
+    u_k = u_nk[0,:]
     if numpy.any(numpy.isnan(u_k)):
         print "First iteration has exploded replicas.  Check to make sure structures are minimized before dynamics"
         print "Energies for all replicas after equilibration:"
@@ -597,10 +931,10 @@ def check_energies(ncfile, atoms):
 
     # There are some energies that are 'nan' past the first iteration.  Find the first instances for each replica and write PDB files.
     first_nan_k = numpy.zeros([nstates], numpy.int32)
-    for iteration in range(niterations):
-        for k in range(nstates):
-            if numpy.isnan(energies[iteration,k,k]) and first_nan_k[k]==0:
-                first_nan_k[k] = iteration
+    for k in range(nstates):
+        nan_iterations = numpy.nonzero(nan_nk[1:,k])[0]
+        if len(nan_iterations) > 0:
+            first_nan_k[k] = nan_iterations[0] + 1
     if not all(first_nan_k == 0):
         print "Some replicas exploded during the simulation."
         print "Iterations where explosions were detected for each replica:"
@@ -608,8 +942,8 @@ def check_energies(ncfile, atoms):
         print "Writing PDB files immediately before explosions were detected..."
         for replica in range(nstates):            
             if (first_nan_k[replica] > 0):
-                state = ncfile.variables['states'][iteration,replica]
                 iteration = first_nan_k[replica] - 1
+                state = states[iteration,replica]
                 filename = 'replica-%d-before-explosion.pdb' % replica
                 title = 'replica %d state %d iteration %d' % (replica, state, iteration)
                 write_pdb(atoms, filename, iteration, replica, title, ncfile)
@@ -617,7 +951,7 @@ def check_energies(ncfile, atoms):
                 write_crd(filename, iteration, replica, title, ncfile)
         sys.exit(1)
 
-    # There are some energies that are 'nan', but these are energies at foreign lambdas.  We'll just have to be careful with MBAR.
+    # There are some evaluated energies that are 'nan', but these are energies at foreign lambdas.  We'll just have to be careful with MBAR.
     # Raise a warning.
     print "WARNING: Some energies at foreign lambdas are 'nan'.  This is recoverable."
         
@@ -636,7 +970,7 @@ def check_positions(ncfile):
     natoms = ncfile.variables['positions'].shape[2]
 
     # Compute torsion angles for each replica
-    for iteration in range(niterations):
+    for iteration in range(0, niterations, get_positions_interval(ncfile)):
         for replica in range(nstates):
             # Extract positions
             positions = numpy.array(ncfile.variables['positions'][iteration,replica,:,:])
@@ -656,7 +990,7 @@ def estimate_free_energies(ncfile, ndiscard = 0, nuse = None):
     """Estimate free energies of all alchemical states.
 
     ARGUMENTS
-       ncfile (NetCDF) - input YANK netcdf file
+       ncfile (NetCDF or ReplicaExchangeDataset) - input YANK netcdf file, or a dataset reading it
 
     OPTIONAL ARGUMENTS
        ndiscard (int) - number of iterations to discard to equilibration
@@ -665,31 +999,24 @@ def estimate_free_energies(ncfile, ndiscard = 0, nuse = None):
     TODO: Automatically determine 'ndiscard'.
     """
 
+    dataset = get_dataset(ncfile)
+
     # Get current dimensions.
-    niterations = ncfile.variables['energies'].shape[0]
-    nstates = ncfile.variables['energies'].shape[1]
-    natoms = ncfile.variables['energies'].shape[2]
+    niterations = dataset.niterations
+    nstates = dataset.nstates
 
     # Extract energies.
     print "Reading energies..."
-    energies = ncfile.variables['energies']
-    u_kln_replica = numpy.zeros([nstates, nstates, niterations], numpy.float64)
-    for n in range(niterations):
-        u_kln_replica[:,:,n] = energies[n,:,:]
+    u_kln_replica = dataset.u_kln_replica
     print "Done."
 
     # Deconvolute replicas
     print "Deconvoluting replicas..."
-    u_kln = numpy.zeros([nstates, nstates, niterations], numpy.float64)
-    for iteration in range(niterations):
-        state_indices = ncfile.variables['states'][iteration,:]
-        u_kln[state_indices,:,iteration] = energies[iteration,:,:]
+    u_kln = dataset.u_kln
     print "Done."
 
     # Compute total negative log probability over all iterations.
-    u_n = numpy.zeros([niterations], numpy.float64)
-    for iteration in range(niterations):
-        u_n[iteration] = numpy.sum(numpy.diagonal(u_kln[:,:,iteration]))
+    u_n = dataset.u_n
     #print u_n
 
     # DEBUG
@@ -708,15 +1035,22 @@ def estimate_free_energies(ncfile, ndiscard = 0, nuse = None):
         u_kln_replica = u_kln_replica[:,:,0:nuse]
         u_kln = u_kln[:,:,0:nuse]
         u_n = u_n[0:nuse]
+
+    # Use only iterations for which the full energy matrix was evaluated.
+    full = dataset.full[ndiscard:]
+    if (nuse):
+        full = full[0:nuse]
+    u_kln = u_kln[:,:,full]
+    u_n = u_n[full]
     
     # Subsample data to obtain uncorrelated samples
     N_k = numpy.zeros(nstates, numpy.int32)    
-    indices = timeseries.subsampleCorrelatedData(u_n) # indices of uncorrelated samples
+    indices = timeseries.subsampleCorrelatedData(u_n, method='fft') # indices of uncorrelated samples
     #print u_n # DEBUG
     #indices = range(0,u_n.size) # DEBUG - assume samples are uncorrelated
     N = len(indices) # number of uncorrelated samples
     N_k[:] = N      
-    u_kln[:,:,0:N] = u_kln[:,:,indices]
+    u_kln = u_kln[:,:,indices] # copy, so the shared dataset arrays are not modified
     print "number of uncorrelated samples:"
     print N_k
     print ""
@@ -756,7 +1090,7 @@ def estimate_enthalpies(ncfile, ndiscard = 0, nuse = None):
     """Estimate enthalpies of all alchemical states.
 
     ARGUMENTS
-       ncfile (NetCDF) - input YANK netcdf file
+       ncfile (NetCDF or ReplicaExchangeDataset) - input YANK netcdf file, or a dataset reading it
 
     OPTIONAL ARGUMENTS
        ndiscard (int) - number of iterations to discard to equilibration
@@ -766,31 +1100,24 @@ def estimate_enthalpies(ncfile, ndiscard = 0, nuse = None):
     TODO: Combine some functions with estimate_free_energies.
     """
 
+    dataset = get_dataset(ncfile)
+
     # Get current dimensions.
-    niterations = ncfile.variables['energies'].shape[0]
-    nstates = ncfile.variables['energies'].shape[1]
-    natoms = ncfile.variables['energies'].shape[2]
+    niterations = dataset.niterations
+    nstates = dataset.nstates
 
     # Extract energies.
     print "Reading energies..."
-    energies = ncfile.variables['energies']
-    u_kln_replica = numpy.zeros([nstates, nstates, niterations], numpy.float64)
-    for n in range(niterations):
-        u_kln_replica[:,:,n] = energies[n,:,:]
+    u_kln_replica = dataset.u_kln_replica
     print "Done."
 
     # Deconvolute replicas
     print "Deconvoluting replicas..."
-    u_kln = numpy.zeros([nstates, nstates, niterations], numpy.float64)
-    for iteration in range(niterations):
-        state_indices = ncfile.variables['states'][iteration,:]
-        u_kln[state_indices,:,iteration] = energies[iteration,:,:]
+    u_kln = dataset.u_kln
     print "Done."
 
     # Compute total negative log probability over all iterations.
-    u_n = numpy.zeros([niterations], numpy.float64)
-    for iteration in range(niterations):
-        u_n[iteration] = numpy.sum(numpy.diagonal(u_kln[:,:,iteration]))
+    u_n = dataset.u_n
     #print u_n
 
     # DEBUG
@@ -812,12 +1139,12 @@ def estimate_enthalpies(ncfile, ndiscard = 0, nuse = None):
 
     # Subsample data to obtain uncorrelated samples
     N_k = numpy.zeros(nstates, numpy.int32)
-    indices = timeseries.subsampleCorrelatedData(u_n) # indices of uncorrelated samples
+    indices = timeseries.subsampleCorrelatedData(u_n, method='fft') # indices of uncorrelated samples
     #print u_n # DEBUG
     #indices = range(0,u_n.size) # DEBUG - assume samples are uncorrelated
     N = len(indices) # number of uncorrelated samples
     N_k[:] = N      
-    u_kln[:,:,0:N] = u_kln[:,:,indices]
+    u_kln = u_kln[:,:,indices] # copy, so the shared dataset arrays are not modified
     print "number of uncorrelated samples:"
     print N_k
     print ""
@@ -835,37 +1162,17 @@ def extract_u_n(ncfile):
     """
     Extract timeseries of u_n = - log q(x_n)
 
-    """
-
-    # Get current dimensions.
-    niterations = ncfile.variables['energies'].shape[0]
-    nstates = ncfile.variables['energies'].shape[1]
-    natoms = ncfile.variables['energies'].shape[2]
-
-    # Extract energies.
-    print "Reading energies..."
-    energies = ncfile.variables['energies']
-    u_kln_replica = numpy.zeros([nstates, nstates, niterations], numpy.float64)
-    for n in range(niterations):
-        u_kln_replica[:,:,n] = energies[n,:,:]
-    print "Done."
+    ARGUMENTS
+       ncfile (NetCDF or ReplicaExchangeDataset) - input YANK netcdf file, or a dataset reading it
 
-    # Deconvolute replicas
-    print "Deconvoluting replicas..."
-    u_kln = numpy.zeros([nstates, nstates, niterations], numpy.float64)
-    for iteration in range(niterations):
-        state_indices = ncfile.variables['states'][iteration,:]
-        u_kln[state_indices,:,iteration] = energies[iteration,:,:]
-    print "Done."
+    RETURNS
+       u_n (numpy array) - u_n[n] is the total reduced potential of all replicas at iteration n; shared with the dataset, so do not modify
 
-    # Compute total negative log probability over all iterations.
-    u_n = numpy.zeros([niterations], numpy.float64)
-    for iteration in range(niterations):
-        u_n[iteration] = numpy.sum(numpy.diagonal(u_kln[:,:,iteration]))
+    """
 
-    return u_n
+    return get_dataset(ncfile).u_n
 
-def detect_equilibration(A_t):
+def detect_equilibration(A_t, ngrid=20):
     """
     Automatically detect equilibrated region.
 
@@ -873,30 +1180,23 @@ def detect_equilibration(A_t):
 
     A_t (numpy.array) - timeseries
 
+    OPTIONAL ARGUMENTS
+
+    ngrid (int) - number of start times tried per level of the coarse-to-fine search, or None to try all (default: 20)
+
     RETURNS
 
     t (int) - start of equilibrated data
     g (float) - statistical inefficiency of equilibrated data
     Neff_max (float) - number of uncorrelated samples   
+
+    NOTES
+
+    This delegates to timeseries.detectEquilibration(), which is also used online by ReplicaExchange.
     
     """
-    T = A_t.size
 
-    # Special case if timeseries is constant.
-    if A_t.std() == 0.0:
-        return (0, 1, T)
-    
-    g_t = numpy.ones([T-1], numpy.float32)
-    Neff_t = numpy.ones([T-1], numpy.float32)
-    for t in range(T-1):
-        g_t[t] = timeseries.statisticalInefficiency(A_t[t:T])
-        Neff_t[t] = (T-t+1) / g_t[t]
-    
-    Neff_max = Neff_t.max()
-    t = Neff_t.argmax()
-    g = g_t[t]
-    
-    return (t, g, Neff_max)
+    return timeseries.detectEquilibration(A_t, method='fft', ngrid=ngrid)
 
 
 #=============================================================================================
@@ -937,21 +1237,24 @@ if __name__ == '__main__':
     prefix = 'trajectory'
     write_pdb_replica_trajectories(reference_pdb_filename, output_directory, prefix, title, ncfile, trajectory_by_state=False)
 
+    # Read energies and states once for all analyses.
+    dataset = ReplicaExchangeDataset(ncfile)
+
     # Check to make sure no self-energies go nan.
-    check_energies(ncfile, atoms)
+    check_energies(dataset, atoms)
     
     # Check to make sure no positions are nan
     check_positions(ncfile)
 
     # Choose number of samples to discard to equilibration
-    u_n = extract_u_n(ncfile)
+    u_n = extract_u_n(dataset)
     [nequil, g_t, Neff_max] = detect_equilibration(u_n)
     print [nequil, Neff_max]
     
     # Examine acceptance probabilities.
-    show_mixing_statistics(ncfile, cutoff=0.05, nequil=nequil)
+    show_mixing_statistics(dataset, cutoff=0.05, nequil=nequil)
 
     # Estimate free energies.
-    (Deltaf_ij, dDeltaf_ij) = estimate_free_energies(ncfile, ndiscard = nequil)
+    (Deltaf_ij, dDeltaf_ij) = estimate_free_energies(dataset, ndiscard = nequil)
     print "DeltaF = %.3f +- %.3f kT" % (Deltaf_ij[0,-1], dDeltaf_ij[0,-1])
     
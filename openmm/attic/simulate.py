@@ -55,6 +55,9 @@ import simtk.unit as units
 # Import factory to generate alchemically modified System objects.
 import alchemy
 
+# Import thermodynamic state to evaluate reduced potentials.
+from thermodynamics import ThermodynamicState
+
 # We need NumPy and NetCDF for writing out data in a platform-portable format.
 import numpy 
 import netCDF4 as netcdf 
@@ -204,31 +207,21 @@ for jstate in range(nstates):
     print "Computing energies for state %d / %d..." % (jstate, nstates)
 
     # Select system corresponding to this alchemical state.
-    system = systems[jstate]
-
-    # Initialize integrator and context.
-    integrator = openmm.VerletIntegrator(timestep)
-    context = openmm.Context(system, integrator)
+    thermodynamic_state = ThermodynamicState(system=systems[jstate], temperature=temperature)
 
     for iteration in range(niterations):
         print "  iteration %d / %d" % (iteration, niterations)
 
-        for istate in range(nstates):
-            # Set configuration.
-            positions = units.Quantity(ncfile.variables['positions'][iteration,istate,:,:], units.angstroms)
-            box_vectors = units.Quantity(ncfile.variables['box_vectors'][iteration,istate,:,:], units.angstroms)
-            context.setPositions(positions)
-            context.setPeriodicBoxVectors(box_vectors[0,:], box_vectors[1,:], box_vectors[2,:])
-
-            # Get energy.
-            state = context.getState(getEnergy=True)
-            ncfile.variables['energies'][iteration,istate,jstate] = state.getPotentialEnergy() / kT
+        # Evaluate the snapshots from all states at this iteration in one batch.
+        positions = units.Quantity(numpy.array(ncfile.variables['positions'][iteration,:,:,:]), units.angstroms)
+        box_vectors = units.Quantity(numpy.array(ncfile.variables['box_vectors'][iteration,:,:,:]), units.angstroms)
+        ncfile.variables['energies'][iteration,:,jstate] = thermodynamic_state.reduced_potential_multiple(positions, box_vectors)
 
     # Sync up NetCDF file.
     ncfile.sync()
         
     # Clean up.
-    del context, integrator
+    del thermodynamic_state
 
 # Clean up.
 ncfile.close()
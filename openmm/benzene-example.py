@@ -332,7 +332,7 @@ if __name__ == "__main__":
     # Create replica-exchange simulation.
     if verbose: print "Setting up replica-exchange simulation..."
     output_filename = 'repex.nc'
-    simulation = repex.HamiltonianExchange(reference_state, systems, [coordinates], output_filename) # initialize the replica-exchange simulation
+    simulation = repex.HamiltonianExchange(reference_state, systems, [coordinates], output_filename, share_systems=True) # initialize the replica-exchange simulation
     simulation.verbose = True
     simulation.number_of_iterations = 1000
     simulation.timestep = timestep
@@ -0,0 +1,293 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Bounded pool of reusable OpenMM Context objects.
+
+DESCRIPTION
+
+Creating an OpenMM Context is expensive, and every Context holds a full copy of the System on its
+Platform (which, for GPU platforms, means device memory).  This module provides a process-wide
+pool of Context objects that are shared by everything that needs to evaluate or propagate a System,
+so that thermodynamic states sharing a System also share their Contexts.
+
+Provided classes include:
+
+* ContextPool - A thread-safe, bounded, least-recently-used pool of Context objects
+
+The process-wide pool used by ThermodynamicState is 'default_pool'.  It holds at most 'default_max_contexts'
+Contexts.  ReplicaExchange creates a private pool for each simulation unless it is given one.
+
+EXAMPLES
+
+Acquire a Context for a Lennard-Jones cluster, use it, and return it to the pool.
+
+>>> import simtk.unit as units
+>>> import simtk.pyopenmm.extras.testsystems as testsystems
+>>> [system, coordinates] = testsystems.LennardJonesCluster()
+>>> pool = ContextPool(max_contexts=4)
+>>> [context, integrator] = pool.acquire(system)
+>>> context.setPositions(coordinates)
+>>> potential = context.getState(getEnergy=True).getPotentialEnergy()
+>>> pool.release(context)
+
+NOTES
+
+Contexts are keyed by the identity of the System object and the Platform.  A Context that has been
+acquired is never handed out again until it is released, so threads never share a Context.  Idle
+Contexts beyond the configured limits are destroyed in least-recently-used order; Contexts in use
+are never destroyed, so the limits may be exceeded temporarily while many Contexts are in use.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import threading
+import collections
+
+import simtk.openmm
+import simtk.unit as units
+
+#=============================================================================================
+# REVISION CONTROL
+#=============================================================================================
+
+__version__ = "$Revision: $"
+
+#=============================================================================================
+# Context pool
+#=============================================================================================
+
+class _PooledContext(object):
+    """
+    A Context owned by a ContextPool, together with the Integrator and System it was created from.
+
+    """
+
+    def __init__(self, key, system, integrator_type, integrator, context, properties):
+        self.key = key                          # pool key (system identity, platform name)
+        self.system = system                    # reference to the System, which keeps the key valid
+        self.integrator_type = integrator_type  # name of the Integrator class
+        self.integrator = integrator
+        self.context = context
+        self.properties = properties            # Platform properties the Context was created with, or None for the Platform defaults
+        self.nparticles = system.getNumParticles()
+
+class ContextPool(object):
+    """
+    A thread-safe, bounded, least-recently-used pool of Context objects.
+
+    EXAMPLES
+
+    Create a pool holding at most two Contexts and at most 10000 particles in total.
+
+    >>> pool = ContextPool(max_contexts=2, max_particles=10000)
+
+    NOTES
+
+    The number of particles in a Context is used as a proxy for the memory it consumes.
+
+    """
+
+    def __init__(self, max_contexts=None, max_particles=None):
+        """
+        Initialize an empty pool.
+
+        OPTIONAL ARGUMENTS
+
+        max_contexts (int) - maximum number of Contexts held by the pool, or None for no limit (default: None)
+        max_particles (int) - maximum total number of particles in Contexts held by the pool, or None for no limit (default: None)
+
+        """
+
+        self.max_contexts = max_contexts
+        self.max_particles = max_particles
+
+        self._lock = threading.Lock()
+        self._idle = collections.OrderedDict() # _idle[id(context)] is an idle _PooledContext, least recently used first
+        self._in_use = dict() # _in_use[id(context)] is a _PooledContext that has been acquired and not yet released
+
+        # Statistics.
+        self.ncreated = 0 # number of Contexts created
+        self.nreused = 0 # number of requests satisfied by an existing Context
+        self.nevicted = 0 # number of Contexts destroyed to stay within limits
+
+        return
+
+    @staticmethod
+    def _key(system, platform):
+        """
+        Return the pool key for Contexts of the given System on the given Platform.
+
+        """
+
+        if platform is None:
+            return (id(system), None)
+        return (id(system), platform.getName())
+
+    def acquire(self, system, integrator_type=None, platform=None, temperature=None, collision_rate=None, timestep=None, mm=None, properties=None):
+        """
+        Acquire a Context for the given System for exclusive use until it is released.
+
+        ARGUMENTS
+
+        system (simtk.openmm.System) - the System the Context must represent
+
+        OPTIONAL ARGUMENTS
+
+        integrator_type (string) - 'VerletIntegrator' or 'LangevinIntegrator', or None if any Integrator will do (default: None)
+        platform (simtk.openmm.Platform) - the Platform on which the Context is to be created, or None for the default (default: None)
+        temperature (simtk.unit.Quantity with units of temperature) - temperature of a LangevinIntegrator (default: None)
+        collision_rate (simtk.unit.Quantity with units of inverse time) - collision rate of a LangevinIntegrator (default: None)
+        timestep (simtk.unit.Quantity with units of time) - integrator timestep (default: None, which uses 1 fs for new Integrators)
+        mm (simtk.openmm API) - OpenMM API implementation used to create new objects (default: simtk.openmm)
+        properties (dict) - Platform properties for the Context, or None if a Context with any properties will do; new
+           Contexts are then created with the Platform defaults (default: None)
+
+        RETURNS
+
+        context (simtk.openmm.Context) - the Context, which must be passed to release() when no longer needed
+        integrator (simtk.openmm.Integrator) - the Integrator bound to the Context, with the requested parameters set
+
+        NOTES
+
+        If an idle Context for the System exists, it is reused and the requested integrator parameters are applied to it.
+        The positions, velocities, box vectors, and global parameters of a reused Context are whatever was last set.
+
+        """
+
+        if mm is None: mm = simtk.openmm
+        key = self._key(system, platform)
+
+        # Find the most recently used idle Context of the requested kind.
+        entry = None
+        self._lock.acquire()
+        try:
+            for (token, candidate) in reversed(self._idle.items()):
+                if (candidate.key == key) and ((integrator_type is None) or (candidate.integrator_type == integrator_type)) and ((properties is None) or (candidate.properties == properties)):
+                    entry = self._idle.pop(token)
+                    self._in_use[token] = entry
+                    self.nreused += 1
+                    break
+        finally:
+            self._lock.release()
+
+        if entry is None:
+            # Create a new Context outside the lock, since this can be slow.
+            if integrator_type is None: integrator_type = 'VerletIntegrator'
+            if timestep is None: timestep = 1.0 * units.femtosecond
+            if integrator_type == 'LangevinIntegrator':
+                integrator = mm.LangevinIntegrator(temperature, collision_rate, timestep)
+            elif integrator_type == 'VerletIntegrator':
+                integrator = mm.VerletIntegrator(timestep)
+            else:
+                raise ValueError("Unsupported integrator type '%s'." % integrator_type)
+            if platform is None:
+                context = mm.Context(system, integrator)
+            elif properties:
+                context = mm.Context(system, integrator, platform, properties)
+            else:
+                context = mm.Context(system, integrator, platform)
+            entry = _PooledContext(key, system, integrator_type, integrator, context, properties)
+
+            self._lock.acquire()
+            try:
+                self._in_use[id(context)] = entry
+                self.ncreated += 1
+                self._evict()
+            finally:
+                self._lock.release()
+        else:
+            # Apply requested parameters to the reused Integrator.
+            if timestep is not None:
+                entry.integrator.setStepSize(timestep)
+            if entry.integrator_type == 'LangevinIntegrator':
+                if temperature is not None: entry.integrator.setTemperature(temperature)
+                if collision_rate is not None: entry.integrator.setFriction(collision_rate)
+
+        return (entry.context, entry.integrator)
+
+    def release(self, context, discard=False):
+        """
+        Return a Context obtained from acquire() to the pool.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the Context to release
+
+        OPTIONAL ARGUMENTS
+
+        discard (boolean) - if True, the Context is destroyed instead of being kept for reuse, e.g. because it failed (default: False)
+
+        """
+
+        token = id(context)
+        self._lock.acquire()
+        try:
+            entry = self._in_use.pop(token)
+            if not discard:
+                self._idle[token] = entry
+            self._evict()
+        finally:
+            self._lock.release()
+
+        return
+
+    def clear(self):
+        """
+        Destroy all idle Contexts.
+
+        """
+
+        self._lock.acquire()
+        try:
+            self._idle.clear()
+        finally:
+            self._lock.release()
+
+        return
+
+    def _evict(self):
+        """
+        Destroy least recently used idle Contexts until the pool is within its limits.
+
+        NOTES
+
+        The caller must hold the lock.
+
+        """
+
+        while len(self._idle) > 0:
+            entries = list(self._idle.values()) + list(self._in_use.values())
+            over_count = (self.max_contexts is not None) and (len(entries) > self.max_contexts)
+            over_particles = (self.max_particles is not None) and (sum([ entry.nparticles for entry in entries ]) > self.max_particles)
+            if not (over_count or over_particles):
+                break
+            self._idle.popitem(last=False)
+            self.nevicted += 1
+
+        return
+
+    def __len__(self):
+        return len(self._idle) + len(self._in_use)
+
+#=============================================================================================
+# Process-wide pool
+#=============================================================================================
+
+default_max_contexts = 16 # number of Contexts kept by the process-wide pool
+
+default_pool = ContextPool(max_contexts=default_max_contexts) # pool shared by all ThermodynamicState objects in this process
+
+#=============================================================================================
+# MAIN AND TESTS
+#=============================================================================================
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
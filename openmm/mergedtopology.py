@@ -71,6 +71,8 @@ import numpy
 import copy
 import time
 
+import systemregistry
+
 #=============================================================================================
 # MergedTopologyFactory
 #=============================================================================================
@@ -108,9 +110,12 @@ class MergedTopologyFactory(object):
         
         """
 
-        # Store deep copies of both molecules.
-        self.system_A = copy.deepcopy(system_A)
-        self.system_B = copy.deepcopy(system_B)
+        # Store copies of both molecules, which are only read; shared Systems are immutable, so they need not be copied.
+        [self.system_A, self.system_B] = [system_A, system_B]
+        if not systemregistry.default_registry.is_shared(system_A):
+            self.system_A = copy.deepcopy(system_A)
+        if not systemregistry.default_registry.is_shared(system_B):
+            self.system_B = copy.deepcopy(system_B)
 
         # Store copy of atom correspondence list.
         self.corresponding_atoms = copy.deepcopy(corresponding_atoms)
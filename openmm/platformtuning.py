@@ -0,0 +1,339 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Measured selection of the fastest OpenMM Platform and Platform properties for a System.
+
+DESCRIPTION
+
+The static Platform.getSpeed() estimate ignores system size, nonbonded method, thread count, and precision.
+This module times a short run of dynamics of the actual System(s) on each available Platform, for each
+candidate setting of its tunable properties (CpuThreads for the CPU platform, precision for GPU platforms),
+and picks the setting with the highest throughput.  Decisions can be cached in a JSON file keyed by the
+System fingerprints, host name, and OpenMM version, so later runs start without benchmarking.  The selected
+properties are returned for passing to each Context; the global Platform defaults are not changed.
+
+Provided functions include:
+
+* select_platform - Select the fastest Platform and properties for the given Systems, using the cache if possible
+* benchmark - Time dynamics of one System on one Platform with the given properties
+
+EXAMPLES
+
+Select the fastest platform for a Lennard-Jones fluid, without caching the result.
+
+>>> import simtk.pyopenmm.extras.testsystems as testsystems
+>>> [system, coordinates] = testsystems.LennardJonesFluid()
+>>> [platform, properties] = select_platform([system], coordinates, cache_filename=None, nsteps=10)
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import os
+import time
+import json
+import socket
+import tempfile
+import multiprocessing
+
+import simtk.openmm
+import simtk.unit as units
+
+import systemregistry
+
+#=============================================================================================
+# REVISION CONTROL
+#=============================================================================================
+
+__version__ = "$Revision: $"
+
+#=============================================================================================
+# MODULE CONSTANTS
+#=============================================================================================
+
+precision_property_names = ['CudaPrecision', 'OpenCLPrecision', 'Precision'] # names of precision properties used by GPU platforms
+
+#=============================================================================================
+# Candidate settings
+#=============================================================================================
+
+def _thread_counts(ncpus):
+    """
+    Return candidate CpuThreads values: powers of two up to the number of cores, and the number of cores itself.
+
+    """
+
+    counts = set([ncpus])
+    count = 1
+    while count < ncpus:
+        counts.add(count)
+        count *= 2
+    return sorted(counts)
+
+def candidate_properties(platform, precisions=None, ncpus=None):
+    """
+    Return the candidate property settings to benchmark for a Platform.
+
+    ARGUMENTS
+
+    platform (simtk.openmm.Platform) - the Platform
+
+    OPTIONAL ARGUMENTS
+
+    precisions (list of string) - precision modes to try on platforms that support them (default: ['mixed', 'single', 'double'])
+    ncpus (int) - number of cores on this host (default: multiprocessing.cpu_count())
+
+    RETURNS
+
+    candidates (list of dict) - each dict maps property names to string values; an empty dict uses the Platform defaults
+
+    """
+
+    if precisions is None: precisions = ['mixed', 'single', 'double']
+    if ncpus is None: ncpus = multiprocessing.cpu_count()
+
+    property_names = list(platform.getPropertyNames())
+    if 'CpuThreads' in property_names:
+        return [ {'CpuThreads' : str(nthreads)} for nthreads in _thread_counts(ncpus) ]
+    for name in precision_property_names:
+        if name in property_names:
+            return [ {name : precision} for precision in precisions ]
+    return [ dict() ]
+
+def concurrency(platform_name, properties, ncpus=None, nthreads=None):
+    """
+    Return the number of Contexts a node runs concurrently with the given setting, as ReplicaExchange chooses it.
+
+    ARGUMENTS
+
+    platform_name (string) - name of the Platform
+    properties (dict) - Platform properties
+
+    OPTIONAL ARGUMENTS
+
+    ncpus (int) - number of cores on this host (default: multiprocessing.cpu_count())
+    nthreads (int) - number of threads requested by the caller, or None to choose from the Platform (default: None)
+
+    RETURNS
+
+    ncontexts (int) - number of Contexts that can run at once without oversubscribing the cores
+
+    """
+
+    if ncpus is None: ncpus = multiprocessing.cpu_count()
+
+    if platform_name == 'Reference':
+        ncontexts = ncpus
+    elif 'CpuThreads' in properties:
+        ncontexts = max(1, ncpus // max(1, int(properties['CpuThreads'])))
+    else:
+        ncontexts = 1
+
+    if nthreads is not None:
+        ncontexts = max(1, min(ncontexts, nthreads))
+    return ncontexts
+
+#=============================================================================================
+# Benchmarking
+#=============================================================================================
+
+def benchmark(system, coordinates, platform, properties, nsteps=50, nwarmup=5, timestep=None, temperature=None, mm=None):
+    """
+    Time Langevin dynamics of one System on one Platform with the given properties.
+
+    ARGUMENTS
+
+    system (simtk.openmm.System) - the System to simulate
+    coordinates (simtk.unit.Quantity of natoms x 3 array with units of length) - initial coordinates
+    platform (simtk.openmm.Platform) - the Platform to use
+    properties (dict) - Platform properties to use
+
+    OPTIONAL ARGUMENTS
+
+    nsteps (int) - number of timed steps (default: 50)
+    nwarmup (int) - number of untimed steps taken first, to exclude kernel compilation and setup (default: 5)
+    timestep (simtk.unit.Quantity with units of time) - timestep (default: 0.5 fs, small enough for unminimized coordinates)
+    temperature (simtk.unit.Quantity with units of temperature) - temperature (default: 298 K)
+    mm (simtk.openmm API) - OpenMM API implementation to use (default: simtk.openmm)
+
+    RETURNS
+
+    seconds_per_step (float) - wall clock time per step, or None if the Platform failed with these properties
+
+    """
+
+    if mm is None: mm = simtk.openmm
+    if timestep is None: timestep = 0.5 * units.femtoseconds
+    if temperature is None: temperature = 298.0 * units.kelvin
+
+    try:
+        integrator = mm.LangevinIntegrator(temperature, 1.0 / units.picoseconds, timestep)
+        context = mm.Context(system, integrator, platform, properties)
+        context.setPositions(coordinates)
+        context.setVelocitiesToTemperature(temperature)
+
+        # Warm up, then wait for all queued work to finish before starting the clock.
+        integrator.step(nwarmup)
+        context.getState(getEnergy=True)
+
+        initial_time = time.time()
+        integrator.step(nsteps)
+        context.getState(getEnergy=True) # forces GPU platforms to finish
+        final_time = time.time()
+    except Exception:
+        return None
+    finally:
+        context = None
+        integrator = None
+
+    return (final_time - initial_time) / float(nsteps)
+
+#=============================================================================================
+# Decision cache
+#=============================================================================================
+
+def _cache_key(systems, mm=None):
+    """
+    Return the cache key for a list of Systems on this host and OpenMM version.
+
+    """
+
+    if mm is None: mm = simtk.openmm
+    fingerprints = [ systemregistry.default_registry.fingerprint(system, mm=mm) for system in systems ]
+    return '%s:%s:%s' % (socket.gethostname(), mm.Platform.getOpenMMVersion(), ','.join(fingerprints))
+
+def _read_cache(cache_filename):
+    """
+    Read the decision cache, returning an empty dict if it does not exist or cannot be read.
+
+    """
+
+    try:
+        infile = open(cache_filename, 'r')
+        try:
+            return json.load(infile)
+        finally:
+            infile.close()
+    except Exception:
+        return dict()
+
+def _write_cache_entry(cache_filename, key, entry):
+    """
+    Add an entry to the decision cache, replacing the file atomically so that concurrent readers never see a partial file.
+
+    """
+
+    cache = _read_cache(cache_filename)
+    cache[key] = entry
+    try:
+        directory = os.path.dirname(os.path.abspath(cache_filename))
+        (fd, temporary_filename) = tempfile.mkstemp(dir=directory, prefix='.platform-cache-')
+        outfile = os.fdopen(fd, 'w')
+        try:
+            json.dump(cache, outfile, indent=2, sort_keys=True)
+        finally:
+            outfile.close()
+        os.rename(temporary_filename, cache_filename)
+    except Exception as e:
+        # The cache is only an optimization.
+        print "Could not write platform cache '%s': %s" % (cache_filename, str(e))
+
+    return
+
+#=============================================================================================
+# Platform selection
+#=============================================================================================
+
+def select_platform(systems, coordinates, cache_filename=None, nsteps=50, precisions=None, nthreads=None, mm=None, verbose=False):
+    """
+    Select the fastest Platform and Platform properties for the given Systems, benchmarking them if no cached decision exists.
+
+    ARGUMENTS
+
+    systems (list of simtk.openmm.System) - the Systems to benchmark; all must share the given coordinates
+    coordinates (simtk.unit.Quantity of natoms x 3 array with units of length) - coordinates used for benchmarking
+
+    OPTIONAL ARGUMENTS
+
+    cache_filename (string) - JSON file in which decisions are cached, or None to disable caching (default: None)
+    nsteps (int) - number of timed steps per benchmark (default: 50)
+    precisions (list of string) - precision modes to try on platforms that support them (default: ['mixed', 'single', 'double'])
+    nthreads (int) - number of threads the caller will use to run Contexts concurrently, or None if chosen from the Platform (default: None)
+    mm (simtk.openmm API) - OpenMM API implementation to use (default: simtk.openmm)
+    verbose (boolean) - if True, report benchmark results (default: False)
+
+    RETURNS
+
+    platform (simtk.openmm.Platform) - the fastest Platform
+    properties (dict) - the selected Platform properties, to be passed to each Context created on the Platform
+
+    NOTES
+
+    The score of a setting is the number of Contexts the node can run concurrently with it, divided by the total time per step of all Systems.
+    This accounts for the Reference platform and small CpuThreads values allowing several replicas to be propagated at once.
+
+    """
+
+    if mm is None: mm = simtk.openmm
+
+    key = _cache_key(systems, mm=mm)
+    if nthreads is not None: key += ':nthreads=%d' % nthreads
+
+    # Use the cached decision if there is one for a Platform that is still available.
+    if cache_filename is not None:
+        entry = _read_cache(cache_filename).get(key)
+        if entry is not None:
+            try:
+                platform = mm.Platform.getPlatformByName(str(entry['platform']))
+                properties = dict([ (str(name), str(value)) for (name, value) in entry['properties'].items() ])
+                if verbose: print "Using cached platform selection: %s %s" % (platform.getName(), str(properties))
+                return (platform, properties)
+            except Exception:
+                pass
+
+    # Benchmark every setting of every Platform.
+    best = None
+    for platform_index in range(mm.Platform.getNumPlatforms()):
+        platform = mm.Platform.getPlatform(platform_index)
+        for properties in candidate_properties(platform, precisions=precisions):
+            total_time = 0.0
+            for system in systems:
+                seconds_per_step = benchmark(system, coordinates, platform, properties, nsteps=nsteps, mm=mm)
+                if seconds_per_step is None:
+                    total_time = None
+                    break
+                total_time += seconds_per_step
+            if total_time is None:
+                if verbose: print "Platform %s %s: failed" % (platform.getName(), str(properties))
+                continue
+            ncontexts = concurrency(platform.getName(), properties, nthreads=nthreads)
+            score = ncontexts / max(total_time, 1.0e-9)
+            if verbose: print "Platform %s %s: %.3f ms/step, %d concurrent contexts" % (platform.getName(), str(properties), total_time * 1000.0, ncontexts)
+            if (best is None) or (score > best[0]):
+                best = (score, platform, properties, total_time)
+
+    if best is None:
+        raise Exception("No OpenMM Platform could simulate the given Systems.")
+
+    (score, platform, properties, total_time) = best
+    if verbose: print "Selected platform %s %s." % (platform.getName(), str(properties))
+
+    if cache_filename is not None:
+        entry = { 'platform' : platform.getName(), 'properties' : properties, 'seconds_per_step' : total_time, 'time' : time.asctime(time.localtime()) }
+        _write_cache_entry(cache_filename, key, entry)
+
+    return (platform, properties)
+
+#=============================================================================================
+# MAIN AND TESTS
+#=============================================================================================
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
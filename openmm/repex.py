@@ -18,6 +18,7 @@ Provided classes include:
 * ReplicaExchange - Base class for general replica-exchange simulations among specified ThermodynamicState objects
 * ParallelTempering - Convenience subclass of ReplicaExchange for parallel tempering simulations (one System object, many temperatures/pressures)
 * HamiltonianExchange - Convenience subclass of ReplicaExchange for Hamiltonian exchange simulations (many System objects, same temperature/pressure)
+* ParameterizedHamiltonianExchange - Hamiltonian exchange among states that differ only in global parameters of one shared System (Contexts shared by all replicas)
 
 DEPENDENCIES
 
@@ -40,7 +41,6 @@ TODO
 
 * Allow different integrators to be specified.
 * Allow different choices of thermal control and temperature-handling on exchange.
-* Add control over number of times swaps are attempted when mixing replicas?
 * Add another layer of abstraction so that the base class uses generic log probabilities, rather than reduced potentials.
 * Add support for HDF5 storage models.
 * See if we can get scipy.io.netcdf interface working, or more easily support additional NetCDF implementations / autodetect available implementations.
@@ -61,6 +61,10 @@ import math
 import copy
 import time
 import datetime
+import threading
+import Queue
+import multiprocessing
+import multiprocessing.pool
 
 import numpy
 import numpy.linalg
@@ -73,6 +77,9 @@ import netCDF4 as netcdf # netcdf4-python is used in place of scipy.io.netcdf fo
 #import tables as hdf5 # HDF5 will be supported in the future
 
 from thermodynamics import ThermodynamicState
+import contextpool
+import systemregistry
+import platformtuning
 
 #=============================================================================================
 # REVISION CONTROL
@@ -138,10 +145,42 @@ class ReplicaExchange(object):
     * nsteps_per_iteration (dimensionless) - number of timesteps per iteration (default: 500)
     * number_of_iterations (dimensionless) - number of replica-exchange iterations to simulate (default: 100)
     * number_of_equilibration_iterations (dimensionless) - number of equilibration iterations before beginning exchanges (default: 0)
-    * equilibration_timestep (units: time) - timestep for use in equilibration (default: 2 fs)
+    * equilibration_timestep (units: time) - timestep for use in equilibration (default: 1 fs)
+    * equilibration_ramp_iterations (int) - number of equilibration iterations over which the timestep is ramped linearly from equilibration_timestep to timestep, limited to number_of_equilibration_iterations (default: 10)
+    * automatic_equilibration (boolean) - if True, number_of_equilibration_iterations is a maximum, and equilibration stops once the reduced potential of every replica is stationary (default: False)
+    * equilibration_check_interval (int) - number of equilibration iterations between stationarity checks (default: 5)
+    * equilibration_min_samples (float) - number of uncorrelated samples the equilibrated part of each replica's reduced potential must contain for the replica to be considered stationary (default: 20)
     * verbose (boolean) - show information on run progress (default: False)
+    * minimize (boolean) - if True, minimize all replicas before equilibration (default: True)
+    * minimize_tolerance (units: energy/length) - minimization of a replica stops when the force falls below this tolerance (default: 10 kJ/mol/nm, the OpenMM default)
+    * minimize_max_iterations (int) - maximum number of minimizer iterations per replica, or 0 for no limit (default: 0)
+    * platform (simtk.openmm.Platform) - the Platform to use, or None to select one automatically (default: None)
+    * platform_autotune (boolean) - if True and no platform is specified, select the fastest Platform, thread count, and precision by benchmarking the systems; otherwise use Platform.getSpeed() (default: False)
+    * platform_cache_filename (string) - JSON file caching benchmarked platform choices by system fingerprint and host, or None to benchmark every run (default: None)
+    * platform_autotune_steps (int) - number of timed steps in each platform benchmark (default: 50)
     * replica_mixing_scheme (string) - scheme used to swap replicas: 'swap-all' or 'swap-neighbors' (default: 'swap-all')
-    * online_analysis (boolean) - if True, analysis will occur each iteration (default: False)
+    * nswap_attempts (int) - number of swaps attempted per iteration by the 'swap-all' scheme, or None for nstates**3 (default: None)
+    * full_energy_interval (int) - number of iterations between evaluations of the full energy matrix; on other iterations only the entries required by the replica mixing scheme are evaluated, and the rest are set to NaN; must be 1 or a multiple of store_energies_interval (default: 1)
+    * online_analysis (boolean) - if True, free energies are estimated with MBAR in a background thread during the run and stored in the 'online_analysis' group of the store file (default: False)
+    * online_analysis_interval (int) - number of iterations between submissions of the accumulated energies to the online analysis (default: 10)
+    * online_analysis_max_samples (int) - maximum number of samples kept for online analysis; when reached, every other sample is discarded and later samples are kept at half the rate (default: 4096)
+    * target_uncertainty (float) - if not None, the run stops once the online MBAR uncertainty of Deltaf_ij between target_state_pair falls below this (in kT); enables online_analysis (default: None)
+    * target_state_pair (tuple of int) - the pair of states (i,j) whose free energy difference uncertainty is monitored (default: (0,-1))
+    * target_effective_samples (float) - if not None, the run stops once the online analysis finds this many uncorrelated equilibrated samples; enables online_analysis (default: None)
+    * max_wall_time (float) - if not None, the run stops before starting an iteration that is expected to end more than this many seconds after run() was called (default: None)
+    * assign_velocities_with_context (boolean) - if True, the Context rather than this class draws Maxwell-Boltzmann velocities each iteration (default: False)
+    * mpi_gather_all (boolean) - if False, subclasses whose nodes own fixed replicas gather configurations only on the root node, for storage (default: True)
+    * mpi_rebalance_interval (int) - number of iterations between reassigning states to MPI nodes from measured propagation times, or None for a static assignment (default: 5)
+    * nthreads (int) - number of threads used on this node to propagate replicas and compute energies, or None to choose from the platform; use 1 to propagate replicas serially (default: None)
+    * context_pool (contextpool.ContextPool) - pool from which Contexts are acquired for dynamics, minimization, and energies, or None to create a private pool for this simulation whose Contexts are destroyed when the run ends; a provided pool and its limits are left unchanged (default: None)
+    * max_contexts (int) - number of Contexts the private pool may keep, or None for one per distinct System plus one per thread; ignored if context_pool is provided (default: None)
+    * store_energies_interval (int) - number of iterations between stored records of energies, states, box vectors, and mixing statistics (default: 1)
+    * store_positions_interval (int) - number of iterations between stored positions; must be a multiple of store_energies_interval (default: 1)
+    * store_buffer_iterations (int) - number of records buffered in memory before being written to the store file as one block (default: 1)
+    * store_sync_interval (int) - number of iterations between flushing, checkpointing, and syncing the store file to disk (default: 1)
+    * store_positions_zlib (boolean) - if True, positions are stored with lossless zlib compression (default: False)
+    * store_positions_least_significant_digit (int) - if not None, positions are quantized to this many decimal digits (in nm) and compressed (default: None)
+    * store_compression_level (int) - zlib compression level (1-9) used for compressed positions (default: 4)
     
     TODO
 
@@ -175,8 +214,33 @@ class ReplicaExchange(object):
     >>> simulation.nsteps_per_iteration = 500 # run 500 timesteps per iteration
     >>> simulation.run() # run the simulation
 
+    Store energies only every second iteration and positions every fourth, so that some iterations store no record.
+
+    >>> file = tempfile.NamedTemporaryFile()
+    >>> simulation = ReplicaExchange(states, coordinates, file.name)
+    >>> simulation.number_of_iterations = 5
+    >>> simulation.nsteps_per_iteration = 50
+    >>> simulation.store_energies_interval = 2
+    >>> simulation.store_positions_interval = 4
+    >>> simulation.run()
+
+    Run with a convergence target, which turns on online analysis; the run ends at the target or after number_of_iterations.
+
+    >>> file = tempfile.NamedTemporaryFile()
+    >>> simulation = ReplicaExchange(states, coordinates, file.name)
+    >>> simulation.number_of_iterations = 6
+    >>> simulation.nsteps_per_iteration = 50
+    >>> simulation.online_analysis_interval = 2
+    >>> simulation.target_uncertainty = 0.1 # in kT
+    >>> simulation.run()
+    >>> simulation.online_analysis
+    True
+
     """    
 
+    # True if each MPI node owns a fixed set of replicas and only ever needs their configurations.
+    _nodes_own_replicas = False
+
     def __init__(self, states, coordinates, store_filename, protocol=None, mm=None, mpicomm=None):
         """
         Initialize replica-exchange simulation facility.
@@ -237,11 +301,59 @@ class ReplicaExchange(object):
         self.number_of_iterations = 1
         self.equilibration_timestep = 1.0 * units.femtosecond
         self.number_of_equilibration_iterations = 0
+        self.automatic_equilibration = False # if True, equilibration stops as soon as the reduced potentials of all replicas are stationary
+        self.equilibration_ramp_iterations = 10 # number of equilibration iterations over which the timestep is ramped from equilibration_timestep to timestep
+        self.equilibration_check_interval = 5 # number of equilibration iterations between stationarity checks
+        self.equilibration_min_samples = 20.0 # number of uncorrelated samples each replica's equilibrated reduced potential must contain to be considered stationary
         self.title = 'Replica-exchange simulation created using ReplicaExchange class of repex.py on %s' % time.asctime(time.localtime())        
         self.minimize = True 
+        self.minimize_tolerance = 10.0 * units.kilojoules_per_mole / units.nanometers # minimization stops when the root-mean-square force falls below this
+        self.minimize_max_iterations = 0 # maximum number of minimizer iterations per replica, or 0 for no limit
         self.platform = None
+        self.platform_autotune = False # if True and no platform is specified, the fastest platform and settings are found by benchmarking
+        self.platform_cache_filename = None # file caching benchmarked platform choices, or None to always benchmark
+        self.platform_properties = None # Platform properties passed to each Context, or None for the Platform defaults
+        self.platform_autotune_steps = 50 # number of timed steps in each platform benchmark
         self.replica_mixing_scheme = 'swap-all' # mix all replicas thoroughly
-        self.online_analysis = False # if True, analysis will occur each iteration
+        self.nswap_attempts = None # number of swap attempts for 'swap-all' mixing, or None to use nstates**3
+        self.full_energy_interval = 1 # number of iterations between evaluations of the full energy matrix; otherwise only entries needed for mixing are evaluated
+        self.online_analysis = False # if True, free energies are estimated with MBAR in a background thread during the run
+        self.online_analysis_interval = 10 # number of iterations between submissions of accumulated energies to the online analysis
+        self.online_analysis_max_samples = 4096 # maximum number of samples kept for online analysis before the history is decimated
+        self.analysis_result = None # most recent result of the online analysis, or None if none has completed
+        self.target_uncertainty = None # if not None, stop once the uncertainty (in kT) of Deltaf_ij for target_state_pair falls below this
+        self.target_state_pair = (0, -1) # pair of states whose free energy difference uncertainty is monitored
+        self.target_effective_samples = None # if not None, stop once the online analysis finds this many uncorrelated samples
+        self.max_wall_time = None # if not None, wall clock budget (in seconds) for a call to run()
+        self.termination_reason = None # reason the last run() stopped before number_of_iterations, or None
+        self.assign_velocities_with_context = False # if True, velocities are assigned by Context.setVelocitiesToTemperature()
+        self.mpi_gather_all = True # if False, subclasses whose nodes own fixed replicas gather configurations only on the root node, for storage
+        self.mpi_rebalance_interval = 5 # number of iterations between reassigning states to MPI nodes from measured propagation times, or None for a static assignment
+        self.nthreads = None # number of threads used to propagate replicas and compute energies on this node, or None to choose from the platform
+        self.context_pool = None # pool from which Contexts are acquired, or None to create a private pool for this simulation
+        self.max_contexts = None # number of Contexts the private pool may keep, or None for one per distinct System plus one per thread
+        self.store_energies_interval = 1 # number of iterations between stored records of energies, states, box vectors, and mixing statistics
+        self.store_positions_interval = 1 # number of iterations between stored positions (must be a multiple of store_energies_interval)
+        self.store_buffer_iterations = 1 # number of records to buffer in memory before writing them to the store file
+        self.store_sync_interval = 1 # number of iterations between forced syncs of the store file to disk
+        self.store_positions_zlib = False # if True, positions are stored with lossless zlib compression
+        self.store_positions_least_significant_digit = None # if not None, positions are quantized to this many decimal digits (in nm) before compression
+        self.store_compression_level = 4 # zlib compression level for compressed positions
+
+        # Buffer of iteration records not yet written to the store file, keyed by variable name.
+        self._store_buffer = dict()
+
+        # Pool of threads used to propagate replicas and compute energies, created on initialization if nthreads > 1.
+        self._thread_pool = None
+
+        # True if context_pool was created by this simulation on initialization, and is to be cleared when the run ends.
+        self._owns_context_pool = False
+
+        # Background online analysis worker, created on initialization of the root node if online_analysis is True.
+        self._analysis_worker = None
+
+        # Cache of per-atom velocity standard deviations, keyed by (system, temperature).
+        self._velocity_sigmas = dict()
 
         # Set MPI communicator (or None if not used).
         self.mpicomm = mpicomm
@@ -317,6 +429,8 @@ class ReplicaExchange(object):
         # Main loop
         run_start_time = time.time()              
         run_start_iteration = self.iteration
+        self._last_iteration_time = None # wall clock time of the last iteration, used to enforce max_wall_time
+        self.termination_reason = None
         while (self.iteration < self.number_of_iterations):
             if self.verbose: print "\nIteration %d / %d" % (self.iteration+1, self.number_of_iterations)
             initial_time = time.time()
@@ -351,17 +465,62 @@ class ReplicaExchange(object):
             # Show timing statistics.
             final_time = time.time()
             elapsed_time = final_time - initial_time
+            self._last_iteration_time = elapsed_time
             estimated_time_remaining = (final_time - run_start_time) / (self.iteration - run_start_iteration) * (self.number_of_iterations - self.iteration - 1)
             estimated_finish_time = final_time + estimated_time_remaining
             if self.verbose: 
                 print "Iteration took %.3f s." % elapsed_time
                 print "Estimated completion time %s (consuming total wall clock time %s)." % (time.ctime(estimated_finish_time), str(datetime.timedelta(seconds=estimated_time_remaining)))
+
+            # Stop early if a convergence target or the wall clock budget has been reached.
+            if self.iteration < self.number_of_iterations:
+                self.termination_reason = self._check_termination(final_time - run_start_time)
+                if self.termination_reason is not None:
+                    if self.verbose: print "Stopping after iteration %d: %s" % (self.iteration, self.termination_reason)
+                    if self.ncfile is not None:
+                        setattr(self.ncfile, 'termination_reason', self.termination_reason)
+                    break
             
         # Clean up and close storage files.
         self._finalize()
 
         return
 
+    def _check_termination(self, elapsed_time):
+        """
+        Determine whether the run should stop before the next iteration.
+
+        ARGUMENTS
+
+        elapsed_time (float) - wall clock time (in seconds) since run() was called
+
+        RETURNS
+
+        reason (string) - description of the criterion that was met, or None if the run should continue
+
+        NOTES
+
+        The root node decides, using the most recent completed online analysis, and broadcasts its decision to all nodes.
+
+        """
+
+        reason = None
+        if (not self.mpicomm) or (self.mpicomm.rank == 0):
+            result = self.analysis_result
+            if (self.max_wall_time is not None) and (elapsed_time + self._last_iteration_time > self.max_wall_time):
+                reason = "wall clock budget of %.1f s would be exceeded by the next iteration" % self.max_wall_time
+            if (reason is None) and (self.target_uncertainty is not None) and (result is not None):
+                (i, j) = self.target_state_pair
+                if result['dDeltaf_ij'][i,j] < self.target_uncertainty:
+                    reason = "uncertainty of Delta f(%d,%d) is %.3f kT < %.3f kT" % (i, j, result['dDeltaf_ij'][i,j], self.target_uncertainty)
+            if (reason is None) and (self.target_effective_samples is not None) and (result is not None):
+                if result['effective_samples'] >= self.target_effective_samples:
+                    reason = "%.1f effective samples >= %.1f" % (result['effective_samples'], self.target_effective_samples)
+        if self.mpicomm:
+            reason = self.mpicomm.bcast(reason, root=0)
+
+        return reason
+
     def _initialize(self):
         """
         Initialize the simulation, and bind to a storage file.
@@ -371,6 +530,16 @@ class ReplicaExchange(object):
             print "Simulation has already been initialized."
             raise Error
 
+        # Convergence targets require online analysis.
+        if (self.target_uncertainty is not None) or (self.target_effective_samples is not None):
+            self.online_analysis = True
+
+        # Check storage intervals.
+        if (self.store_positions_interval % self.store_energies_interval) != 0:
+            raise ParameterException("store_positions_interval (%d) must be a multiple of store_energies_interval (%d)." % (self.store_positions_interval, self.store_energies_interval))
+        if (self.full_energy_interval not in [None, 1]) and ((self.full_energy_interval % self.store_energies_interval) != 0):
+            raise ParameterException("full_energy_interval (%d) must be 1 or a multiple of store_energies_interval (%d), so that full energy matrices are evaluated on stored iterations." % (self.full_energy_interval, self.store_energies_interval))
+
         # Turn off verbosity if not master node.
         if self.mpicomm:
             if self.verbose:
@@ -383,42 +552,38 @@ class ReplicaExchange(object):
 
         # Select OpenMM Platform for dynamics if none is specified.
         if self.platform is None:
-            # Find fastest platform.
-            fastest_speed = 0.0
-            fastest_platform = simtk.openmm.Platform.getPlatformByName("Reference")                        
-            for platform_index in range(simtk.openmm.Platform.getNumPlatforms()):
-                platform = simtk.openmm.Platform.getPlatform(platform_index)
-                speed = platform.getSpeed()
-                if (speed > fastest_speed):
-                    fastest_speed = speed
-                    fastest_platform = platform
-            self.platform = fastest_platform
+            self._select_platform()
 
         # Determine number of alchemical states.
         self.nstates = len(self.states)
 
-        # Create cached Context objects.
-        # NOTE: This will preclude use of platforms that do not support caching, like Cuda.
-        # TODO: Cache only if platform supports it?
-        if self.verbose: print "Creating and caching Context objects..."
-        initial_time = time.time()
+        # Assign states to MPI nodes round-robin until propagation times have been measured.
         if self.mpicomm:
-            # Create cached contexts for only the states this process will handle.
-            for state_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size):
-                state = self.states[state_index]
-                try:
-                    state._integrator = self.mm.LangevinIntegrator(state.temperature, self.collision_rate, self.timestep)
-                    state._context = self.mm.Context(state.system, state._integrator, self.platform)
-                    print "Node %d state %d: platform name %s device requested %s actual %s success" % (self.mpicomm.rank, state_index, self.platform.getName(), self.platform.getPropertyDefaultValue("OpenCLDeviceIndex"), state._context.getPlatform().getPropertyValue(state._context, "OpenCLDeviceIndex"))      
-                except Exception as e:
-                    print "Node %d state %d: platform %s device %s failure: %s" % (self.mpicomm.rank, state_index, self.platform, self.platform.getPropertyDefaultValue("OpenCLDeviceIndex"), str(e))
-            self.mpicomm.barrier()
-        else:
-            # Serial version.
-            for state in self.states:  
-                state._integrator = self.mm.LangevinIntegrator(state.temperature, self.collision_rate, self.timestep)
-                state._context = self.mm.Context(state.system, state._integrator, self.platform)
-            
+            self._state_ranks = numpy.arange(self.nstates) % self.mpicomm.size # _state_ranks[i] is the node that handles state i
+            self._state_cost_sums = numpy.zeros([self.nstates], numpy.float64) # propagation time of each state accumulated since the last rebalancing
+            self._schedule_iterations = 0 # number of iterations accumulated in _state_cost_sums
+            self._node_context_states = set() # states for which this node has created a pooled Context
+        self._replica_propagation_times = numpy.zeros([self.nstates], numpy.float64) # wall clock time of the last propagation of each replica
+
+        # Create thread pool for local concurrency.
+        if self.nthreads is None:
+            self.nthreads = self._default_thread_count()
+        if self.nthreads > 1:
+            if self.verbose: print "Using %d threads to propagate replicas and compute energies." % self.nthreads
+            self._thread_pool = multiprocessing.pool.ThreadPool(self.nthreads)
+
+        # Create a private, bounded pool of Contexts, unless one was provided.
+        self._owns_context_pool = (self.context_pool is None)
+        if self._owns_context_pool:
+            max_contexts = self.max_contexts
+            if max_contexts is None:
+                max_contexts = len(set([ id(state.system) for state in self.states ])) + self.nthreads
+            self.context_pool = contextpool.ContextPool(max_contexts=max_contexts)
+
+        # Create pooled Context objects.
+        if self.verbose: print "Creating pooled Context objects..."
+        initial_time = time.time()
+        self._create_contexts()
         final_time = time.time()
         elapsed_time = final_time - initial_time
         if self.verbose: print "%.3f s elapsed." % elapsed_time
@@ -427,27 +592,32 @@ class ReplicaExchange(object):
         self.natoms = self.states[0].system.getNumParticles()
   
         # Allocate storage.
-        self.replica_coordinates = list() # replica_coordinates[i] is the configuration currently held in replica i
-        self.replica_box_vectors = list() # replica_box_vectors[i] is the set of box vectors currently held in replica i  
+        self.replica_coordinates = numpy.zeros([self.nstates, self.natoms, 3], numpy.float64) # replica_coordinates[i,:,:] is the configuration (in nm) currently held in replica i
+        self.replica_box_vectors = numpy.zeros([self.nstates, 3, 3], numpy.float64) # replica_box_vectors[i,:,:] is the set of box vectors (in nm) currently held in replica i
         self.replica_states     = numpy.zeros([self.nstates], numpy.int32) # replica_states[i] is the state that replica i is currently at
         self.u_kl               = numpy.zeros([self.nstates, self.nstates], numpy.float32)        
+        self._energy_mask       = None # _energy_mask[i,j] is True if u_kl[i,j] is to be evaluated, or None if all entries are
+        self._energies_full     = True # True if the full energy matrix u_kl was evaluated
+        self._equilibrating     = False # True while equilibrating, when only the energies of replicas at their own states are evaluated
         self.swap_Pij_accepted  = numpy.zeros([self.nstates, self.nstates], numpy.float32)
         self.Nij_proposed       = numpy.zeros([self.nstates,self.nstates], numpy.int64) # Nij_proposed[i][j] is the number of swaps proposed between states i and j, prior of 1
         self.Nij_accepted       = numpy.zeros([self.nstates,self.nstates], numpy.int64) # Nij_proposed[i][j] is the number of swaps proposed between states i and j, prior of 1
+        self._Nij_proposed_unstored = numpy.zeros([self.nstates,self.nstates], numpy.int64) # swaps proposed since the last stored record
+        self._Nij_accepted_unstored = numpy.zeros([self.nstates,self.nstates], numpy.int64) # swaps accepted since the last stored record
+        self._Nij_proposed_total = numpy.zeros([self.nstates,self.nstates], numpy.int64) # swaps proposed over the whole simulation
+        self._Nij_accepted_total = numpy.zeros([self.nstates,self.nstates], numpy.int64) # swaps accepted over the whole simulation
+        self._Nij_transitions = numpy.zeros([self.nstates,self.nstates], numpy.float64) # symmetrized count of state transitions i -> j observed between iterations
 
         # Distribute coordinate information to replicas in a round-robin fashion.
-        self.replica_coordinates = [ copy.deepcopy(self.provided_coordinates[replica_index % len(self.provided_coordinates)]) for replica_index in range(self.nstates) ]
-        #self.replica_coordinates = [ self.provided_coordinates[replica_index % len(self.provided_coordinates)] for replica_index in range(self.nstates) ]
+        for replica_index in range(self.nstates):
+            self.replica_coordinates[replica_index,:,:] = self.provided_coordinates[replica_index % len(self.provided_coordinates)] / units.nanometers
 
         # Assign default box vectors.
-        self.replica_box_vectors = list()
-        for state in self.states:
+        for (replica_index, state) in enumerate(self.states):
             [a,b,c] = state.system.getDefaultPeriodicBoxVectors()
-            box_vectors = units.Quantity(numpy.zeros([3,3], numpy.float32), units.nanometers)
-            box_vectors[0,:] = a
-            box_vectors[1,:] = b
-            box_vectors[2,:] = c
-            self.replica_box_vectors.append(box_vectors)
+            self.replica_box_vectors[replica_index,0,:] = a / units.nanometers
+            self.replica_box_vectors[replica_index,1,:] = b / units.nanometers
+            self.replica_box_vectors[replica_index,2,:] = c / units.nanometers
         
         # Assign initial replica states.
         for replica_index in range(self.nstates):
@@ -482,21 +652,174 @@ class ReplicaExchange(object):
             # Initialize NetCDF file.
             self._initialize_netcdf()
 
-            # Store initial state.
+            # Store initial state, making sure it reaches the disk.
             self._write_iteration_netcdf()
+            self._sync_netcdf()
+
+        # Start online analysis on the root node.
+        if self.online_analysis and ((not self.mpicomm) or (self.mpicomm.rank == 0)):
+            self._start_online_analysis(resume)
 
         # Signal that the class has been initialized.
         self._initialized = True
 
         return
 
+    def _select_platform(self):
+        """
+        Select the OpenMM Platform, either by benchmarking the systems (with cached results) or from static speed estimates.
+
+        NOTES
+
+        With platform_autotune, the systems of the first and last states are benchmarked on each Platform and setting
+        of its tunable properties, and the fastest choice is cached in platform_cache_filename, if set (see platformtuning.py).
+        The selected properties are stored in platform_properties and passed to each Context this simulation creates.
+        With MPI, the root node benchmarks and all nodes use its choice.
+
+        """
+
+        if not self.platform_autotune:
+            # Find fastest platform from static speed estimates.
+            fastest_speed = 0.0
+            fastest_platform = simtk.openmm.Platform.getPlatformByName("Reference")                        
+            for platform_index in range(simtk.openmm.Platform.getNumPlatforms()):
+                platform = simtk.openmm.Platform.getPlatform(platform_index)
+                speed = platform.getSpeed()
+                if (speed > fastest_speed):
+                    fastest_speed = speed
+                    fastest_platform = platform
+            self.platform = fastest_platform
+            return
+
+        selection = None
+        if (not self.mpicomm) or (self.mpicomm.rank == 0):
+            # Benchmark the endpoint systems.
+            systems = [ self.states[0].system ]
+            if self.states[-1].system is not self.states[0].system:
+                systems.append(self.states[-1].system)
+            if self.verbose: print "Selecting fastest platform..."
+            (platform, properties) = platformtuning.select_platform(systems, self.provided_coordinates[0], cache_filename=self.platform_cache_filename, nsteps=self.platform_autotune_steps, nthreads=self.nthreads, mm=self.mm, verbose=self.verbose)
+            selection = (platform.getName(), properties)
+        if self.mpicomm:
+            selection = self.mpicomm.bcast(selection, root=0)
+
+        (platform_name, properties) = selection
+        self.platform = self.mm.Platform.getPlatformByName(platform_name)
+        self.platform_properties = properties
+
+        return
+
+    def _create_contexts(self):
+        """
+        Populate the context pool with the Contexts used to propagate the thermodynamic states handled by this node.
+
+        NOTES
+
+        States that share a System share pooled Contexts, so this creates at most one Context per distinct System.
+        Further Contexts are created on demand when several threads need the same System at once.
+
+        """
+
+        if self.mpicomm:
+            # Create pooled contexts for only the states this process will handle.
+            for state_index in self._node_state_indices():
+                self._create_state_context(state_index)
+            self.mpicomm.barrier()
+        else:
+            # Serial version.
+            for state_index in range(len(self.states)):
+                self._create_state_context(state_index)
+
+        return
+
+    def _acquire_context(self, state, integrator_type='LangevinIntegrator', timestep=None):
+        """
+        Acquire a Context for the System of the given thermodynamic state from the context pool.
+
+        ARGUMENTS
+
+        state (ThermodynamicState) - the thermodynamic state whose System and temperature are to be used
+
+        OPTIONAL ARGUMENTS
+
+        integrator_type (string) - 'LangevinIntegrator', 'VerletIntegrator', or None if any Integrator will do (default: 'LangevinIntegrator')
+        timestep (simtk.unit.Quantity with units of time) - integrator timestep, or None to use self.timestep (default: None)
+
+        RETURNS
+
+        context (simtk.openmm.Context) - the Context, which must be passed to _release_context() after use
+        integrator (simtk.openmm.Integrator) - the Integrator bound to the Context, set to the temperature of the state
+
+        """
+
+        if timestep is None: timestep = self.timestep
+        return self.context_pool.acquire(state.system, integrator_type, self.platform, temperature=state.temperature, collision_rate=self.collision_rate, timestep=timestep, mm=self.mm, properties=self.platform_properties)
+
+    def _release_context(self, context):
+        """
+        Return a Context obtained from _acquire_context() to the context pool.
+
+        """
+
+        self.context_pool.release(context)
+        return
+
+    def _create_state_context(self, state_index):
+        """
+        Create the pooled Integrator and Context used by this node to propagate the specified thermodynamic state.
+
+        ARGUMENTS
+
+        state_index (int) - the state for which a Context is to be created
+
+        """
+
+        state = self.states[state_index]
+        if not self.mpicomm:
+            [context, integrator] = self._acquire_context(state)
+            self._release_context(context)
+            return
+
+        try:
+            [context, integrator] = self._acquire_context(state)
+            self._node_context_states.add(state_index)
+            print "Node %d state %d: platform name %s device requested %s actual %s success" % (self.mpicomm.rank, state_index, self.platform.getName(), self.platform.getPropertyDefaultValue("OpenCLDeviceIndex"), context.getPlatform().getPropertyValue(context, "OpenCLDeviceIndex"))      
+            self._release_context(context)
+        except Exception as e:
+            print "Node %d state %d: platform %s device %s failure: %s" % (self.mpicomm.rank, state_index, self.platform, self.platform.getPropertyDefaultValue("OpenCLDeviceIndex"), str(e))
+
+        return
+
     def _finalize(self):
         """
         Do anything necessary to clean up.
 
         """
 
-        self.ncfile.close()
+        if self._analysis_worker is not None:
+            # Wait for any analysis in progress, and store its result.
+            self._analysis_worker.stop()
+            self._store_analysis_result()
+            self._analysis_worker = None
+
+        if self.ncfile is not None:
+            # Write out any buffered records and a final checkpoint before closing.
+            self._sync_netcdf()
+            self.ncfile.close()
+
+        if self.verbose:
+            pool = self.context_pool
+            print "Context pool: %d Contexts created, %d requests served by reused Contexts, %d Contexts evicted." % (pool.ncreated, pool.nreused, pool.nevicted)
+
+        # Destroy the Contexts of a private pool; a provided pool may be in use by others, so it is left alone.
+        if self._owns_context_pool:
+            self.context_pool.clear()
+
+        if self._thread_pool is not None:
+            # Shut down worker threads.
+            self._thread_pool.close()
+            self._thread_pool.join()
+            self._thread_pool = None
 
         return
 
@@ -534,6 +857,131 @@ class ReplicaExchange(object):
 
         return
 
+    def _default_thread_count(self):
+        """
+        Choose the number of threads to use on this node from the selected platform.
+
+        RETURNS
+
+        nthreads (int) - the number of threads to use
+
+        NOTES
+
+        The single-threaded Reference platform uses one thread per core.  The multithreaded CPU platform uses as many threads as
+        there are Contexts that fit on the cores without oversubscription.  GPU platforms use a single thread.  Under MPI, a
+        single thread is used, since the cores of a node are usually shared by several MPI processes.
+
+        """
+
+        if self.mpicomm:
+            return 1
+
+        ncpus = multiprocessing.cpu_count()
+        platform_name = self.platform.getName()
+        if platform_name == 'Reference':
+            return ncpus
+        elif platform_name == 'CPU':
+            try:
+                if self.platform_properties and ('CpuThreads' in self.platform_properties):
+                    threads_per_context = int(self.platform_properties['CpuThreads'])
+                else:
+                    threads_per_context = int(self.platform.getPropertyDefaultValue('CpuThreads'))
+            except Exception:
+                threads_per_context = ncpus
+            return max(1, ncpus // max(1, threads_per_context))
+        else:
+            return 1
+
+    def _parallel_map(self, function, items):
+        """
+        Call function(item) for each item, distributing the work over the thread pool if one is in use.
+
+        ARGUMENTS
+
+        function (callable) - function to be called for each item
+        items (list) - items to process
+
+        NOTES
+
+        Item k is always processed by the same task as items k+nthreads, k+2*nthreads, ..., so that when items are ordered by
+        thermodynamic state, each state is only ever touched by one thread at a time.  Each thread acquires its own Context
+        from the context pool, so threads never share a Context.
+        OpenMM releases the GIL during dynamics and energy evaluation, so the threads run concurrently.
+
+        """
+
+        items = list(items)
+        if (self._thread_pool is None) or (len(items) < 2):
+            for item in items:
+                function(item)
+            return
+
+        ntasks = min(self.nthreads, len(items))
+        def process_partition(partition):
+            for item in items[partition::ntasks]:
+                function(item)
+        self._thread_pool.map(process_partition, range(ntasks))
+
+        return
+
+    def _replica_configuration(self, replica_index):
+        """
+        Return the configuration of the specified replica with units attached, for use with OpenMM.
+
+        ARGUMENTS
+
+        replica_index (int) - the replica whose configuration is to be returned
+
+        RETURNS
+
+        coordinates (simtk.unit.Quantity of natoms x 3 numpy array with units of length) - coordinates of the replica
+        box_vectors (simtk.unit.Quantity of 3 x 3 numpy array with units of length) - box_vectors[i,:] is box vector i of the replica
+
+        NOTES
+
+        The returned quantities are views into the replica storage buffers, and are not copies.
+
+        """
+
+        coordinates = units.Quantity(self.replica_coordinates[replica_index,:,:], units.nanometers)
+        box_vectors = units.Quantity(self.replica_box_vectors[replica_index,:,:], units.nanometers)
+
+        return (coordinates, box_vectors)
+
+    def _set_context_configuration(self, context, replica_index):
+        """
+        Set the coordinates and box vectors of the given Context to those of the specified replica.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the Context to be updated
+        replica_index (int) - the replica whose configuration is to be used
+
+        """
+
+        (coordinates, box_vectors) = self._replica_configuration(replica_index)
+        context.setPositions(coordinates)
+        context.setPeriodicBoxVectors(box_vectors[0,:], box_vectors[1,:], box_vectors[2,:])
+
+        return
+
+    def _store_context_configuration(self, context, replica_index):
+        """
+        Store the coordinates and box vectors of the given Context as the configuration of the specified replica.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the Context holding the configuration
+        replica_index (int) - the replica whose configuration is to be updated
+
+        """
+
+        openmm_state = context.getState(getPositions=True)
+        self.replica_coordinates[replica_index,:,:] = openmm_state.getPositions(asNumpy=True) / units.nanometers
+        self.replica_box_vectors[replica_index,:,:] = openmm_state.getPeriodicBoxVectors(asNumpy=True) / units.nanometers
+
+        return
+
     def _propagate_replica(self, replica_index):
         """
         Propagate the replica corresponding to the specified replica index.
@@ -555,145 +1003,417 @@ class ReplicaExchange(object):
         state_index = self.replica_states[replica_index] # index of thermodynamic state that current replica is assigned to
         state = self.states[state_index] # thermodynamic state
 
-        # Retrieve integrator and context from thermodynamic state.
-        integrator = state._integrator
-        context = state._context
+        # Acquire integrator and context for this thermodynamic state from the pool.
+        [context, integrator] = self._acquire_context(state)
 
-        # Set coordinates.
-        coordinates = self.replica_coordinates[replica_index]            
-        context.setPositions(coordinates)
-        # Set box vectors.
-        box_vectors = self.replica_box_vectors[replica_index]
-        context.setPeriodicBoxVectors(box_vectors[0,:], box_vectors[1,:], box_vectors[2,:])
+        # Set coordinates and box vectors.
+        self._set_context_configuration(context, replica_index)
         # Assign Maxwell-Boltzmann velocities.
-        velocities = self._assign_Maxwell_Boltzmann_velocities(state.system, state.temperature)
-        context.setVelocities(velocities)
+        self._assign_velocities(context, state)
         # Run dynamics.
         start_time = time.time() # DEBUG
         integrator.step(self.nsteps_per_iteration)
         end_time = time.time() # DEBUG
-        # Store final coordinates.
-        openmm_state = context.getState(getPositions=True)        
-        self.replica_coordinates[replica_index] = openmm_state.getPositions(asNumpy=True)
-        # Store box vectors.
-        self.replica_box_vectors[replica_index] = openmm_state.getPeriodicBoxVectors(asNumpy=True)
+        # Store final coordinates and box vectors.
+        self._store_context_configuration(context, replica_index)
+        self._replica_propagated(replica_index, context)
+        # Return the context to the pool.
+        self._release_context(context)
 
         #end_time = time.time()
         elapsed_time = end_time - start_time
 
         return elapsed_time
 
-    def _propagate_replicas_mpi(self):
+    def _replica_propagated(self, replica_index, context):
         """
-        Propagate all replicas using MPI communicator.
+        Called after a replica has been propagated, while the Context that propagated it is still held.
 
-        It is presumed all nodes have the correct configurations in the correct replica slots, but that state indices may be unsynchronized.
+        ARGUMENTS
 
-        TODO
+        replica_index (int) - the replica that was propagated
+        context (simtk.openmm.Context) - the Context holding the final configuration of the replica
 
-        * Move synchronization of state information to mix_replicas?
-        * Broadcast from root node only?
+        NOTES
+
+        Subclasses may override this to extract additional information from the Context.
 
         """
 
-        # Propagate all replicas.
-        if self.verbose: print "Propagating all replicas for %.3f ps..." % (self.nsteps_per_iteration * self.timestep / units.picoseconds)
+        return
 
-        # Run just this node's share of states.
-        if self.mpicomm.rank == 0: print "Running trajectories..."
-        start_time = time.time()
-        replica_lookup = { self.replica_states[replica_index] : replica_index for replica_index in range(self.nstates) } # replica indices corresponding to state indices
-        replica_indices = [ replica_lookup[state_index] for state_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size) ] # replica indices to propagate
-        for replica_index in replica_indices:
-            self._propagate_replica(replica_index)
-        end_time = time.time()        
-        elapsed_time = end_time - start_time
-        # Collect elapsed time.
-        node_elapsed_times = self.mpicomm.gather(elapsed_time, root=0)
-        if self.mpicomm.rank == 0:
-            node_elapsed_times = numpy.array(node_elapsed_times)
-            end_time = time.time()        
-            elapsed_time = end_time - start_time
-            barrier_wait_times = elapsed_time - node_elapsed_times
-            print "Running trajectories: elapsed time %.3f s (barrier time min %.3f s | max %.3f s | avg %.3f s)" % (elapsed_time, barrier_wait_times.min(), barrier_wait_times.max(), barrier_wait_times.mean())
-            print "Total time spent waiting for GPU: %.3f s" % (node_elapsed_times.sum())
+    def _node_replica_indices(self, rank=None):
+        """
+        Return the indices of the replicas a node is responsible for propagating this iteration.
 
-        # Send final configurations and box vectors back to all nodes.
-        if self.mpicomm.rank == 0: print "Synchronizing trajectories..."
-        start_time = time.time()
-        replica_indices_gather = self.mpicomm.allgather(replica_indices)
-        replica_coordinates_gather = self.mpicomm.allgather([ self.replica_coordinates[replica_index] for replica_index in replica_indices ])
-        replica_box_vectors_gather = self.mpicomm.allgather([ self.replica_box_vectors[replica_index] for replica_index in replica_indices ])
-        for (source, replica_indices) in enumerate(replica_indices_gather):
-            for (index, replica_index) in enumerate(replica_indices):
-                self.replica_coordinates[replica_index] = replica_coordinates_gather[source][index]
-                self.replica_box_vectors[replica_index] = replica_box_vectors_gather[source][index]
-        end_time = time.time()
-        if self.mpicomm.rank == 0: print "Synchronizing configurations and box vectors: elapsed time %.3f s" % (end_time - start_time)
+        OPTIONAL ARGUMENTS
+
+        rank (int) - the node whose replicas are to be returned, or None for this node (default: None)
+
+        RETURNS
+
+        replica_indices (list of int) - replicas currently assigned to the states handled by the node
 
-        return
-        
-    def _propagate_replicas_serial(self):        
         """
-        Propagate all replicas using serial execution.
 
+        replica_lookup = { self.replica_states[replica_index] : replica_index for replica_index in range(self.nstates) } # replica indices corresponding to state indices
+        replica_indices = [ replica_lookup[state_index] for state_index in self._node_state_indices(rank) ]
+
+        return replica_indices
+
+    def _node_state_indices(self, rank=None):
         """
+        Return the indices of the thermodynamic states handled by the specified MPI node.
 
-        # Propagate all replicas.
-        if self.verbose: print "Propagating all replicas for %.3f ps..." % (self.nsteps_per_iteration * self.timestep / units.picoseconds)
-        for replica_index in range(self.nstates):
-            self._propagate_replica(replica_index)
+        OPTIONAL ARGUMENTS
 
-        return
+        rank (int) - the node whose states are to be returned, or None for this node (default: None)
+
+        RETURNS
+
+        state_indices (list of int) - states handled by the node
 
-    def _propagate_replicas(self):
         """
-        Propagate all replicas.
 
-        TODO
+        if rank is None:
+            rank = self.mpicomm.rank
 
-        * Report on efficiency of dyanmics (fraction of time wasted to overhead).
+        return [ int(state_index) for state_index in numpy.where(self._state_ranks == rank)[0] ]
 
+    def _broadcast_replica_states(self):
         """
-        start_time = time.time()
+        Broadcast the replica state assignments from the root node to all nodes in place, using a buffer-based collective.
 
-        if self.mpicomm:
-            self._propagate_replicas_mpi()
-        else:
-            self._propagate_replicas_serial()
+        """
 
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        time_per_replica = elapsed_time / float(self.nstates)
-        ns_per_day = self.timestep * self.nsteps_per_iteration / time_per_replica * 24*60*60 / units.nanoseconds
-        if self.verbose: print "Time to propagate all replicas: %.3f s (%.3f per replica, %.3f ns/day)." % (elapsed_time, time_per_replica, ns_per_day)
+        from mpi4py import MPI
+        self.mpicomm.Bcast([self.replica_states, MPI.INT], root=0)
 
         return
 
-    def _minimize_replica(self, replica_index):
+    def _exchange_rows(self, array, rank_indices, root=None):
         """
-        Minimize the specified replica.
+        Exchange rows of an array computed by different MPI nodes using buffer-based collectives, without pickling.
 
-        """
-        # Retrieve thermodynamic state.
+        ARGUMENTS
+
+        array (numpy array) - array whose rows (first index) are to be exchanged; updated in place, and may be a view (e.g. a transpose)
+        rank_indices (list of lists of int) - rank_indices[rank] are the rows of 'array' computed by node 'rank', known to all nodes
+
+        OPTIONAL ARGUMENTS
+
+        root (int) - if not None, rows are only gathered on this node; otherwise they are gathered on all nodes (default: None)
+
+        NOTES
+
+        Rows are transmitted as float64, so integer arrays must fit exactly in double precision.
+
+        """
+
+        from mpi4py import MPI
+
+        row_shape = list(array.shape[1:])
+        row_size = int(numpy.prod(row_shape))
+        counts = [ len(indices) * row_size for indices in rank_indices ]
+        displacements = [ sum(counts[0:rank]) for rank in range(len(counts)) ]
+        sendbuf = numpy.ascontiguousarray(array[rank_indices[self.mpicomm.rank]], numpy.float64)
+
+        if root is None:
+            recvbuf = numpy.empty([sum(counts)], numpy.float64)
+            self.mpicomm.Allgatherv([sendbuf, MPI.DOUBLE], [recvbuf, (counts, displacements), MPI.DOUBLE])
+        elif self.mpicomm.rank == root:
+            recvbuf = numpy.empty([sum(counts)], numpy.float64)
+            self.mpicomm.Gatherv([sendbuf, MPI.DOUBLE], [recvbuf, (counts, displacements), MPI.DOUBLE], root=root)
+        else:
+            self.mpicomm.Gatherv([sendbuf, MPI.DOUBLE], None, root=root)
+            return
+
+        rows = [ row for indices in rank_indices for row in indices ]
+        array[rows] = recvbuf.reshape([len(rows)] + row_shape)
+
+        return
+
+    def _timed_propagate_replica(self, replica_index):
+        """
+        Propagate the specified replica, recording the wall clock time taken.
+
+        ARGUMENTS
+
+        replica_index (int) - the replica to propagate
+
+        """
+
+        start_time = time.time()
+        self._propagate_replica(replica_index)
+        self._replica_propagation_times[replica_index] = time.time() - start_time
+
+        return
+
+    def _accumulate_state_costs(self, rank_replica_indices):
+        """
+        Share the propagation times measured by each node and accumulate them per thermodynamic state.
+
+        ARGUMENTS
+
+        rank_replica_indices (list of lists of int) - rank_replica_indices[rank] are the replicas propagated by node 'rank' this iteration
+
+        """
+
+        self._exchange_rows(self._replica_propagation_times, rank_replica_indices)
+        self._state_cost_sums[self.replica_states] += self._replica_propagation_times
+        self._schedule_iterations += 1
+
+        return
+
+    def _schedule_states(self, costs):
+        """
+        Assign states to MPI nodes to balance the estimated propagation cost, using the longest-processing-time-first greedy rule.
+
+        ARGUMENTS
+
+        costs (numpy array of float) - costs[i] is the estimated propagation time of state i
+
+        RETURNS
+
+        state_ranks (numpy array of int) - state_ranks[i] is the node assigned to state i
+        loads (numpy array of float) - loads[rank] is the estimated total cost assigned to node 'rank'
+
+        """
+
+        state_ranks = numpy.zeros([self.nstates], numpy.int32)
+        loads = numpy.zeros([self.mpicomm.size], numpy.float64)
+        for state_index in numpy.argsort(-costs, kind='mergesort'):
+            rank = numpy.argmin(loads)
+            state_ranks[state_index] = rank
+            loads[rank] += costs[state_index]
+
+        return (state_ranks, loads)
+
+    def _rebalance_states(self):
+        """
+        Reassign states to MPI nodes from measured propagation times, if enough iterations have been measured and the
+        estimated iteration time improves appreciably.
+
+        Contexts are created lazily in the context pool on each node only for states it has not handled before.
+        All nodes hold identical cost statistics, so they arrive at the same assignment without further communication.
+
+        """
+
+        MIN_IMPROVEMENT = 0.05 # minimum fractional reduction in estimated iteration time required to change the assignment
+
+        if (self.mpi_rebalance_interval is None) or (self._schedule_iterations < self.mpi_rebalance_interval):
+            return
+
+        # Estimate the cost of each state from the average measured propagation time.
+        costs = self._state_cost_sums / float(self._schedule_iterations)
+        self._state_cost_sums[:] = 0.0
+        self._schedule_iterations = 0
+
+        # Compare the estimated iteration time of the balanced and current assignments.
+        (state_ranks, loads) = self._schedule_states(costs)
+        current_loads = numpy.bincount(self._state_ranks, weights=costs, minlength=self.mpicomm.size)
+        if loads.max() > (1.0 - MIN_IMPROVEMENT) * current_loads.max():
+            return
+
+        if self.verbose: print "Rebalancing states among nodes: estimated time per iteration %.3f s -> %.3f s" % (current_loads.max(), loads.max())
+        self._state_ranks = state_ranks
+
+        # Create contexts for states this node has not handled before.
+        for state_index in self._node_state_indices():
+            if state_index not in self._node_context_states:
+                self._create_state_context(state_index)
+
+        return
+
+    def _propagate_replicas_mpi(self):
+        """
+        Propagate all replicas using MPI communicator.
+
+        It is presumed all nodes have the correct configurations in the correct replica slots, but that state indices may be unsynchronized.
+
+        TODO
+
+        * Move synchronization of state information to mix_replicas?
+        * Broadcast from root node only?
+
+        """
+
+        # Propagate all replicas.
+        if self.verbose: print "Propagating all replicas for %.3f ps..." % (self.nsteps_per_iteration * self.timestep / units.picoseconds)
+
+        # Reassign states to nodes based on measured propagation times.
+        self._rebalance_states()
+
+        # Run just this node's share of states.
+        if self.mpicomm.rank == 0: print "Running trajectories..."
+        start_time = time.time()
+        replica_indices = self._node_replica_indices() # replica indices to propagate
+        self._parallel_map(self._timed_propagate_replica, replica_indices)
+        end_time = time.time()        
+        elapsed_time = end_time - start_time
+        # Collect elapsed time.
+        node_elapsed_times = self.mpicomm.gather(elapsed_time, root=0)
+        if self.mpicomm.rank == 0:
+            node_elapsed_times = numpy.array(node_elapsed_times)
+            end_time = time.time()        
+            elapsed_time = end_time - start_time
+            barrier_wait_times = elapsed_time - node_elapsed_times
+            print "Running trajectories: elapsed time %.3f s (barrier time min %.3f s | max %.3f s | avg %.3f s)" % (elapsed_time, barrier_wait_times.min(), barrier_wait_times.max(), barrier_wait_times.mean())
+            print "Total time spent waiting for GPU: %.3f s" % (node_elapsed_times.sum())
+
+        # Send final configurations and box vectors back to all nodes (or only the root node, if other nodes do not need them).
+        if self.mpicomm.rank == 0: print "Synchronizing trajectories..."
+        start_time = time.time()
+        rank_replica_indices = [ self._node_replica_indices(rank) for rank in range(self.mpicomm.size) ]
+        root = None
+        if self._nodes_own_replicas and not self.mpi_gather_all: root = 0
+        self._exchange_rows(self.replica_coordinates, rank_replica_indices, root=root)
+        self._exchange_rows(self.replica_box_vectors, rank_replica_indices, root=root)
+        end_time = time.time()
+        if self.mpicomm.rank == 0: print "Synchronizing configurations and box vectors: elapsed time %.3f s" % (end_time - start_time)
+
+        # Record propagation times for load balancing.
+        self._accumulate_state_costs(rank_replica_indices)
+
+        return
+        
+    def _propagate_replicas_serial(self):        
+        """
+        Propagate all replicas using serial execution.
+
+        """
+
+        # Propagate all replicas, ordered by the state they currently occupy.
+        if self.verbose: print "Propagating all replicas for %.3f ps..." % (self.nsteps_per_iteration * self.timestep / units.picoseconds)
+        replica_lookup = { self.replica_states[replica_index] : replica_index for replica_index in range(self.nstates) } # replica indices corresponding to state indices
+        self._parallel_map(self._propagate_replica, [ replica_lookup[state_index] for state_index in range(self.nstates) ])
+
+        return
+
+    def _propagate_replicas(self):
+        """
+        Propagate all replicas.
+
+        TODO
+
+        * Report on efficiency of dyanmics (fraction of time wasted to overhead).
+
+        """
+        start_time = time.time()
+
+        if self.mpicomm:
+            self._propagate_replicas_mpi()
+        else:
+            self._propagate_replicas_serial()
+
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        time_per_replica = elapsed_time / float(self.nstates)
+        ns_per_day = self.timestep * self.nsteps_per_iteration / time_per_replica * 24*60*60 / units.nanoseconds
+        if self.verbose: print "Time to propagate all replicas: %.3f s (%.3f per replica, %.3f ns/day)." % (elapsed_time, time_per_replica, ns_per_day)
+
+        return
+
+    def _minimize_replica(self, replica_index):
+        """
+        Minimize the specified replica.
+
+        RETURNS
+
+        elapsed_time (float) - time (in seconds) to minimize replica
+
+        """
+        # Retrieve thermodynamic state.
         state_index = self.replica_states[replica_index] # index of thermodynamic state that current replica is assigned to
         state = self.states[state_index] # thermodynamic state
-        # Create integrator and context.
-        integrator = self.mm.VerletIntegrator(self.equilibration_timestep)
-        context = self.mm.Context(state.system, integrator, self.platform)                        
-        # Set coordinates.
-        coordinates = self.replica_coordinates[replica_index]            
-        context.setPositions(coordinates)
-        # Set box vectors.
-        box_vectors = self.replica_box_vectors[replica_index]
-        context.setPeriodicBoxVectors(box_vectors[0,:], box_vectors[1,:], box_vectors[2,:])
+        # Acquire any pooled context for this state; the integrator is not used by the minimizer.
+        [context, integrator] = self._acquire_context(state, integrator_type=None, timestep=self.equilibration_timestep)
+        # Set coordinates and box vectors.
+        self._set_context_configuration(context, replica_index)
         # Minimize energy.
-        minimized_coordinates = self.mm.LocalEnergyMinimizer.minimize(context)
+        start_time = time.time()
+        self.mm.LocalEnergyMinimizer.minimize(context, self.minimize_tolerance, self.minimize_max_iterations)
+        end_time = time.time()
         # Store final coordinates
-        openmm_state = context.getState(getPositions=True)
-        self.replica_coordinates[replica_index] = openmm_state.getPositions(asNumpy=True)
-        # Clean up.
-        del integrator, context
+        self._store_context_configuration(context, replica_index)
+        # Return the context to the pool.
+        self._release_context(context)
+
+        return end_time - start_time
+
+    def _minimization_key(self, replica_index):
+        """
+        Return a key identifying the minimization problem of a replica before any dynamics, so identical problems are solved once.
+
+        ARGUMENTS
+
+        replica_index (int) - the replica
+
+        RETURNS
+
+        key (tuple) - (index of the provided coordinate set the replica started from, fingerprint of the System of its state)
+
+        NOTES
+
+        The temperature does not affect minimization, so states differing only in temperature share minimized configurations.
+        The box vectors are the defaults of the System, and so are covered by the fingerprint.
+
+        """
+
+        state = self.states[self.replica_states[replica_index]]
+        coordinate_source = replica_index % len(self.provided_coordinates)
+        return (coordinate_source, systemregistry.default_registry.fingerprint(state.system, mm=self.mm))
+
+    def _minimize_replicas(self):
+        """
+        Minimize every distinct starting configuration once, distributing the work over threads and MPI nodes.
+
+        NOTES
+
+        Replicas with the same minimization key (see _minimization_key) receive copies of the configuration minimized
+        for the first of them.  The distinct minimizations are divided among the MPI nodes round-robin, and each node
+        minimizes its share concurrently on its thread pool, with a pooled Context per thread.
+
+        """
+
+        initial_time = time.time()
+
+        # Group replicas with identical minimization problems.
+        representatives = list() # representatives[i] is the replica minimized for group i
+        groups = dict() # groups[key] is the list of replicas sharing minimization key 'key'
+        for replica_index in range(self.nstates):
+            key = self._minimization_key(replica_index)
+            if key not in groups:
+                groups[key] = list()
+                representatives.append(replica_index)
+            groups[key].append(replica_index)
+        if self.verbose: print "Minimizing %d distinct configurations for %d replicas..." % (len(representatives), self.nstates)
+
+        # Minimize this node's share of the distinct configurations.
+        minimization_times = numpy.zeros([self.nstates], numpy.float64)
+        def minimize(replica_index):
+            minimization_times[replica_index] = self._minimize_replica(replica_index)
+        if self.mpicomm:
+            rank_replica_indices = [ representatives[rank::self.mpicomm.size] for rank in range(self.mpicomm.size) ]
+            self._parallel_map(minimize, rank_replica_indices[self.mpicomm.rank])
+
+            # Send minimized configurations, box vectors, and timings to all nodes.
+            self._exchange_rows(self.replica_coordinates, rank_replica_indices)
+            self._exchange_rows(self.replica_box_vectors, rank_replica_indices)
+            self._exchange_rows(minimization_times, rank_replica_indices)
+        else:
+            self._parallel_map(minimize, representatives)
+
+        # Copy minimized configurations to the other replicas of each group.
+        for replica_index in representatives:
+            replica_indices = groups[self._minimization_key(replica_index)]
+            self.replica_coordinates[replica_indices,:,:] = self.replica_coordinates[replica_index,:,:]
+            self.replica_box_vectors[replica_indices,:,:] = self.replica_box_vectors[replica_index,:,:]
+            if self.verbose:
+                print "Replica %3d minimized in %8.3f s; shared with replicas %s" % (replica_index, minimization_times[replica_index], str(replica_indices))
+
+        final_time = time.time()
+        if self.verbose: print "Minimization: elapsed time %.3f s (%.3f s of minimizer time)" % (final_time - initial_time, minimization_times.sum())
 
         return
             
@@ -705,46 +1425,110 @@ class ReplicaExchange(object):
 
         # Minimize
         if self.minimize:
-            if self.verbose: print "Minimizing all replicas..."
+            self._minimize_replicas()
 
-            if self.mpicomm:
-                # MPI implementation.
-                
-                # Minimize this node's share of replicas.
-                start_time = time.time()
-                for replica_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size):
-                    print "node %d / %d : minimizing replica %d / %d" % (self.mpicomm.rank, self.mpicomm.size, replica_index, self.nstates)
-                    self._minimize_replica(replica_index)
-                end_time = time.time()
-                self.mpicomm.barrier()
-                if self.mpicomm.rank == 0: print "Running trajectories: elapsed time %.3f s" % (end_time - start_time)
-
-                # Send final configurations and box vectors back to all nodes.
-                if self.mpicomm.rank == 0: print "Synchronizing trajectories..."
-                replica_coordinates_gather = self.mpicomm.allgather(self.replica_coordinates[self.mpicomm.rank:self.nstates:self.mpicomm.size])
-                replica_box_vectors_gather = self.mpicomm.allgather(self.replica_box_vectors[self.mpicomm.rank:self.nstates:self.mpicomm.size])        
-                for replica_index in range(self.nstates):
-                    source = replica_index % self.mpicomm.size # node with trajectory data
-                    index = replica_index // self.mpicomm.size # index within trajectory batch
-                    self.replica_coordinates[replica_index] = replica_coordinates_gather[source][index]
-                    self.replica_box_vectors[replica_index] = replica_box_vectors_gather[source][index]
-                if self.mpicomm.rank == 0: print "Synchronizing configurations and box vectors: elapsed time %.3f s" % (end_time - start_time)
+        # Equilibrate
+        self._equilibrate()
+            
+        return
 
-            else:
-                # Serial implementation.
-                for replica_index in range(self.nstates):
-                    self._minimize_replica(replica_index)
+    def _equilibration_timestep(self, iteration):
+        """
+        Return the timestep for the specified equilibration iteration, ramped linearly from equilibration_timestep to timestep.
+
+        ARGUMENTS
+
+        iteration (int) - the equilibration iteration
+
+        RETURNS
+
+        timestep (simtk.unit.Quantity with units of time) - the timestep to use
+
+        """
+
+        nramp = min(self.equilibration_ramp_iterations, self.number_of_equilibration_iterations)
+        if iteration >= nramp:
+            return self.timestep
+        if nramp < 2:
+            return self.equilibration_timestep
+        fraction = float(iteration) / float(nramp - 1)
+        return self.equilibration_timestep + fraction * (self.timestep - self.equilibration_timestep)
+
+    def _replicas_stationary(self, u_tk):
+        """
+        Determine whether the reduced potential timeseries of all replicas are stationary.
+
+        ARGUMENTS
+
+        u_tk (numpy array) - u_tk[t,k] is the reduced potential of replica k at its state after equilibration iteration t
+
+        RETURNS
+
+        stationary (boolean) - True if the equilibrated part of every timeseries holds at least equilibration_min_samples uncorrelated samples
+
+        NOTES
+
+        The equilibration time is found with the coarse-to-fine FFT search of timeseries.detectEquilibration, as in the online analysis.
+
+        """
+
+        import timeseries
+
+        for replica_index in range(u_tk.shape[1]):
+            [t0, g, Neff_max] = timeseries.detectEquilibration(u_tk[:,replica_index], fast=True, method='fft', ngrid=20)
+            if Neff_max < self.equilibration_min_samples:
+                return False
+
+        return True
+
+    def _equilibrate(self):
+        """
+        Equilibrate all replicas without exchanges, ramping the timestep and, if requested, stopping once they are stationary.
+
+        NOTES
+
+        The timestep is ramped from equilibration_timestep to timestep over the first equilibration_ramp_iterations iterations.
+        With automatic_equilibration, the reduced potential of each replica at its own state is computed after every iteration,
+        and every equilibration_check_interval iterations after the ramp, equilibration stops if all of these timeseries are
+        stationary (see _replicas_stationary).  All nodes hold the same energies, so they reach the same decision.
+
+        """
+
+        niterations = self.number_of_equilibration_iterations
+        if niterations == 0:
+            return
 
-        # Equilibrate
         production_timestep = self.timestep
-        for iteration in range(self.number_of_equilibration_iterations):
-            if self.verbose: print "equilibration iteration %d / %d" % (iteration, self.number_of_equilibration_iterations)
+        u_tk = numpy.zeros([niterations, self.nstates], numpy.float64) # u_tk[t,k] is the reduced potential of replica k after iteration t
+        replica_indices = numpy.arange(self.nstates)
+        self._equilibrating = True
+
+        for iteration in range(niterations):
+            self.timestep = self._equilibration_timestep(iteration)
+            if self.verbose: print "equilibration iteration %d / %d (timestep %s)" % (iteration, niterations, str(self.timestep))
             if self.mpicomm:
                 self._propagate_replicas_mpi()
             else:
                 self._propagate_replicas_serial()
+            self.timestep = production_timestep
+
+            if not self.automatic_equilibration:
+                continue
+
+            # Record the reduced potential of each replica at its own state.
+            self._compute_energies()
+            u_tk[iteration,:] = self.u_kl[replica_indices, self.replica_states]
+
+            # Stop once all replicas are stationary.
+            niterations_done = iteration + 1
+            if (niterations_done > self.equilibration_ramp_iterations) and (niterations_done % self.equilibration_check_interval == 0):
+                if self._replicas_stationary(u_tk[0:niterations_done,:]):
+                    if self.verbose: print "All replicas are stationary after %d equilibration iterations." % niterations_done
+                    break
+
+        self._equilibrating = False
         self.timestep = production_timestep
-            
+
         return
 
     def _compute_energies(self):
@@ -757,26 +1541,23 @@ class ReplicaExchange(object):
         
         if self.verbose: print "Computing energies..."
 
+        # Determine which energies need to be evaluated.
+        self._plan_energy_evaluations()
+
         if self.mpicomm:
             # MPI version.
 
             # Compute energies for this node's share of states.
-            for state_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size):
-                for replica_index in range(self.nstates):
-                    self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_coordinates[replica_index], box_vectors=self.replica_box_vectors[replica_index], platform=self.platform)        
+            state_indices = self._node_state_indices()
+            self._parallel_map(self._compute_state_energies, state_indices)
 
-            # Send final energies to all nodes.
-            energies_gather = self.mpicomm.allgather(self.u_kl[:,self.mpicomm.rank:self.nstates:self.mpicomm.size])
-            for state_index in range(self.nstates):
-                source = state_index % self.mpicomm.size # node with trajectory data
-                index = state_index // self.mpicomm.size # index within trajectory batch
-                self.u_kl[:,state_index] = energies_gather[source][:,index]
+            # Send final energies to all nodes; each node computed columns of the energy matrix.
+            rank_state_indices = [ self._node_state_indices(rank) for rank in range(self.mpicomm.size) ]
+            self._exchange_rows(self.u_kl.T, rank_state_indices)
 
         else:
             # Serial version.
-            for state_index in range(self.nstates):
-                for replica_index in range(self.nstates):
-                    self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_coordinates[replica_index], box_vectors=self.replica_box_vectors[replica_index], platform=self.platform)        
+            self._parallel_map(self._compute_state_energies, range(self.nstates))
 
         end_time = time.time()
         elapsed_time = end_time - start_time
@@ -785,129 +1566,159 @@ class ReplicaExchange(object):
 
         return
 
-    def _mix_all_replicas(self):
+    def _compute_state_energies(self, state_index):
         """
-        Attempt exchanges between all replicas to enhance mixing.
+        Compute the reduced potentials of all replicas at the specified state.
 
-        TODO
+        ARGUMENTS
+
+        state_index (int) - the state at which energies are to be computed
 
-        * Adjust nswap_attempts based on how many we can afford to do and not have mixing take a substantial fraction of iteration time.
-        
         """
 
-        # Determine number of swaps to attempt to ensure thorough mixing.
-        # TODO: Replace this with analytical result computed to guarantee sufficient mixing.
-        nswap_attempts = self.nstates**5 # number of swaps to attempt (ideal, but too slow!)
-        nswap_attempts = self.nstates**3 # best compromise for pure Python?
-        
-        if self.verbose: print "Will attempt to swap all pairs of replicas, using a total of %d attempts." % nswap_attempts
+        # Determine which replicas need to be evaluated at this state.
+        if self._energy_mask is None:
+            replica_indices = numpy.arange(self.nstates)
+        else:
+            replica_indices = numpy.where(self._energy_mask[:,state_index])[0]
+            self.u_kl[:,state_index] = numpy.nan
 
-        # Attempt swaps to mix replicas.
-        for swap_attempt in range(nswap_attempts):
-            # Choose replicas to attempt to swap.
-            i = numpy.random.randint(self.nstates) # Choose replica i uniformly from set of replicas.
-            j = numpy.random.randint(self.nstates) # Choose replica j uniformly from set of replicas.
+        # Evaluate all required configurations in one batch.
+        state = self.states[state_index]
+        self.u_kl[replica_indices,state_index] = state.reduced_potential_multiple(self.replica_coordinates[replica_indices,:,:], self.replica_box_vectors[replica_indices,:,:], platform=self.platform)
 
-            # Determine which states these resplicas correspond to.
-            istate = self.replica_states[i] # state in replica slot i
-            jstate = self.replica_states[j] # state in replica slot j
+        return
 
-            # Reject swap attempt if any energies are nan.
-            if (numpy.isnan(self.u_kl[i,jstate]) or numpy.isnan(self.u_kl[j,istate]) or numpy.isnan(self.u_kl[i,istate]) or numpy.isnan(self.u_kl[j,jstate])):
-                continue
+    def _plan_energy_evaluations(self):
+        """
+        Determine which entries of the energy matrix u_kl need to be evaluated this iteration.
+        During equilibration, only the diagonal entries of each replica at its own state are evaluated.
 
-            # Compute log probability of swap.
-            log_P_accept = - (self.u_kl[i,jstate] + self.u_kl[j,istate]) + (self.u_kl[i,istate] + self.u_kl[j,jstate])
+        The full matrix is evaluated every 'full_energy_interval' iterations, and always for the 'swap-all' scheme.
+        Otherwise, each replica is only evaluated at the states the mixing scheme can propose for it: the current state for
+        'none', and the current and adjacent states for 'swap-neighbors'.  The result is stored in _energy_mask and
+        _energies_full.
 
-            #print "replica (%3d,%3d) states (%3d,%3d) energies (%8.1f,%8.1f) %8.1f -> (%8.1f,%8.1f) %8.1f : log_P_accept %8.1f" % (i,j,istate,jstate,self.u_kl[i,istate],self.u_kl[j,jstate],self.u_kl[i,istate]+self.u_kl[j,jstate],self.u_kl[i,jstate],self.u_kl[j,istate],self.u_kl[i,jstate]+self.u_kl[j,istate],log_P_accept)
+        """
 
-            # Record that this move has been proposed.
-            self.Nij_proposed[istate,jstate] += 1
-            self.Nij_proposed[jstate,istate] += 1
+        if self._equilibrating:
+            # Only the energies of replicas at their own states are needed.
+            mask = numpy.zeros([self.nstates, self.nstates], numpy.bool_)
+            mask[numpy.arange(self.nstates), self.replica_states] = True
+            self._energy_mask = mask
+            self._energies_full = False
+            return
 
-            # Accept or reject.
-            if (log_P_accept >= 0.0 or (numpy.random.rand() < math.exp(log_P_accept))):
-                # Swap states in replica slots i and j.
-                (self.replica_states[i], self.replica_states[j]) = (self.replica_states[j], self.replica_states[i])
-                # Accumulate statistics
-                self.Nij_accepted[istate,jstate] += 1
-                self.Nij_accepted[jstate,istate] += 1
+        full = (self.full_energy_interval is None) or (self.iteration % self.full_energy_interval == 0)
+        if full or (self.replica_mixing_scheme not in ['swap-neighbors', 'none']):
+            self._energy_mask = None
+            self._energies_full = True
+            return
+
+        replica_indices = numpy.arange(self.nstates)
+        state_indices = numpy.array(self.replica_states)
+        mask = numpy.zeros([self.nstates, self.nstates], numpy.bool_)
+        mask[replica_indices, state_indices] = True
+        if self.replica_mixing_scheme == 'swap-neighbors':
+            below = (state_indices > 0)
+            mask[replica_indices[below], state_indices[below] - 1] = True
+            above = (state_indices < self.nstates - 1)
+            mask[replica_indices[above], state_indices[above] + 1] = True
+
+        self._energy_mask = mask
+        self._energies_full = False
 
         return
 
-    def _mix_all_replicas_weave(self):
+    def _mix_all_replicas(self):
         """
         Attempt exchanges between all replicas to enhance mixing.
-        Acceleration by 'weave' from scipy is used to speed up mixing by ~ 400x.
-        
+
+        NOTES
+
+        Swaps are attempted in sweeps.  Each sweep pairs up the replicas according to a random permutation and attempts a swap
+        within each of the nstates/2 disjoint pairs.  Because the pairs of a sweep share no replicas, their Metropolis tests are
+        independent and are carried out together with vectorized operations; a sweep is therefore equivalent to nstates/2 sequential
+        attempts among uniformly chosen pairs of distinct replicas, and each sweep satisfies detailed balance.
+
+        A fixed number of sweeps is performed, making at least 'nswap_attempts' attempts, so the random number stream does not
+        depend on timing and runs are reproducible.  The default of nstates**3 attempts replaces the nstates**5 of the original
+        weave code, which takes minutes per iteration for 40 states without compiled code.  When every swap is accepted, random
+        transpositions mix a permutation of nstates replicas in about (1/2) nstates ln(nstates) attempts (Diaconis and Shahshahani,
+        1981), so nstates**3 attempts leave a margin of 2 nstates**2 / ln(nstates) for rejected swaps.
+
         """
 
+        # Nothing to do unless there are at least two replicas.
+        if self.nstates < 2:
+            return
+
         # Determine number of swaps to attempt to ensure thorough mixing.
-        # TODO: Replace this with analytical result computed to guarantee sufficient mixing.
-        nswap_attempts = self.nstates**5 # number of swaps to attempt (ideal, but too slow!)
-        # Handled in C code below.
-        
-        if self.verbose: print "Will attempt to swap all pairs of replicas using weave-accelerated code, using a total of %d attempts." % nswap_attempts
-
-        from scipy import weave
-
-        # TODO: Replace drand48 with numpy random generator.
-        code = """
-        // Determine number of swap attempts.
-        // TODO: Replace this with analytical result computed to guarantee sufficient mixing.        
-        long nswap_attempts = nstates*nstates*nstates*nstates*nstates; // K**5
-        //long nswap_attempts = nstates*nstates*nstates; // K**3
-        //long nswap_attempts = nstates*nstates*nstates*nstates; // K**4
-
-        // Attempt swaps.
-        for(long swap_attempt = 0; swap_attempt < nswap_attempts; swap_attempt++) {
-            // Choose replicas to attempt to swap.
-            int i = (long)(drand48() * nstates); 
-            int j = (long)(drand48() * nstates);
-
-            // Determine which states these resplicas correspond to.            
-            int istate = REPLICA_STATES1(i); // state in replica slot i
-            int jstate = REPLICA_STATES1(j); // state in replica slot j
-
-            // Reject swap attempt if any energies are nan.
-            if ((std::isnan(U_KL2(i,jstate)) || std::isnan(U_KL2(j,istate)) || std::isnan(U_KL2(i,istate)) || std::isnan(U_KL2(j,jstate))))
-               continue;
-
-            // Compute log probability of swap.
-            double log_P_accept = - (U_KL2(i,jstate) + U_KL2(j,istate)) + (U_KL2(i,istate) + U_KL2(j,jstate));
-
-            // Record that this move has been proposed.
-            NIJ_PROPOSED2(istate,jstate) += 1;
-            NIJ_PROPOSED2(jstate,istate) += 1;
-
-            // Accept or reject.
-            if (log_P_accept >= 0.0 || (drand48() < exp(log_P_accept))) {
-                // Swap states in replica slots i and j.
-                int tmp = REPLICA_STATES1(i);
-                REPLICA_STATES1(i) = REPLICA_STATES1(j);
-                REPLICA_STATES1(j) = tmp;
-                // Accumulate statistics
-                NIJ_ACCEPTED2(istate,jstate) += 1;
-                NIJ_ACCEPTED2(jstate,istate) += 1;
-            }
-
-        }
-        """
-
-        # Stage input temporarily.
+        nswap_attempts = self.nswap_attempts
+        if nswap_attempts is None:
+            nswap_attempts = self.nstates**3 # number of swaps to attempt
+        npairs = self.nstates // 2 # number of disjoint pairs per sweep
+        nsweeps = max(1, int(math.ceil(float(nswap_attempts) / float(npairs)))) # number of sweeps needed to reach nswap_attempts
+
+        if self.verbose: print "Will attempt to swap all pairs of replicas, using %d attempts in sweeps of %d disjoint pairs." % (nsweeps * npairs, npairs)
+
+        # Stage data locally.
         nstates = self.nstates
         replica_states = self.replica_states
         u_kl = self.u_kl
-        Nij_proposed = self.Nij_proposed
-        Nij_accepted = self.Nij_accepted
-
-        # Execute inline C code with weave.
-        info = weave.inline(code, ['nstates', 'replica_states', 'u_kl', 'Nij_proposed', 'Nij_accepted'], headers=['<math.h>', '<stdlib.h>'], verbose=2)
-
-        # Store results.
-        self.replica_states = replica_states
-        self.Nij_proposed = Nij_proposed
-        self.Nij_accepted = Nij_accepted
+        Nij_proposed = numpy.zeros([nstates*nstates], numpy.int64)
+        Nij_accepted = numpy.zeros([nstates*nstates], numpy.int64)
+
+        # Attempt swaps in blocks of sweeps, drawing random numbers for each block at once.
+        nsweeps_per_block = 1000
+        sweep = 0
+        while (sweep < nsweeps):
+            nblock = min(nsweeps_per_block, nsweeps - sweep)
+
+            # Choose random pairings of replicas and the log uniform variates for the acceptance tests.
+            permutations = numpy.argsort(numpy.random.random([nblock, nstates]), axis=1)
+            log_uniform = numpy.log(numpy.random.random([nblock, npairs]))
+
+            proposed_pairs = list()
+            accepted_pairs = list()
+            for block_index in range(nblock):
+                # Choose replicas to attempt to swap.
+                i = permutations[block_index,0:2*npairs:2]
+                j = permutations[block_index,1:2*npairs:2]
+
+                # Determine which states these replicas correspond to.
+                istate = replica_states[i]
+                jstate = replica_states[j]
+
+                # Compute log probability of swap.
+                log_P_accept = - (u_kl[i,jstate] + u_kl[j,istate]) + (u_kl[i,istate] + u_kl[j,jstate])
+
+                # Reject swap attempts for which any energies are nan; these are not counted as proposed.
+                valid = numpy.logical_not(numpy.isnan(log_P_accept))
+                proposed_pairs.append(istate[valid] * nstates + jstate[valid])
+
+                # Accept or reject.
+                accept = valid & (log_uniform[block_index,:] < log_P_accept)
+                if accept.any():
+                    # Swap states in replica slots i and j.
+                    replica_states[i[accept]] = jstate[accept]
+                    replica_states[j[accept]] = istate[accept]
+                    accepted_pairs.append(istate[accept] * nstates + jstate[accept])
+
+            # Accumulate statistics.
+            Nij_proposed += numpy.bincount(numpy.concatenate(proposed_pairs), minlength=nstates*nstates)
+            if len(accepted_pairs) > 0:
+                Nij_accepted += numpy.bincount(numpy.concatenate(accepted_pairs), minlength=nstates*nstates)
+
+            sweep += nblock
+
+        # Record symmetrized statistics.
+        Nij_proposed = Nij_proposed.reshape([nstates, nstates])
+        Nij_accepted = Nij_accepted.reshape([nstates, nstates])
+        self.Nij_proposed += Nij_proposed + Nij_proposed.T
+        self.Nij_accepted += Nij_accepted + Nij_accepted.T
+
+        if self.verbose: print "Performed %d sweeps (%d attempts)." % (sweep, sweep * npairs)
 
         return
 
@@ -962,7 +1773,7 @@ class ReplicaExchange(object):
 
         if (self.mpicomm) and (self.mpicomm.rank != 0):
             # Non-root nodes receive state information.
-            self.replica_state = self.mpicomm.bcast(self.replica_states, root=0)
+            self._broadcast_replica_states()
             return
 
         if self.verbose: print "Mixing replicas..."        
@@ -971,16 +1782,15 @@ class ReplicaExchange(object):
         self.Nij_proposed[:,:] = 0
         self.Nij_accepted[:,:] = 0
 
+        # Remember states prior to mixing to accumulate transition statistics.
+        previous_replica_states = self.replica_states.copy()
+
         # Perform swap attempts according to requested scheme.
         start_time = time.time()                    
         if self.replica_mixing_scheme == 'swap-neighbors':
             self._mix_neighboring_replicas()        
         elif self.replica_mixing_scheme == 'swap-all':
-            # Try to use weave-accelerated mixing code if possible, otherwise fall back to Python-accelerated code.            
-            try:
-                self._mix_all_replicas_weave()            
-            except:
-                self._mix_all_replicas()
+            self._mix_all_replicas()
         elif self.replica_mixing_scheme == 'none':
             # Don't mix replicas.
             pass
@@ -995,24 +1805,29 @@ class ReplicaExchange(object):
         if (nswaps_attempted > 0): swap_fraction_accepted = float(nswaps_accepted) / float(nswaps_attempted);            
         if self.verbose: print "Accepted %d / %d attempted swaps (%.1f %%)" % (nswaps_accepted, nswaps_attempted, swap_fraction_accepted * 100.0)
 
+        # Update running totals of swap statistics.
+        self._Nij_accepted_total += self.Nij_accepted
+        self._Nij_proposed_total += self.Nij_proposed
+
+        # Accumulate symmetrized state transitions; each state appears once in replica_states, so no index pair is repeated.
+        self._Nij_transitions[previous_replica_states, self.replica_states] += 0.5
+        self._Nij_transitions[self.replica_states, previous_replica_states] += 0.5
+
         # Estimate cumulative transition probabilities between all states.
-        Nij_accepted = self.ncfile.variables['accepted'][:,:,:].sum(0) + self.Nij_accepted
-        Nij_proposed = self.ncfile.variables['proposed'][:,:,:].sum(0) + self.Nij_proposed
-        swap_Pij_accepted = numpy.zeros([self.nstates,self.nstates], numpy.float64)
-        for istate in range(self.nstates):
-            Ni = Nij_proposed[istate,:].sum()
-            if (Ni == 0):
-                swap_Pij_accepted[istate,istate] = 1.0
-            else:
-                swap_Pij_accepted[istate,istate] = 1.0 - float(Nij_accepted[istate,:].sum() - Nij_accepted[istate,istate]) / float(Ni)
-                for jstate in range(self.nstates):
-                    if istate != jstate:
-                        swap_Pij_accepted[istate,jstate] = float(Nij_accepted[istate,jstate]) / float(Ni)
+        Nij_accepted = self._Nij_accepted_total
+        Nij_proposed = self._Nij_proposed_total
+        Ni = Nij_proposed.sum(1)
+        self.swap_Pij_accepted = numpy.zeros([self.nstates,self.nstates], numpy.float64)
+        attempted = (Ni > 0)
+        self.swap_Pij_accepted[attempted,:] = Nij_accepted[attempted,:] / Ni[attempted,numpy.newaxis].astype(numpy.float64)
+        diagonal = numpy.arange(self.nstates)
+        self.swap_Pij_accepted[diagonal,diagonal] = 0.0
+        self.swap_Pij_accepted[diagonal,diagonal] = 1.0 - self.swap_Pij_accepted.sum(1)
 
         if self.mpicomm:
             # Root node will share state information with all replicas.
             if self.verbose: print "Sharing state information..."
-            self.replica_states = self.mpicomm.bcast(self.replica_states, root=0)
+            self._broadcast_replica_states()
 
         # Report on mixing.
         if self.verbose:
@@ -1038,17 +1853,8 @@ class ReplicaExchange(object):
         if (self.nreplicas < 2):
             return
         
-        # Compute statistics of transitions.
-        Nij = numpy.zeros([self.nstates,self.nstates], numpy.float64)
-        for iteration in range(self.iteration - 1):
-            for ireplica in range(self.nstates):
-                istate = self.ncfile.variables['states'][iteration,ireplica]
-                jstate = self.ncfile.variables['states'][iteration+1,ireplica]
-                Nij[istate,jstate] += 0.5
-                Nij[jstate,istate] += 0.5
-        Tij = numpy.zeros([self.nstates,self.nstates], numpy.float64)
-        for istate in range(self.nstates):
-            Tij[istate,:] = Nij[istate,:] / Nij[istate,:].sum()
+        # Compute statistics of transitions from running counts.
+        Tij = self._compute_transition_matrix()
 
         if self.show_mixing_statistics:
             # Print observed transition probabilities.
@@ -1068,15 +1874,59 @@ class ReplicaExchange(object):
                         print "%6s" % "",
                 print ""
 
-        # Estimate second eigenvalue and equilibration time.
-        mu = numpy.linalg.eigvals(Tij)
+        # Estimate second eigenvalue and equilibration time.
+        (mu2, tau) = self._estimate_mixing_timescale(Tij)
+        if (mu2 >= 1):
+            print "Perron eigenvalue is unity; Markov chain is decomposable."
+        else:
+            print "Perron eigenvalue is %9.5f; state equilibration timescale is ~ %.1f iterations" % (mu2, tau)
+
+        return
+
+    def _compute_transition_matrix(self):
+        """
+        Compute the cumulative symmetrized state transition matrix from the running transition counts.
+
+        RETURNS
+
+        Tij (numpy nstates x nstates array) - Tij[i,j] is the estimated probability of a transition from state i to state j in one iteration
+
+        """
+
+        Ni = self._Nij_transitions.sum(1)
+        Tij = numpy.eye(self.nstates)
+        observed = (Ni > 0)
+        Tij[observed,:] = self._Nij_transitions[observed,:] / Ni[observed,numpy.newaxis]
+
+        return Tij
+
+    def _estimate_mixing_timescale(self, Tij=None):
+        """
+        Estimate the subdominant (Perron) eigenvalue of the state transition matrix and the corresponding equilibration timescale.
+
+        OPTIONAL ARGUMENTS
+
+        Tij (numpy nstates x nstates array) - transition matrix to use; if None, it is computed from the running counts (default: None)
+
+        RETURNS
+
+        mu2 (float) - second-largest eigenvalue of the transition matrix
+        tau (float) - state equilibration timescale (in iterations), or None if the Markov chain is decomposable
+
+        """
+
+        if Tij is None:
+            Tij = self._compute_transition_matrix()
+
+        # The symmetrized transition matrix is reversible, so its eigenvalues are real.
+        mu = numpy.real(numpy.linalg.eigvals(Tij))
         mu = -numpy.sort(-mu) # sort in descending order
-        if (mu[1] >= 1):
-            print "Perron eigenvalue is unity; Markov chain is decomposable."
-        else:
-            print "Perron eigenvalue is %9.5f; state equilibration timescale is ~ %.1f iterations" % (mu[1], 1.0 / (1.0 - mu[1]))
+        mu2 = mu[1]
+        tau = None
+        if (mu2 < 1):
+            tau = 1.0 / (1.0 - mu2)
 
-        return
+        return (mu2, tau)
 
     def _initialize_netcdf(self):
         """
@@ -1086,7 +1936,7 @@ class ReplicaExchange(object):
 
         # Open NetCDF 4 file for writing.
         #ncfile = netcdf.NetCDFFile(self.store_filename, 'w', version=2)
-        ncfile = netcdf.Dataset(self.store_filename, 'w', version=2)        
+        ncfile = netcdf.Dataset(self.store_filename, 'w', format='NETCDF4')
 
         # Create dimensions.
         ncfile.createDimension('iteration', 0) # unlimited number of iterations
@@ -1101,15 +1951,24 @@ class ReplicaExchange(object):
         setattr(ncfile, 'programVersion', __version__)
         setattr(ncfile, 'Conventions', 'YANK')
         setattr(ncfile, 'ConventionVersion', '0.1')
+        setattr(ncfile, 'energies_interval', self.store_energies_interval)
+        setattr(ncfile, 'positions_interval', self.store_positions_interval)
         
         # Create variables.
-        ncvar_positions = ncfile.createVariable('positions', 'f', ('iteration','replica','atom','spatial'))
-        ncvar_states    = ncfile.createVariable('states', 'i', ('iteration','replica'))
-        ncvar_energies  = ncfile.createVariable('energies', 'f', ('iteration','replica','replica'))        
-        ncvar_proposed  = ncfile.createVariable('proposed', 'l', ('iteration','replica','replica'))
-        ncvar_accepted  = ncfile.createVariable('accepted', 'l', ('iteration','replica','replica'))                
-        ncvar_box_vectors = ncfile.createVariable('box_vectors', 'f', ('iteration','replica','spatial','spatial'))        
-        ncvar_volumes  = ncfile.createVariable('volumes', 'f', ('iteration','replica'))
+        # Positions are chunked by (iteration, replica) so that a single configuration can be read without touching others.
+        # Smaller per-iteration variables are chunked over a block of buffered iterations.
+        nblock = max(1, self.store_buffer_iterations)
+        compress_positions = self.store_positions_zlib or (self.store_positions_least_significant_digit is not None)
+        ncvar_positions = ncfile.createVariable('positions', 'f', ('iteration','replica','atom','spatial'), chunksizes=(1,1,self.natoms,3), 
+                                                zlib=compress_positions, complevel=self.store_compression_level, shuffle=compress_positions,
+                                                least_significant_digit=self.store_positions_least_significant_digit)
+        ncvar_states    = ncfile.createVariable('states', 'i', ('iteration','replica'), chunksizes=(nblock,self.nreplicas))
+        ncvar_energies  = ncfile.createVariable('energies', 'f', ('iteration','replica','replica'), chunksizes=(nblock,self.nreplicas,self.nreplicas))
+        ncvar_proposed  = ncfile.createVariable('proposed', 'l', ('iteration','replica','replica'), chunksizes=(nblock,self.nreplicas,self.nreplicas))
+        ncvar_accepted  = ncfile.createVariable('accepted', 'l', ('iteration','replica','replica'), chunksizes=(nblock,self.nreplicas,self.nreplicas))
+        ncvar_box_vectors = ncfile.createVariable('box_vectors', 'f', ('iteration','replica','spatial','spatial'), chunksizes=(nblock,self.nreplicas,3,3))
+        ncvar_volumes  = ncfile.createVariable('volumes', 'f', ('iteration','replica'), chunksizes=(nblock,self.nreplicas))
+        ncvar_energies_full = ncfile.createVariable('energies_full', 'i', ('iteration',), chunksizes=(nblock,))
         
         # Define units for variables.
         setattr(ncvar_positions, 'units', 'nm')
@@ -1119,6 +1978,7 @@ class ReplicaExchange(object):
         setattr(ncvar_accepted,  'units', 'none')                
         setattr(ncvar_box_vectors, 'units', 'nm')
         setattr(ncvar_volumes, 'units', 'nm**3')
+        setattr(ncvar_energies_full, 'units', 'none')
 
         # Define long (human-readable) names for variables.
         setattr(ncvar_positions, "long_name", "positions[iteration][replica][atom][spatial] is position of coordinate 'spatial' of atom 'atom' from replica 'replica' for iteration 'iteration'.")
@@ -1128,6 +1988,13 @@ class ReplicaExchange(object):
         setattr(ncvar_accepted,  "long_name", "accepted[iteration][i][j] is the number of proposed transitions between states i and j from iteration 'iteration-1'.")
         setattr(ncvar_box_vectors, "long_name", "box_vectors[iteration][replica][i][j] is dimension j of box vector i for replica 'replica' from iteration 'iteration-1'.")
         setattr(ncvar_volumes, "long_name", "volume[iteration][replica] is the box volume for replica 'replica' from iteration 'iteration-1'.")
+        setattr(ncvar_energies_full, "long_name", "energies_full[iteration] is 1 if all energies[iteration][replica][state] were evaluated, or 0 if only those needed for replica mixing were (the rest are NaN).")
+
+        # Positions are stored only for a subset of records.
+        setattr(ncvar_positions, 'write_interval', self.store_positions_interval // self.store_energies_interval)
+
+        # Create rolling checkpoint used for resuming.
+        self._create_checkpoint_group(ncfile)
         
         # Force sync to disk to avoid data loss.
         ncfile.sync()
@@ -1137,9 +2004,77 @@ class ReplicaExchange(object):
         
         return
     
+    def _create_checkpoint_group(self, ncfile):
+        """
+        Create the rolling checkpoint group of the store file, with both slots empty.
+
+        ARGUMENTS
+
+        ncfile (netCDF4.Dataset) - the store file, which must already have 'replica', 'atom', and 'spatial' dimensions
+
+        """
+
+        # Use two slots so that an interrupted write never destroys the last good checkpoint.
+        ncgrp_checkpoint = ncfile.createGroup('checkpoint')
+        ncgrp_checkpoint.createDimension('slot', 2)
+        ncvar_checkpoint_iteration = ncgrp_checkpoint.createVariable('iteration', 'i', ('slot',))
+        ncvar_checkpoint_positions = ncgrp_checkpoint.createVariable('positions', 'd', ('slot','replica','atom','spatial'))
+        ncvar_checkpoint_box_vectors = ncgrp_checkpoint.createVariable('box_vectors', 'd', ('slot','replica','spatial','spatial'))
+        ncvar_checkpoint_states = ncgrp_checkpoint.createVariable('states', 'i', ('slot','replica'))
+        ncvar_checkpoint_energies = ncgrp_checkpoint.createVariable('energies', 'f', ('slot','replica','replica'))
+        ncvar_checkpoint_proposed = ncgrp_checkpoint.createVariable('proposed', 'l', ('slot','replica','replica'))
+        ncvar_checkpoint_accepted = ncgrp_checkpoint.createVariable('accepted', 'l', ('slot','replica','replica'))
+        ncvar_checkpoint_transitions = ncgrp_checkpoint.createVariable('transitions', 'd', ('slot','replica','replica'))
+        self._create_checkpoint_unstored_variables(ncgrp_checkpoint)
+        rng_state = numpy.random.get_state()
+        ncgrp_checkpoint.createDimension('rng_key', len(rng_state[1]))
+        ncvar_checkpoint_rng_key = ncgrp_checkpoint.createVariable('rng_key', 'u4', ('slot','rng_key'))
+        ncvar_checkpoint_rng_position = ncgrp_checkpoint.createVariable('rng_position', 'i', ('slot',))
+        ncvar_checkpoint_rng_has_gauss = ncgrp_checkpoint.createVariable('rng_has_gauss', 'i', ('slot',))
+        ncvar_checkpoint_rng_cached_gaussian = ncgrp_checkpoint.createVariable('rng_cached_gaussian', 'd', ('slot',))
+        setattr(ncvar_checkpoint_iteration, "long_name", "iteration[slot] is the iteration stored in checkpoint slot 'slot', or -1 if the slot is empty.")
+        setattr(ncvar_checkpoint_positions, 'units', 'nm')
+        setattr(ncvar_checkpoint_box_vectors, 'units', 'nm')
+        setattr(ncvar_checkpoint_states, 'units', 'none')
+        setattr(ncvar_checkpoint_energies, 'units', 'kT')
+        setattr(ncvar_checkpoint_proposed, "long_name", "proposed[slot][i][j] is the total number of proposed transitions between states i and j up to the checkpointed iteration.")
+        setattr(ncvar_checkpoint_accepted, "long_name", "accepted[slot][i][j] is the total number of accepted transitions between states i and j up to the checkpointed iteration.")
+        setattr(ncvar_checkpoint_transitions, "long_name", "transitions[slot][i][j] is the symmetrized number of state transitions between states i and j between consecutive iterations, up to the checkpointed iteration.")
+        setattr(ncvar_checkpoint_rng_key, "long_name", "rng_key[slot] is the Mersenne Twister key of the numpy.random state of the root node.")
+        ncvar_checkpoint_iteration[:] = -1
+
+        return
+
+    def _create_checkpoint_unstored_variables(self, ncgrp_checkpoint):
+        """
+        Create the checkpoint variables holding the swap statistics accumulated since the last stored record, filled with zeros.
+
+        ARGUMENTS
+
+        ncgrp_checkpoint (netCDF4.Group) - the checkpoint group of the store file
+
+        """
+
+        ncvar_checkpoint_proposed_unstored = ncgrp_checkpoint.createVariable('proposed_unstored', 'l', ('slot','replica','replica'))
+        ncvar_checkpoint_accepted_unstored = ncgrp_checkpoint.createVariable('accepted_unstored', 'l', ('slot','replica','replica'))
+        setattr(ncvar_checkpoint_proposed_unstored, "long_name", "proposed_unstored[slot][i][j] is the number of proposed transitions between states i and j since the last stored record, up to the checkpointed iteration.")
+        setattr(ncvar_checkpoint_accepted_unstored, "long_name", "accepted_unstored[slot][i][j] is the number of accepted transitions between states i and j since the last stored record, up to the checkpointed iteration.")
+        ncvar_checkpoint_proposed_unstored[:,:,:] = 0
+        ncvar_checkpoint_accepted_unstored[:,:,:] = 0
+
+        return
+
     def _write_iteration_netcdf(self):
         """
         Write positions, states, and energies of current iteration to NetCDF file.
+
+        NOTES
+
+        A record of energies, states, box vectors, and mixing statistics is stored every 'store_energies_interval' iterations,
+        with record index iteration // store_energies_interval; mixing statistics are accumulated over the iterations since the
+        previous record.  Positions are stored only every 'store_positions_interval' iterations.
+        Records are buffered in memory and written to the store file in blocks of 'store_buffer_iterations' records.
+        The store file is flushed, checkpointed, and synced to disk every 'store_sync_interval' iterations.
         
         """
 
@@ -1147,89 +2082,333 @@ class ReplicaExchange(object):
             # Only the root node will write data.
             if self.mpicomm.rank != 0: return
 
-        # Store replica positions.
-        for replica_index in range(self.nstates):
-            coordinates = self.replica_coordinates[replica_index]
-            x = coordinates / units.nanometers
-            self.ncfile.variables['positions'][self.iteration,replica_index,:,:] = x[:,:]
-            
-        # Store box vectors and volume.
-        for replica_index in range(self.nstates):
-            state_index = self.replica_states[replica_index]
-            state = self.states[state_index]
-            box_vectors = self.replica_box_vectors[replica_index]
-            for i in range(3):
-                self.ncfile.variables['box_vectors'][self.iteration,replica_index,i,:] = (box_vectors[i] / units.nanometers)
-            volume = state._volume(box_vectors)
-            self.ncfile.variables['volumes'][self.iteration,replica_index] = volume / (units.nanometers**3)
+        # Accumulate mixing statistics since the last stored record.
+        self._Nij_proposed_unstored += self.Nij_proposed
+        self._Nij_accepted_unstored += self.Nij_accepted
 
-        # Store state information.
-        self.ncfile.variables['states'][self.iteration,:] = self.replica_states[:]
+        # Remember the most recent iteration for checkpointing.
+        self._last_written_iteration = self.iteration
 
-        # Store energies.
-        self.ncfile.variables['energies'][self.iteration,:,:] = self.u_kl[:,:]
+        if (self.iteration % self.store_energies_interval) == 0:
+            record = self.iteration // self.store_energies_interval
 
-        # Store mixing statistics.
-        # TODO: Write mixing statistics for this iteration?
-        self.ncfile.variables['proposed'][self.iteration,:,:] = self.Nij_proposed[:,:]
-        self.ncfile.variables['accepted'][self.iteration,:,:] = self.Nij_accepted[:,:]        
+            # Store replica positions.
+            if (self.iteration % self.store_positions_interval) == 0:
+                self._buffer_store_record('positions', record, self.replica_coordinates)
 
-        # Force sync to disk to avoid data loss.
+            # Store box vectors and volume.
+            self._buffer_store_record('box_vectors', record, self.replica_box_vectors)
+            self._buffer_store_record('volumes', record, numpy.linalg.det(self.replica_box_vectors))
+
+            # Store state information.
+            self._buffer_store_record('states', record, self.replica_states)
+
+            # Store energies.
+            self._buffer_store_record('energies', record, self.u_kl)
+            self._buffer_store_record('energies_full', record, int(self._energies_full))
+
+            # Store mixing statistics.
+            self._buffer_store_record('proposed', record, self._Nij_proposed_unstored)
+            self._buffer_store_record('accepted', record, self._Nij_accepted_unstored)
+            self._Nij_proposed_unstored[:,:] = 0
+            self._Nij_accepted_unstored[:,:] = 0
+
+        # Write buffered records once the buffer is full.
+        nbuffered = max([ len(records) for records in self._store_buffer.values() ] + [0]) # the buffer is empty on iterations that store no record
+        if nbuffered >= self.store_buffer_iterations:
+            self._flush_netcdf()
+
+        # Force sync to disk periodically to avoid data loss.
+        if (self.iteration + 1) % self.store_sync_interval == 0:
+            self._sync_netcdf()
+
+        return
+
+    def _buffer_store_record(self, name, record, value):
+        """
+        Buffer a copy of a record of the specified store file variable.
+
+        ARGUMENTS
+
+        name (string) - name of the NetCDF variable
+        record (int) - index of the record along the 'iteration' dimension
+        value (numpy array) - the record to be stored
+
+        NOTES
+
+        If the same record is already buffered, it is replaced.
+
+        """
+
+        records = self._store_buffer.setdefault(name, list())
+        if (len(records) > 0) and (records[-1][0] == record):
+            records.pop()
+        records.append( (record, numpy.array(value)) )
+
+        return
+
+    def _flush_netcdf(self):
+        """
+        Write all buffered records to the store file.
+
+        Runs of consecutive records are written as a single hyperslab.
+
+        """
+
+        for (name, records) in self._store_buffer.items():
+            ncvar = self.ncfile.variables[name]
+            start = 0
+            while start < len(records):
+                # Find the end of the run of consecutive records beginning at 'start'.
+                end = start + 1
+                while (end < len(records)) and (records[end][0] == records[end-1][0] + 1):
+                    end += 1
+                first_record = records[start][0]
+                ncvar[first_record:first_record+(end-start)] = numpy.array([ value for (record, value) in records[start:end] ])
+                start = end
+
+        self._store_buffer = dict()
+
+        return
+
+    def _sync_netcdf(self):
+        """
+        Write any buffered records and a checkpoint, and force the store file to be synced to disk.
+
+        """
+
+        if self.mpicomm:
+            # Only the root node holds the store file.
+            if self.mpicomm.rank != 0: return
+
+        self._flush_netcdf()
+        self._write_checkpoint_netcdf()
         self.ncfile.sync()
 
         return
 
+    def _write_checkpoint_netcdf(self):
+        """
+        Write the current replica configurations, states, energies, swap statistics, and random number generator state to the older of the two checkpoint slots.
+
+        The iteration number of the slot is written last, so that a partially written slot is never used for resuming.
+
+        """
+
+        ncgrp = self.ncfile.groups['checkpoint']
+        slot = int(numpy.argmin(ncgrp.variables['iteration'][:]))
+        ncgrp.variables['positions'][slot,:,:,:] = self.replica_coordinates
+        ncgrp.variables['box_vectors'][slot,:,:,:] = self.replica_box_vectors
+        ncgrp.variables['states'][slot,:] = self.replica_states
+        ncgrp.variables['energies'][slot,:,:] = self.u_kl
+        ncgrp.variables['proposed'][slot,:,:] = self._Nij_proposed_total
+        ncgrp.variables['accepted'][slot,:,:] = self._Nij_accepted_total
+        ncgrp.variables['transitions'][slot,:,:] = self._Nij_transitions
+        ncgrp.variables['proposed_unstored'][slot,:,:] = self._Nij_proposed_unstored
+        ncgrp.variables['accepted_unstored'][slot,:,:] = self._Nij_accepted_unstored
+        (rng_name, rng_key, rng_position, rng_has_gauss, rng_cached_gaussian) = numpy.random.get_state()
+        ncgrp.variables['rng_key'][slot,:] = rng_key
+        ncgrp.variables['rng_position'][slot] = rng_position
+        ncgrp.variables['rng_has_gauss'][slot] = rng_has_gauss
+        ncgrp.variables['rng_cached_gaussian'][slot] = rng_cached_gaussian
+        ncgrp.variables['iteration'][slot] = self._last_written_iteration
+
+        return
+
     def _resume_from_netcdf(self):
         """
-        Resume execution by reading current positions and energies from a NetCDF file.
+        Resume execution by reading current positions and energies from the most recent checkpoint in a NetCDF file.
+
+        NOTES
+
+        Only the checkpoint group is read, so the cost of resuming does not depend on the length of the stored history.
+        The numpy.random state is restored on the root node only.
+        Store files written before checkpoints were introduced are resumed from their last stored record instead.
         
         """
 
-        # Open NetCDF file for reading
+        # Open NetCDF file; the root node keeps it open for appending.
         if self.verbose: print "Reading NetCDF file '%s'..." % self.store_filename
         #ncfile = netcdf.NetCDFFile(self.store_filename, 'r') # Scientific.IO.NetCDF
-        ncfile = netcdf.Dataset(self.store_filename, 'r') # netCDF4
+        is_root = (self.mpicomm is None) or (self.mpicomm.rank == 0)
+        if is_root:
+            ncfile = netcdf.Dataset(self.store_filename, 'a') # netCDF4
+        else:
+            ncfile = netcdf.Dataset(self.store_filename, 'r') # netCDF4
         
         # TODO: Perform sanity check on file before resuming
 
+        if 'checkpoint' not in ncfile.groups:
+            self._resume_from_last_record(ncfile, is_root)
+            return
+
+        # Restore storage intervals, so that record indices remain consistent.
+        self.store_energies_interval = int(ncfile.energies_interval)
+        self.store_positions_interval = int(ncfile.positions_interval)
+
+        # Select the most recent checkpoint slot.
+        ncgrp = ncfile.groups['checkpoint']
+        checkpoint_iterations = ncgrp.variables['iteration'][:]
+        slot = int(numpy.argmax(checkpoint_iterations))
+
         # Get current dimensions.
-        self.iteration = ncfile.variables['positions'].shape[0] - 1 
-        self.nstates = ncfile.variables['positions'].shape[1]
-        self.natoms = ncfile.variables['positions'].shape[2]
+        self.iteration = int(checkpoint_iterations[slot])
+        self.nstates = ncgrp.variables['positions'].shape[1]
+        self.natoms = ncgrp.variables['positions'].shape[2]
         if self.verbose: print "iteration = %d, nstates = %d, natoms = %d" % (self.iteration, self.nstates, self.natoms)
 
         # Restore positions.
-        self.replica_coordinates = list()
-        for replica_index in range(self.nstates):
-            x = ncfile.variables['positions'][self.iteration,replica_index,:,:].astype(numpy.float64).copy()
-            coordinates = units.Quantity(x, units.nanometers)
-            self.replica_coordinates.append(coordinates)
-        
+        self.replica_coordinates = numpy.array(ncgrp.variables['positions'][slot,:,:,:], numpy.float64)
+
         # Restore box vectors.
-        self.replica_box_vectors = list()
-        for replica_index in range(self.nstates):
-            x = ncfile.variables['box_vectors'][self.iteration,replica_index,:,:].astype(numpy.float64).copy()
-            box_vectors = units.Quantity(x, units.nanometers)
-            self.replica_box_vectors.append(box_vectors)
+        self.replica_box_vectors = numpy.array(ncgrp.variables['box_vectors'][slot,:,:,:], numpy.float64)
 
         # Restore state information.
-        self.replica_states = ncfile.variables['states'][self.iteration,:].copy()
+        self.replica_states = numpy.array(ncgrp.variables['states'][slot,:], numpy.int32)
 
         # Restore energies.
-        self.u_kl = ncfile.variables['energies'][self.iteration,:,:].copy()
-        
-        # Close NetCDF file.
-        ncfile.close()        
+        self.u_kl = numpy.array(ncgrp.variables['energies'][slot,:,:], numpy.float32)
+
+        # Restore running totals of swap statistics.
+        self._Nij_proposed_total = numpy.array(ncgrp.variables['proposed'][slot,:,:], numpy.int64)
+        self._Nij_accepted_total = numpy.array(ncgrp.variables['accepted'][slot,:,:], numpy.int64)
+        self._Nij_transitions = numpy.array(ncgrp.variables['transitions'][slot,:,:], numpy.float64)
+
+        # Restore swap statistics not yet written to a stored record; checkpoints written before these were saved have none.
+        if 'proposed_unstored' in ncgrp.variables:
+            self._Nij_proposed_unstored = numpy.array(ncgrp.variables['proposed_unstored'][slot,:,:], numpy.int64)
+            self._Nij_accepted_unstored = numpy.array(ncgrp.variables['accepted_unstored'][slot,:,:], numpy.int64)
+        elif is_root:
+            self._create_checkpoint_unstored_variables(ncgrp)
+
+        if is_root:
+            # Restore random number generator state, and maintain file handle.
+            rng_key = numpy.array(ncgrp.variables['rng_key'][slot,:], numpy.uint32)
+            rng_position = int(ncgrp.variables['rng_position'][slot])
+            rng_has_gauss = int(ncgrp.variables['rng_has_gauss'][slot])
+            rng_cached_gaussian = float(ncgrp.variables['rng_cached_gaussian'][slot])
+            numpy.random.set_state(('MT19937', rng_key, rng_position, rng_has_gauss, rng_cached_gaussian))
+            self.ncfile = ncfile
+        else:
+            # Close NetCDF file.
+            ncfile.close()
+            self.ncfile = None
 
         # We will work on the next iteration.
         self.iteration += 1
+        self._last_written_iteration = self.iteration - 1
+        
+        return
+
+    def _resume_from_last_record(self, ncfile, is_root):
+        """
+        Resume execution from the last stored record of a store file written without a checkpoint group.
+
+        ARGUMENTS
+
+        ncfile (netCDF4.Dataset) - the store file, opened for appending on the root node and for reading elsewhere
+        is_root (boolean) - True on the root node, which keeps the file open and adds the storage attributes, the
+           'energies_full' variable, and the checkpoint group that later writes require
+
+        NOTES
+
+        Such store files stored positions, states, and energies every iteration.  The running swap and transition
+        statistics are reconstructed from the whole stored history, and the numpy.random state is not restored.
+
+        EXAMPLES
+
+        Build a one-record store file in the older layout by hand, and resume from it.
+
+        >>> import numpy
+        >>> import tempfile
+        >>> import netCDF4 as netcdf
+        >>> import simtk.unit as units
+        >>> import simtk.pyopenmm.extras.testsystems as testsystems
+        >>> from thermodynamics import ThermodynamicState
+        >>> [system, coordinates] = testsystems.AlanineDipeptideImplicit()
+        >>> nreplicas = 2
+        >>> states = [ ThermodynamicState(system=system, temperature=T*units.kelvin) for T in [298.0, 350.0] ]
+        >>> file = tempfile.NamedTemporaryFile()
+        >>> ncfile = netcdf.Dataset(file.name, 'w', version='NETCDF4')
+        >>> for (name, size) in [('iteration', 0), ('replica', nreplicas), ('atom', system.getNumParticles()), ('spatial', 3)]:
+        ...     dimension = ncfile.createDimension(name, size)
+        >>> for (name, type, dimensions) in [('positions', 'f', ('iteration','replica','atom','spatial')),
+        ...                                  ('box_vectors', 'f', ('iteration','replica','spatial','spatial')),
+        ...                                  ('volumes', 'f', ('iteration','replica')),
+        ...                                  ('states', 'i', ('iteration','replica')),
+        ...                                  ('energies', 'f', ('iteration','replica','replica')),
+        ...                                  ('proposed', 'l', ('iteration','replica','replica')),
+        ...                                  ('accepted', 'l', ('iteration','replica','replica'))]:
+        ...     variable = ncfile.createVariable(name, type, dimensions)
+        >>> box_vectors = numpy.array([ list(vector.value_in_unit(units.nanometers)) for vector in system.getDefaultPeriodicBoxVectors() ])
+        >>> ncfile.variables['positions'][0,:,:,:] = numpy.array([ numpy.array(coordinates.value_in_unit(units.nanometers)) ] * nreplicas)
+        >>> ncfile.variables['box_vectors'][0,:,:,:] = numpy.array([ box_vectors ] * nreplicas)
+        >>> ncfile.variables['volumes'][0,:] = numpy.linalg.det(box_vectors)
+        >>> ncfile.variables['states'][0,:] = numpy.arange(nreplicas)
+        >>> ncfile.variables['energies'][0,:,:] = numpy.zeros([nreplicas, nreplicas])
+        >>> ncfile.variables['proposed'][0,:,:] = numpy.zeros([nreplicas, nreplicas], numpy.int64)
+        >>> ncfile.variables['accepted'][0,:,:] = numpy.zeros([nreplicas, nreplicas], numpy.int64)
+        >>> ncfile.close()
+        >>> simulation = ReplicaExchange(states, coordinates, file.name) # resumes from the last stored record
+        >>> simulation.number_of_iterations = 3
+        >>> simulation.nsteps_per_iteration = 50
+        >>> simulation.run()
+        >>> 'checkpoint' in netcdf.Dataset(file.name, 'r').groups
+        True
+
+        """
+
+        if self.verbose: print "Store file has no checkpoint; resuming from its last stored record."
+
+        # Every iteration was stored.
+        self.store_energies_interval = int(getattr(ncfile, 'energies_interval', 1))
+        self.store_positions_interval = int(getattr(ncfile, 'positions_interval', self.store_energies_interval))
+
+        # Get current dimensions.
+        record = ncfile.variables['positions'].shape[0] - 1
+        self.iteration = record * self.store_energies_interval
+        self.nstates = ncfile.variables['positions'].shape[1]
+        self.natoms = ncfile.variables['positions'].shape[2]
+        if self.verbose: print "iteration = %d, nstates = %d, natoms = %d" % (self.iteration, self.nstates, self.natoms)
 
-        if (self.mpicomm is None) or (self.mpicomm.rank == 0):
-            # Reopen NetCDF file for appending, and maintain handle.
-            self.ncfile = netcdf.Dataset(self.store_filename, 'a')
+        # Restore positions, box vectors, states, and energies.
+        self.replica_coordinates = numpy.array(ncfile.variables['positions'][record,:,:,:], numpy.float64)
+        self.replica_box_vectors = numpy.array(ncfile.variables['box_vectors'][record,:,:,:], numpy.float64)
+        self.replica_states = numpy.array(ncfile.variables['states'][record,:], numpy.int32)
+        self.u_kl = numpy.array(ncfile.variables['energies'][record,:,:], numpy.float32)
+
+        # Reconstruct running totals of swap statistics from the per-iteration counts.
+        self._Nij_proposed_total = numpy.array(ncfile.variables['proposed'][0:record+1,:,:], numpy.int64).sum(0)
+        self._Nij_accepted_total = numpy.array(ncfile.variables['accepted'][0:record+1,:,:], numpy.int64).sum(0)
+
+        # Reconstruct symmetrized state transition counts from the state history.
+        states = numpy.array(ncfile.variables['states'][0:record+1,:], numpy.int64)
+        Nij = numpy.bincount((states[:-1,:] * self.nstates + states[1:,:]).ravel(), minlength=self.nstates*self.nstates)
+        Nij = numpy.array(Nij, numpy.float64).reshape([self.nstates, self.nstates])
+        self._Nij_transitions = 0.5 * (Nij + Nij.T)
+
+        if is_root:
+            # Add what later writes require, and maintain file handle.
+            setattr(ncfile, 'energies_interval', self.store_energies_interval)
+            setattr(ncfile, 'positions_interval', self.store_positions_interval)
+            setattr(ncfile.variables['positions'], 'write_interval', self.store_positions_interval // self.store_energies_interval)
+            if 'energies_full' not in ncfile.variables:
+                ncvar_energies_full = ncfile.createVariable('energies_full', 'i', ('iteration',))
+                setattr(ncvar_energies_full, 'units', 'none')
+                setattr(ncvar_energies_full, "long_name", "energies_full[iteration] is 1 if all energies[iteration][replica][state] were evaluated, or 0 if only those needed for replica mixing were (the rest are NaN).")
+                ncvar_energies_full[0:record+1] = numpy.ones([record+1], numpy.int32)
+            self._create_checkpoint_group(ncfile)
+            ncfile.sync()
+            self.ncfile = ncfile
         else:
+            # Close NetCDF file.
+            ncfile.close()
             self.ncfile = None
-        
+
+        # We will work on the next iteration.
+        self.iteration += 1
+        self._last_written_iteration = self.iteration - 1
+
         return
 
     def _show_energies(self):
@@ -1255,77 +2434,421 @@ class ReplicaExchange(object):
                 print "%10.1f" % (self.u_kl[replica_index,state_index]),
             print ""
 
-        return
+        return
+
+    def _assign_velocities(self, context, state):
+        """
+        Assign velocities drawn from the Maxwell-Boltzmann distribution at the temperature of the specified state.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the Context whose velocities are to be assigned
+        state (ThermodynamicState) - the thermodynamic state whose temperature is to be used
+
+        NOTES
+
+        If 'assign_velocities_with_context' is True, the Context draws the velocities itself.
+
+        """
+
+        if self.assign_velocities_with_context:
+            context.setVelocitiesToTemperature(state.temperature)
+        else:
+            velocities = self._assign_Maxwell_Boltzmann_velocities(state.system, state.temperature)
+            context.setVelocities(velocities)
+
+        return
+
+    def _assign_Maxwell_Boltzmann_velocities(self, system, temperature):
+        """
+        Generate Maxwell-Boltzmann velocities.
+
+        ARGUMENTS
+
+        system (simtk.openmm.System) - the system for which velocities are to be assigned
+        temperature (simtk.unit.Quantity with units temperature) - the temperature at which velocities are to be assigned
+
+        RETURN VALUES
+
+        velocities (simtk.unit.Quantity wrapping numpy array of dimension natoms x 3 with units of distance/time) - drawn from the Maxwell-Boltzmann distribution at the appropriate temperature
+
+        NOTES
+
+        The per-atom standard deviations of the velocity distribution depend only on the masses and the temperature, so they
+        are computed once for each (system, temperature) pair and cached.
+
+        """
+
+        # Retrieve the cached per-atom standard deviations of the velocity distribution, computing them if needed.
+        key = (id(system), temperature / units.kelvin)
+        if key not in self._velocity_sigmas:
+            natoms = system.getNumParticles()
+            masses = numpy.array([ system.getParticleMass(atom_index) / units.amu for atom_index in range(natoms) ], numpy.float64)
+            kT = (kB * temperature) / units.kilojoules_per_mole # thermal energy in kJ/mol
+            # Since 1 kJ/mol = 1 amu nm^2 / ps^2, sqrt(kT / mass) is in units of nm/ps.
+            # Massless particles (such as virtual sites) receive zero velocity.
+            sigmas = numpy.zeros([natoms], numpy.float64)
+            sigmas[masses > 0.0] = numpy.sqrt(kT / masses[masses > 0.0])
+            self._velocity_sigmas[key] = sigmas
+        sigmas = self._velocity_sigmas[key]
+
+        # Draw all velocity components at once.
+        velocities = units.Quantity(sigmas[:,numpy.newaxis] * numpy.random.normal(size=[sigmas.size, 3]), units.nanometer / units.picosecond) # velocities[i,k] is the kth component of the velocity of atom i
+
+        # Return velocities
+        return velocities
+
+    def _start_online_analysis(self, resume):
+        """
+        Start the background online analysis worker, seeding its energy history from the store file when resuming.
+
+        ARGUMENTS
+
+        resume (boolean) - True if the simulation was resumed from the store file
+
+        """
+
+        self._analysis_history = _AnalysisHistory(self.nstates, self.online_analysis_max_samples)
+
+        if resume:
+            # Read records up to the resumed checkpoint; records beyond it will be overwritten.
+            nrecords = min(self.ncfile.variables['energies'].shape[0], (self.iteration - 1) // self.store_energies_interval + 1)
+            if nrecords > 0:
+                energies = numpy.array(self.ncfile.variables['energies'][0:nrecords,:,:], numpy.float64)
+                states = numpy.array(self.ncfile.variables['states'][0:nrecords,:], numpy.int32)
+                if 'energies_full' in self.ncfile.variables:
+                    full = numpy.array(self.ncfile.variables['energies_full'][0:nrecords], numpy.bool_)
+                else:
+                    full = numpy.ones([nrecords], numpy.bool_)
+                for record in numpy.where(full)[0]:
+                    self._analysis_history.append(record * self.store_energies_interval, energies[record,:,:], states[record,:])
+
+        self._analysis_worker = _OnlineAnalysisWorker()
+
+        return
+
+    def _analysis(self):
+        """
+        Record the energies of this iteration for online analysis, store any completed analysis, and submit new work.
+
+        NOTES
+
+        Only iterations that are stored as records and have a fully evaluated energy matrix are used.  Every
+        'online_analysis_interval' iterations, the accumulated energies are handed to the background worker, unless it is
+        still busy with a previous submission, in which case the submission is skipped rather than waiting.  The worker
+        receives views of the history buffers rather than copies (see _AnalysisHistory).
+        Results are written to the store file by this (the main) thread.
+
+        """
+
+        if self._analysis_worker is None:
+            return
+
+        # Record energies of this iteration.
+        if ((self.iteration % self.store_energies_interval) == 0) and self._energies_full:
+            self._analysis_history.append(self.iteration, self.u_kl, self.replica_states)
+
+        # Store any completed analysis.
+        self._store_analysis_result()
+
+        # Submit accumulated energies.
+        if ((self.iteration + 1) % self.online_analysis_interval == 0) and (self._analysis_history.nsamples >= 2):
+            (iterations, energies, states) = self._analysis_history.view()
+            submitted = self._analysis_worker.submit(self.iteration, iterations, energies, states)
+            if self.verbose and not submitted: print "Online analysis is still running; skipping submission."
+
+        return
+
+    def _store_analysis_result(self):
+        """
+        Collect the most recent completed online analysis, if any, and append it to the 'online_analysis' group of the store file.
+
+        """
+
+        result = self._analysis_worker.collect()
+        if result is None:
+            return
+        self.analysis_result = result
+
+        if self.verbose:
+            print "Online analysis of iterations up to %d: Delta f = %.3f +- %.3f kT (equilibrated from iteration %d, %.1f effective samples)" % (result['iteration'], result['Deltaf_ij'][0,-1], result['dDeltaf_ij'][0,-1], result['equilibration_iteration'], result['effective_samples'])
+
+        if self.ncfile is None:
+            return
+
+        # Create the analysis group on first use, so stores created without online analysis are unaffected.
+        if 'online_analysis' not in self.ncfile.groups:
+            ncgrp = self.ncfile.createGroup('online_analysis')
+            ncgrp.createDimension('analysis', 0) # unlimited number of analyses
+            ncgrp.createVariable('iteration', 'i', ('analysis',))
+            ncgrp.createVariable('f_k', 'd', ('analysis','replica'))
+            ncgrp.createVariable('Deltaf_ij', 'd', ('analysis','replica','replica'))
+            ncgrp.createVariable('dDeltaf_ij', 'd', ('analysis','replica','replica'))
+            ncgrp.createVariable('equilibration_iteration', 'i', ('analysis',))
+            ncgrp.createVariable('statistical_inefficiency', 'd', ('analysis',))
+            ncgrp.createVariable('effective_samples', 'd', ('analysis',))
+            setattr(ncgrp.variables['iteration'], "long_name", "iteration[analysis] is the last iteration whose energies were used in analysis 'analysis'.")
+            setattr(ncgrp.variables['f_k'], "units", "kT")
+            setattr(ncgrp.variables['Deltaf_ij'], "long_name", "Deltaf_ij[analysis][i][j] is the MBAR estimate of the reduced free energy difference f_j - f_i.")
+            setattr(ncgrp.variables['dDeltaf_ij'], "long_name", "dDeltaf_ij[analysis][i][j] is the statistical uncertainty of Deltaf_ij[analysis][i][j].")
+            setattr(ncgrp.variables['equilibration_iteration'], "long_name", "equilibration_iteration[analysis] is the first iteration of the data considered equilibrated.")
+            setattr(ncgrp.variables['effective_samples'], "long_name", "effective_samples[analysis] is the number of uncorrelated samples in the equilibrated data.")
+        ncgrp = self.ncfile.groups['online_analysis']
+        index = len(ncgrp.dimensions['analysis'])
+        ncgrp.variables['iteration'][index] = result['iteration']
+        ncgrp.variables['f_k'][index,:] = result['f_k']
+        ncgrp.variables['Deltaf_ij'][index,:,:] = result['Deltaf_ij']
+        ncgrp.variables['dDeltaf_ij'][index,:,:] = result['dDeltaf_ij']
+        ncgrp.variables['equilibration_iteration'][index] = result['equilibration_iteration']
+        ncgrp.variables['statistical_inefficiency'][index] = result['statistical_inefficiency']
+        ncgrp.variables['effective_samples'][index] = result['effective_samples']
+
+        return
+
+#=============================================================================================
+# Online analysis
+#=============================================================================================
+
+class _AnalysisHistory(object):
+    """
+    Bounded history of the energies and replica states used for online analysis.
+
+    NOTES
+
+    Samples are appended to preallocated arrays, which grow by doubling up to 'max_samples'.  When the history is full,
+    every other sample is discarded and only every other subsequent sample is kept, so the retained samples stay evenly
+    spaced while memory stays bounded.  Growing and decimating allocate new arrays and appending only writes beyond the
+    current length, so views returned by view() remain valid while the online analysis worker reads them.
+
+    """
+
+    def __init__(self, nstates, max_samples, initial_capacity=64):
+        self.max_samples = max(int(max_samples), 2)
+        self.stride = 1 # only every 'stride'th appended sample is kept
+        self.nsamples = 0 # number of samples kept
+        self._noffered = 0 # number of samples offered to append()
+
+        capacity = min(initial_capacity, self.max_samples)
+        self.iterations = numpy.zeros([capacity], numpy.int64) # iterations[t] is the iteration of sample t
+        self.energies = numpy.zeros([capacity, nstates, nstates], numpy.float64) # energies[t,i,k] is the reduced potential of replica i of sample t at state k
+        self.states = numpy.zeros([capacity, nstates], numpy.int32) # states[t,i] is the state of replica i of sample t
+
+        return
+
+    def append(self, iteration, energies, states):
+        """
+        Offer the energies and replica states of an iteration to the history.
+
+        ARGUMENTS
+
+        iteration (int) - the iteration
+        energies (numpy array) - energies[i,k] is the reduced potential of replica i at state k
+        states (numpy array of int) - states[i] is the state of replica i
+
+        """
+
+        offered = self._noffered
+        self._noffered += 1
+        if (offered % self.stride) != 0:
+            return
+
+        if self.nsamples == self.max_samples:
+            # Keep every other sample, and every other sample from now on.
+            self.stride *= 2
+            self._reallocate(self.max_samples, step=2)
+            if (offered % self.stride) != 0:
+                return
+        elif self.nsamples == self.iterations.shape[0]:
+            self._reallocate(min(2 * self.nsamples, self.max_samples))
+
+        self.iterations[self.nsamples] = iteration
+        self.energies[self.nsamples,:,:] = energies
+        self.states[self.nsamples,:] = states
+        self.nsamples += 1
+
+        return
+
+    def view(self):
+        """
+        Return views of the retained samples, without copying.
+
+        RETURNS
+
+        iterations (numpy array of int) - iterations[t] is the iteration of sample t
+        energies (numpy array) - energies[t,i,k] is the reduced potential of replica i of sample t at state k
+        states (numpy array of int) - states[t,i] is the state of replica i of sample t
+
+        """
+
+        n = self.nsamples
+        return (self.iterations[0:n], self.energies[0:n,:,:], self.states[0:n,:])
+
+    def _reallocate(self, capacity, step=1):
+        # Copy every 'step'th retained sample into new arrays, leaving any views of the old arrays intact.
+        n = self.nsamples
+        m = len(range(0, n, step))
+        iterations = numpy.zeros([capacity], numpy.int64)
+        energies = numpy.zeros((capacity,) + self.energies.shape[1:], numpy.float64)
+        states = numpy.zeros((capacity,) + self.states.shape[1:], numpy.int32)
+        iterations[0:m] = self.iterations[0:n:step]
+        energies[0:m,:,:] = self.energies[0:n:step,:,:]
+        states[0:m,:] = self.states[0:n:step,:]
+        (self.iterations, self.energies, self.states) = (iterations, energies, states)
+        self.nsamples = m
+
+class _OnlineAnalysisWorker(object):
+    """
+    Background thread that estimates free energies with MBAR from the energies accumulated by a replica-exchange simulation.
+
+    NOTES
+
+    At most one submission is processed at a time.  Each analysis detects the equilibrated region of the total reduced
+    potential, subsamples it to uncorrelated samples, and runs MBAR starting from the free energies of the previous analysis.
+    The worker never touches the store file; results are collected by the simulation thread.
+
+    """
+
+    def __init__(self):
+        self.f_k = None # free energies of the previous analysis, used to warm-start MBAR
+
+        self._lock = threading.Lock()
+        self._jobs = Queue.Queue()
+        self._busy = False # True from submission until the analysis has finished
+        self._result = None # most recent result not yet collected
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+        return
+
+    def submit(self, iteration, iterations, energies, states):
+        """
+        Submit energies for analysis, unless an analysis is already in progress.
+
+        ARGUMENTS
+
+        iteration (int) - the current iteration
+        iterations (numpy array of int) - iterations[t] is the iteration of sample t
+        energies (numpy array) - energies[t,i,k] is the reduced potential of replica i of sample t at state k
+        states (numpy array of int) - states[t,i] is the state of replica i of sample t
+
+        NOTES
+
+        The arrays are not copied, so the caller must not modify them until the analysis has finished.
+
+        RETURNS
+
+        submitted (boolean) - True if the energies were submitted, False if the worker was busy
 
-    def _assign_Maxwell_Boltzmann_velocities(self, system, temperature):
         """
-        Generate Maxwell-Boltzmann velocities.
 
-        ARGUMENTS
+        self._lock.acquire()
+        try:
+            if self._busy:
+                return False
+            self._busy = True
+        finally:
+            self._lock.release()
 
-        system (simtk.openmm.System) - the system for which velocities are to be assigned
-        temperature (simtk.unit.Quantity with units temperature) - the temperature at which velocities are to be assigned
+        self._jobs.put((iteration, iterations, energies, states))
 
-        RETURN VALUES
+        return True
 
-        velocities (simtk.unit.Quantity wrapping numpy array of dimension natoms x 3 with units of distance/time) - drawn from the Maxwell-Boltzmann distribution at the appropriate temperature
+    def collect(self):
+        """
+        Return the most recent result not yet collected, or None.
 
-        TODO
+        """
+
+        self._lock.acquire()
+        try:
+            result = self._result
+            self._result = None
+        finally:
+            self._lock.release()
 
-        This could be sped up by introducing vector operations.
+        return result
 
+    def stop(self):
         """
+        Wait for any analysis in progress to finish, and stop the worker thread.
 
-        # Get number of atoms
-        natoms = system.getNumParticles()
+        """
 
-        # Create storage for velocities.        
-        velocities = units.Quantity(numpy.zeros([natoms, 3], numpy.float32), units.nanometer / units.picosecond) # velocities[i,k] is the kth component of the velocity of atom i
-  
-        # Compute thermal energy and inverse temperature from specified temperature.
-        kT = kB * temperature # thermal energy
-        beta = 1.0 / kT # inverse temperature
-  
-        # Assign velocities from the Maxwell-Boltzmann distribution.
-        for atom_index in range(natoms):
-            mass = system.getParticleMass(atom_index) # atomic mass
-            sigma = units.sqrt(kT / mass) # standard deviation of velocity distribution for each coordinate for this atom
-            for k in range(3):
-                velocities[atom_index,k] = sigma * numpy.random.normal()
+        self._jobs.put(None)
+        self._thread.join()
 
-        # Return velocities
-        return velocities
+        return
 
-    def _analysis(self):
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            try:
+                result = self._analyze(*job)
+            except Exception as e:
+                print "Online analysis failed: %s" % str(e)
+                result = None
+            self._lock.acquire()
+            try:
+                if result is not None:
+                    self._result = result
+                self._busy = False
+            finally:
+                self._lock.release()
+
+    def _analyze(self, iteration, iterations, energies, states):
         """
-        Perform online analysis each iteration.
+        Estimate free energies from the submitted energies.
 
-        UNDER CONSTRUCTION
+        RETURNS
 
-        Every iteration, this will update the estimate of the state relative free energy differences and statistical uncertainties.
-        We can additionally request further analysis.
+        result (dict) - analysis results: 'iteration', 'f_k', 'Deltaf_ij', 'dDeltaf_ij', 'equilibration_iteration',
+           'statistical_inefficiency', 'effective_samples', and 'elapsed_time'
 
         """
 
-        # First, compute optimal equilibration end and integrated autocorrelation time.
-        u_n = numpy.zeros([self.niterations], numpy.float64)
-        for iteration in range(self.niterations):
-            state_indices = self.replica_states[iteration,:] 
-            u_n[iteration] = self.u_kln[:,state_indices,iteration].sum()
         import timeseries
-        [equilibration_end, g, indices] = timeseries.automatedEquilibrationDetection(u_n)
-
-        # Next, analyze with pymbar, initializing with last estimate of free energies.
         import pymbar
-        if hasattr(self, 'f_k'):
-            mbar = pymbar.MBAR(u_kln, N_k, f_k_initial=self.f_k)
-        else:
-            mbar = pymbar.MBAR(u_kln, N_k)            
-
-        # Store free energies.
-        self.f_k = mbar.f_k
 
-        return
+        initial_time = time.time()
+        [nsamples, nreplicas, nstates] = energies.shape
+
+        # Total reduced potential of all replicas at their current states.
+        u_n = energies[numpy.arange(nsamples)[:,numpy.newaxis], numpy.arange(nreplicas)[numpy.newaxis,:], states].sum(axis=1)
+
+        # Discard the initial transient and subsample to uncorrelated samples.
+        [t0, g, Neff_max] = timeseries.detectEquilibration(u_n, fast=True, method='fft', ngrid=20)
+        indices = t0 + numpy.array(timeseries.subsampleCorrelatedData(u_n[t0:], g=g), numpy.int64)
+        N = len(indices)
+
+        # Deconvolute replicas: u_kln[k,l,n] is the reduced potential of the configuration sampled at state k in sample n, evaluated at state l.
+        u_nkl = numpy.zeros([N, nstates, nstates], numpy.float64)
+        u_nkl[numpy.arange(N)[:,numpy.newaxis], states[indices,:], :] = energies[indices,:,:]
+        u_kln = numpy.ascontiguousarray(u_nkl.transpose(1,2,0))
+        N_k = N * numpy.ones([nstates], numpy.int32)
+
+        # Warm-start MBAR from the previous estimate (passed as a list, since pymbar compares initial_f_k with None).
+        initial_f_k = None
+        if (self.f_k is not None) and (self.f_k.size == nstates):
+            initial_f_k = list(self.f_k)
+        mbar = pymbar.MBAR(u_kln, N_k, initial_f_k=initial_f_k, verbose=False)
+        (Deltaf_ij, dDeltaf_ij) = mbar.getFreeEnergyDifferences()
+        self.f_k = numpy.array(mbar.f_k)
+
+        result = dict()
+        result['iteration'] = iteration
+        result['f_k'] = numpy.array(mbar.f_k)
+        result['Deltaf_ij'] = numpy.array(Deltaf_ij)
+        result['dDeltaf_ij'] = numpy.array(dDeltaf_ij)
+        result['equilibration_iteration'] = int(iterations[t0])
+        result['statistical_inefficiency'] = float(g)
+        result['effective_samples'] = float(Neff_max)
+        result['elapsed_time'] = time.time() - initial_time
+
+        return result
 
 #=============================================================================================
 # Parallel tempering
@@ -1391,7 +2914,7 @@ class ParallelTempering(ReplicaExchange):
 
     """
 
-    def __init__(self, system, coordinates, store_filename, protocol=None, Tmin=None, Tmax=None, ntemps=None, temperatures=None, pressure=None, mm=None, mpicomm=None):
+    def __init__(self, system, coordinates, store_filename, protocol=None, Tmin=None, Tmax=None, ntemps=None, temperatures=None, pressure=None, mm=None, mpicomm=None, share_systems=False):
         """
         Initialize a parallel tempering simulation object.
 
@@ -1408,6 +2931,7 @@ class ParallelTempering(ReplicaExchange):
         pressure (simtk.unit.Quantity with units of pressure) - if specified, a MonteCarloBarostat will be added (or modified) to perform NPT simulations
         protocol (dict) - Optional protocol to use for specifying simulation protocol as a dict.  Provided keywords will be matched to object variables to replace defaults. (default: None)
         mpicomm (mpi4py communicator) - MPI communicator, if parallel execution is desired (default: None)
+        share_systems (boolean) - if True, all states share one instance of the System instead of private copies; 'system' must then not be modified (default: False)
 
         NOTES
 
@@ -1428,7 +2952,7 @@ class ParallelTempering(ReplicaExchange):
         else:
             raise ValueError("Either 'temperatures' or 'Tmin', 'Tmax', and 'ntemps' must be provided.")
         
-        states = [ ThermodynamicState(system=system, temperature=self.temperatures[i], pressure=pressure) for i in range(ntemps) ]
+        states = [ ThermodynamicState(system=system, temperature=self.temperatures[i], pressure=pressure, share_system=share_systems) for i in range(ntemps) ]
 
         # Initialize replica-exchange simlulation.
         ReplicaExchange.__init__(self, states, coordinates, store_filename, protocol=protocol, mm=mm, mpicomm=mpicomm)
@@ -1474,27 +2998,16 @@ class ParallelTempering(ReplicaExchange):
             # MPI version.
 
             # Compute potential energies for this node's share of states.
-            replica_lookup = { self.replica_states[replica_index] : replica_index for replica_index in range(self.nstates) } # replica indices corresponding to state indices
-            replica_indices = [ replica_lookup[state_index] for state_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size) ] # replica indices to propagate
-            for replica_index in replica_indices:
-                state_index = self.replica_states[replica_index]
-                self.potential_energies[replica_index] = self.states[state_index].kT * self.states[state_index].reduced_potential(self.replica_coordinates[replica_index], box_vectors=self.replica_box_vectors[replica_index], platform=self.platform)        
+            self._compute_replica_potential_energies(self._node_replica_indices())
 
             # Send final energies to all nodes.
-            potential_energies_gather = self.mpicomm.allgather(self.potential_energies[replica_indices])
-            for state_index in range(self.nstates):
-                source = state_index % self.mpicomm.size # node with trajectory data
-                index = state_index // self.mpicomm.size # index within trajectory batch
-                replica_index = replica_lookup[state_index]
-                self.potential_energies[replica_index] = potential_energies_gather[source][index]
+            self._gather_potential_energies()
 
         else:
             # Serial version.
 
             # Compute potential energies for all replicas.
-            for replica_index in range(self.nstates):
-                state_index = self.replica_states[replica_index]
-                self.potential_energies[replica_index] = self.states[state_index].kT * self.states[state_index].reduced_potential(self.replica_coordinates[replica_index], box_vectors=self.replica_box_vectors[replica_index], platform=self.platform)        
+            self._compute_replica_potential_energies(range(self.nstates))
 
         end_time = time.time()
         elapsed_time = end_time - start_time
@@ -1503,18 +3016,41 @@ class ParallelTempering(ReplicaExchange):
                 
         return
 
-    def _propagate_replica(self, replica_index):
+    def _compute_replica_potential_energies(self, replica_indices):
         """
-        Store replica energy after each propagation.
+        Compute the potential energies of the specified replicas in one batch.
+
+        ARGUMENTS
+
+        replica_indices (list of int) - the replicas whose potential energies are to be computed
+
+        NOTES
+
+        All states share the same System and pressure and differ only in temperature, so kT * u(x) is the same for every state.
+        The state of the first replica is used to evaluate all replicas, with a Context acquired from the context pool.
+
+        """
+
+        replica_indices = list(replica_indices)
+        if len(replica_indices) == 0:
+            return
+
+        state = self.states[self.replica_states[replica_indices[0]]]
+        reduced_potentials = state.reduced_potential_multiple(self.replica_coordinates[replica_indices,:,:], self.replica_box_vectors[replica_indices,:,:], platform=self.platform)
+        kT = state.kT / units.kilojoules_per_mole
+        for (index, replica_index) in enumerate(replica_indices):
+            self.potential_energies[replica_index] = kT * reduced_potentials[index] * units.kilojoules_per_mole
+
+        return
 
+    def _replica_propagated(self, replica_index, context):
         """
+        Store replica energy after each propagation.
 
-        # Propagate replica as usual.
-        ReplicaExchange._propagate_replica(self, replica_index)
+        """
 
         # Compute potential energy.        
-        state_index = self.replica_states[replica_index]
-        openmm_state = self.states[state_index]._context.getState(getEnergy=True)
+        openmm_state = context.getState(getEnergy=True)
         self.potential_energies[replica_index] = openmm_state.getPotentialEnergy()
         
         return
@@ -1529,14 +3065,20 @@ class ParallelTempering(ReplicaExchange):
         
         if self.mpicomm:
             # Collect final potential energies from nodes that have computed them.
-            replica_lookup = { self.replica_states[replica_index] : replica_index for replica_index in range(self.nstates) } # replica indices corresponding to state indices
-            replica_indices = [ replica_lookup[state_index] for state_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size) ] # replica indices to propagate
-            potential_energies_gather = self.mpicomm.allgather(self.potential_energies[replica_indices])
-            for state_index in range(self.nstates):
-                source = state_index % self.mpicomm.size # node with trajectory data
-                index = state_index // self.mpicomm.size # index within trajectory batch
-                replica_index = replica_lookup[state_index]
-                self.potential_energies[replica_index] = potential_energies_gather[source][index]
+            self._gather_potential_energies()
+
+        return
+
+    def _gather_potential_energies(self):
+        """
+        Share the potential energies of the replicas handled by each node with all nodes.
+
+        """
+
+        rank_replica_indices = [ self._node_replica_indices(rank) for rank in range(self.mpicomm.size) ]
+        potential_energies = numpy.array(self.potential_energies / units.kilocalories_per_mole, numpy.float64)
+        self._exchange_rows(potential_energies, rank_replica_indices)
+        self.potential_energies = units.Quantity(potential_energies, units.kilocalories_per_mole)
 
         return
 
@@ -1607,7 +3149,7 @@ class HamiltonianExchange(ReplicaExchange):
     
     """
 
-    def __init__(self, reference_state, systems, coordinates, store_filename, protocol=None, mm=None, mpicomm=None):
+    def __init__(self, reference_state, systems, coordinates, store_filename, protocol=None, mm=None, mpicomm=None, share_systems=False):
         """
         Initialize a Hamiltonian exchange simulation object.
 
@@ -1622,13 +3164,15 @@ class HamiltonianExchange(ReplicaExchange):
 
         protocol (dict) - Optional protocol to use for specifying simulation protocol as a dict. Provided keywords will be matched to object variables to replace defaults.
         mpicomm (mpi4py communicator) - MPI communicator, if parallel execution is desired (default: None)        
+        share_systems (boolean) - if True, structurally identical systems share one instance instead of private copies; the
+           provided systems must then not be modified (default: False)
 
         """
         # Create thermodynamic states from systems.        
         states = list()
         for system in systems:
             # Create a new state.
-            state = ThermodynamicState(system=system, temperature=reference_state.temperature, pressure=reference_state.pressure, mm=mm)
+            state = ThermodynamicState(system=system, temperature=reference_state.temperature, pressure=reference_state.pressure, mm=mm, share_system=share_systems)
             states.append(state)
 
         # Initialize replica-exchange simlulation.
@@ -1636,10 +3180,344 @@ class HamiltonianExchange(ReplicaExchange):
 
         # Override title.
         self.title = 'Hamiltonian exchange simulation created using HamiltonianExchange class of repex.py on %s' % time.asctime(time.localtime())
-        
+
+        return
+
+#=============================================================================================
+# Parameterized Hamiltonian exchange
+#=============================================================================================
+
+class ParameterizedHamiltonianExchange(ReplicaExchange):
+    """
+    Hamiltonian exchange simulation facility for states that differ only in the values of Context global parameters.
+
+    DESCRIPTION
+
+    All thermodynamic states share a single System object whose Custom*Force terms expose the alchemical coupling
+    (e.g. 'bond_lambda' or 'lennard_jones_lambda') as global parameters.  Since any Context of the shared System can
+    represent any state, replicas draw Contexts from the context pool, and switching a Context between states only requires
+    setting its global parameters.  Only as many Contexts as there are concurrent threads are needed, rather than one per
+    state.  The reduced potentials of a replica at all states are computed by setting parameters in one Context, rather than
+    by pushing the coordinates into a separate Context for each state as HamiltonianExchange does.
+
+    EXAMPLES
+
+    >>> # Create a system with a global parameter.
+    >>> import simtk.pyopenmm.extras.testsystems as testsystems
+    >>> [system, coordinates] = testsystems.LennardJonesCluster()
+    >>> import simtk.openmm as openmm
+    >>> force = openmm.CustomExternalForce('lambda_restraint*(x^2 + y^2 + z^2)')
+    >>> force.addGlobalParameter('lambda_restraint', 0.0)
+    >>> for particle_index in range(system.getNumParticles()): force.addParticle(particle_index, [])
+    >>> system.addForce(force)
+    >>> # Specify the parameters for each state.
+    >>> parameters = [ {'lambda_restraint' : value} for value in [0.0, 0.5, 1.0] ]
+    >>> # Create temporary file for storing output.
+    >>> import tempfile
+    >>> file = tempfile.NamedTemporaryFile() # temporary file for testing
+    >>> store_filename = file.name
+    >>> # Create reference state.
+    >>> from thermodynamics import ThermodynamicState
+    >>> reference_state = ThermodynamicState(system, temperature=298.0*units.kelvin)
+    >>> simulation = ParameterizedHamiltonianExchange(reference_state, system, parameters, coordinates, store_filename)
+    >>> simulation.number_of_iterations = 2 # set the simulation to only run 2 iterations
+    >>> simulation.nsteps_per_iteration = 50 # run 50 timesteps per iteration
+    >>> # Run simulation.
+    >>> simulation.run() # run the simulation
+
+    """
+
+    # Replicas are statically assigned to nodes, and energies are computed by the node owning each replica.
+    _nodes_own_replicas = True
+
+    def __init__(self, reference_state, system, parameters, coordinates, store_filename, protocol=None, mm=None, mpicomm=None):
+        """
+        Initialize a parameterized Hamiltonian exchange simulation object.
+
+        ARGUMENTS
+
+        reference_state (ThermodynamicState) - reference state containing all thermodynamic parameters except the system, which will be replaced by 'system'
+        system (simtk.openmm.System) - the system shared by all states, exposing the parameters in 'parameters' as global parameters of its forces
+        parameters (list of dict) - parameters[k] is a dict mapping global parameter names to their values in state k
+        coordinates (simtk.unit.Quantity of numpy natoms x 3 with units length) -  coordinates (or a list of coordinates objects) for initial assignment of replicas (will be used in round-robin assignment)
+        store_filename (string) - name of NetCDF file to bind to for simulation output and checkpointing
+
+        OPTIONAL ARGUMENTS
+
+        protocol (dict) - Optional protocol to use for specifying simulation protocol as a dict. Provided keywords will be matched to object variables to replace defaults.
+        mpicomm (mpi4py communicator) - MPI communicator, if parallel execution is desired (default: None)
+
+        NOTES
+
+        Every state must specify a value for the same set of global parameters.
+
+        """
+
+        # Determine which global parameters are exposed by the forces of the system.
+        global_parameter_names = set()
+        for force_index in range(system.getNumForces()):
+            force = system.getForce(force_index)
+            if hasattr(force, 'getNumGlobalParameters'):
+                for parameter_index in range(force.getNumGlobalParameters()):
+                    global_parameter_names.add(force.getGlobalParameterName(parameter_index))
+
+        # Make sure all states specify the same parameters, and that these are all global parameters of the system.
+        if len(parameters) == 0:
+            raise ParameterException("At least one set of parameters must be specified.")
+        self.parameter_names = sorted(parameters[0].keys())
+        for state_parameters in parameters:
+            if sorted(state_parameters.keys()) != self.parameter_names:
+                raise ParameterException("All states must specify values for the same global parameters.")
+        for name in self.parameter_names:
+            if name not in global_parameter_names:
+                raise ParameterException("Parameter '%s' is not a global parameter of any force in the provided system." % name)
+        self.parameters = [ dict(state_parameters) for state_parameters in parameters ]
+
+        # Create thermodynamic states that all share a single copy of the system.
+        shared_state = ThermodynamicState(system=system, temperature=reference_state.temperature, pressure=reference_state.pressure, mm=mm)
+        states = [ copy.copy(shared_state) for state_parameters in self.parameters ]
+
+        # Initialize replica-exchange simlulation.
+        ReplicaExchange.__init__(self, states, coordinates, store_filename, protocol=protocol, mm=mm, mpicomm=mpicomm)
+
+        # Override title.
+        self.title = 'Parameterized Hamiltonian exchange simulation created using ParameterizedHamiltonianExchange class of repex.py on %s' % time.asctime(time.localtime())
+
+        return
+
+    def _node_replica_indices(self, rank=None):
+        """
+        Return the indices of the replicas owned by a node.
+
+        OPTIONAL ARGUMENTS
+
+        rank (int) - the node whose replicas are to be returned, or None for this node (default: None)
+
+        NOTES
+
+        Because any replica Context can represent any state, replicas are statically assigned to nodes.
+
+        """
+
+        if rank is None:
+            rank = self.mpicomm.rank
+
+        return range(rank, self.nstates, self.mpicomm.size)
+
+    def _rebalance_states(self):
+        """
+        Replicas are statically assigned to nodes, so no rebalancing is performed.
+
+        """
+
+        return
+
+    def _create_contexts(self):
+        """
+        Populate the context pool with one Context of the shared System for each thread that can use one concurrently.
+
+        """
+
+        if self.mpicomm:
+            replica_indices = self._node_replica_indices()
+        else:
+            replica_indices = range(self.nstates)
+
+        # All states share the same System, so the Contexts must be held simultaneously for the pool to create distinct ones.
+        ncontexts = min(self.nthreads, len(replica_indices))
+        contexts = [ self._acquire_context(self.states[0])[0] for index in range(ncontexts) ]
+        for context in contexts:
+            self._release_context(context)
+
+        return
+
+    def _set_context_parameters(self, context, state_index):
+        """
+        Set the global parameters of the given Context to the values for the specified state.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the Context whose parameters are to be set
+        state_index (int) - the thermodynamic state whose parameters are to be used
+
+        """
+
+        state_parameters = self.parameters[state_index]
+        for name in self.parameter_names:
+            context.setParameter(name, state_parameters[name])
+
+        return
+
+    def _propagate_replica(self, replica_index):
+        """
+        Propagate the replica corresponding to the specified replica index in a pooled Context.
+
+        ARGUMENTS
+
+        replica_index (int) - the replica to propagate
+
+        RETURNS
+
+        elapsed_time (float) - time (in seconds) to propagate replica
+
+        """
+
+        # Retrieve state.
+        state_index = self.replica_states[replica_index] # index of thermodynamic state that current replica is assigned to
+        state = self.states[state_index] # thermodynamic state
+
+        # Acquire integrator and context of the shared System from the pool.
+        [context, integrator] = self._acquire_context(state)
+
+        # Switch the Context to the current thermodynamic state.
+        self._set_context_parameters(context, state_index)
+
+        # Set coordinates and box vectors.
+        self._set_context_configuration(context, replica_index)
+        # Assign Maxwell-Boltzmann velocities.
+        self._assign_velocities(context, state)
+        # Run dynamics.
+        start_time = time.time()
+        integrator.step(self.nsteps_per_iteration)
+        end_time = time.time()
+        # Store final coordinates and box vectors.
+        self._store_context_configuration(context, replica_index)
+        # Return the context to the pool.
+        self._release_context(context)
+
+        elapsed_time = end_time - start_time
+
+        return elapsed_time
+
+    def _minimize_replica(self, replica_index):
+        """
+        Minimize the specified replica in a pooled Context.
+
+        RETURNS
+
+        elapsed_time (float) - time (in seconds) to minimize replica
+
+        """
+
+        # Acquire a Context of the shared System and switch it to the current state.
+        state_index = self.replica_states[replica_index]
+        [context, integrator] = self._acquire_context(self.states[state_index], integrator_type=None)
+        self._set_context_parameters(context, state_index)
+        # Set coordinates and box vectors.
+        self._set_context_configuration(context, replica_index)
+        # Minimize energy.
+        start_time = time.time()
+        self.mm.LocalEnergyMinimizer.minimize(context, self.minimize_tolerance, self.minimize_max_iterations)
+        end_time = time.time()
+        # Store final coordinates
+        self._store_context_configuration(context, replica_index)
+        # Return the context to the pool.
+        self._release_context(context)
+
+        return end_time - start_time
+
+    def _minimization_key(self, replica_index):
+        """
+        Return a key identifying the minimization problem of a replica, including the global parameters of its state.
+
+        """
+
+        state_index = self.replica_states[replica_index]
+        parameters = tuple([ self.parameters[state_index][name] for name in self.parameter_names ])
+        return ReplicaExchange._minimization_key(self, replica_index) + (parameters,)
+
+    def _compute_replica_energies(self, replica_index):
+        """
+        Compute the reduced potential of the specified replica at all states by switching the parameters of a pooled Context.
+
+        ARGUMENTS
+
+        replica_index (int) - the replica whose energies are to be computed
+
+        """
+
+        [context, integrator] = self._acquire_context(self.states[0], integrator_type=None)
+
+        # Set coordinates and box vectors once for all states.
+        self._set_context_configuration(context, replica_index)
+        (coordinates, box_vectors) = self._replica_configuration(replica_index)
+
+        # Evaluate the potential at each state.
+        for state_index in range(self.nstates):
+            if (self._energy_mask is not None) and (not self._energy_mask[replica_index,state_index]):
+                self.u_kl[replica_index,state_index] = numpy.nan
+                continue
+            state = self.states[state_index]
+            self._set_context_parameters(context, state_index)
+            openmm_state = context.getState(getEnergy=True)
+            reduced_potential = state.beta * openmm_state.getPotentialEnergy()
+            if state.pressure is not None:
+                reduced_potential += state.beta * state.pressure * state._volume(box_vectors) * units.AVOGADRO_CONSTANT_NA
+            self.u_kl[replica_index,state_index] = reduced_potential
+
+        # Return the context to the pool.
+        self._release_context(context)
+
+        return
+
+    def _compute_energies(self):
+        """
+        Compute energies of all replicas at all states.
+
+        NOTES
+
+        Each node computes the rows of the energy matrix for the replicas it owns.
+
+        """
+
+        start_time = time.time()
+
+        if self.verbose: print "Computing energies..."
+
+        # Determine which energies need to be evaluated.
+        self._plan_energy_evaluations()
+
+        if self.mpicomm:
+            # MPI version.
+
+            # Compute energies for this node's share of replicas.
+            replica_indices = self._node_replica_indices()
+            self._parallel_map(self._compute_replica_energies, replica_indices)
+
+            # Send final energies to all nodes.
+            rank_replica_indices = [ self._node_replica_indices(rank) for rank in range(self.mpicomm.size) ]
+            self._exchange_rows(self.u_kl, rank_replica_indices)
+
+        else:
+            # Serial version.
+            self._parallel_map(self._compute_replica_energies, range(self.nstates))
+
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        time_per_energy = elapsed_time / float(self.nstates)**2
+        if self.verbose: print "Time to compute all energies %.3f s (%.3f per energy calculation)." % (elapsed_time, time_per_energy)
+
+        return
+
+    def _initialize_netcdf(self):
+        # Call superclass method.
+        ReplicaExchange._initialize_netcdf(self)
+
+        # Save parameters of each state.
+        self.ncfile.createDimension('parameter', len(self.parameter_names))
+        ncvar_parameters = self.ncfile.createVariable('parameters', 'f', ('replica','parameter'))
+        setattr(ncvar_parameters, 'units', 'none')
+        setattr(ncvar_parameters, 'parameter_names', ' '.join(self.parameter_names))
+        setattr(ncvar_parameters, "long_name", "parameters[state][parameter] is the value of global parameter 'parameter' (named in attribute 'parameter_names') for state 'state'.")
+        for state_index in range(self.nstates):
+            for (parameter_index, name) in enumerate(self.parameter_names):
+                self.ncfile.variables['parameters'][state_index,parameter_index] = self.parameters[state_index][name]
+
+        # Force sync to disk to avoid data loss.
+        self.ncfile.sync()
+
         return
 
-    
 
 #=============================================================================================
 # MAIN AND TESTS
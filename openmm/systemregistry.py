@@ -0,0 +1,289 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Registry of fingerprinted OpenMM System objects shared among thermodynamic states and factories.
+
+DESCRIPTION
+
+Large explicit-solvent Systems are expensive to copy, and many alchemical intermediates are
+structurally identical (e.g. all states with a fully-coupled ligand).  This module fingerprints
+Systems by hashing their XML serialization, and hands out a single shared instance for all Systems
+with the same fingerprint, so that identical states share one System (and therefore one set of
+pooled Contexts; see contextpool.py).
+
+Provided classes include:
+
+* SystemRegistry - A thread-safe registry of shared System objects, keyed by fingerprint
+
+Provided functions include:
+
+* fingerprint - Compute the fingerprint of a System
+
+The process-wide registry is 'default_registry'.  Sharing is opt-in: ThermodynamicState uses it only when created
+with share_system=True, and the alchemical factories skip their private copies of Systems that are already shared.
+
+EXAMPLES
+
+Two structurally identical Systems are replaced by one shared instance.
+
+>>> import copy
+>>> import simtk.pyopenmm.extras.testsystems as testsystems
+>>> [system, coordinates] = testsystems.LennardJonesCluster()
+>>> registry = SystemRegistry()
+>>> shared_1 = registry.share(system)
+>>> shared_2 = registry.share(copy.deepcopy(system))
+>>> shared_1 is shared_2
+True
+
+NOTES
+
+Shared Systems must be treated as immutable, since they may be used by many states and cached Contexts.
+To modify one, obtain a private copy with SystemRegistry.writable(), modify it, and share the result again.
+
+The registry holds only weak references, so a shared System is released as soon as no state, factory, or
+pooled Context uses it any more.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import copy
+import weakref
+import hashlib
+import threading
+
+import simtk.openmm
+
+#=============================================================================================
+# REVISION CONTROL
+#=============================================================================================
+
+__version__ = "$Revision: $"
+
+#=============================================================================================
+# Fingerprinting
+#=============================================================================================
+
+def fingerprint(system, mm=None):
+    """
+    Compute a fingerprint that identifies a System by its contents.
+
+    ARGUMENTS
+
+    system (simtk.openmm.System) - the System to fingerprint
+
+    OPTIONAL ARGUMENTS
+
+    mm (simtk.openmm API) - OpenMM API implementation providing XmlSerializer (default: simtk.openmm)
+
+    RETURNS
+
+    fingerprint (string) - hexadecimal SHA-1 digest of the XML serialization of the System
+
+    """
+
+    if mm is None: mm = simtk.openmm
+    xml = mm.XmlSerializer.serializeSystem(system)
+    return hashlib.sha1(xml).hexdigest()
+
+#=============================================================================================
+# System registry
+#=============================================================================================
+
+class SystemRegistry(object):
+    """
+    A thread-safe registry of shared System objects, keyed by fingerprint.
+
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty registry.
+
+        """
+
+        self._lock = threading.RLock() # reentrant, since weak reference callbacks may run while the lock is held
+        self._systems = weakref.WeakValueDictionary() # _systems[fingerprint] is the shared System with that fingerprint
+        self._fingerprints = dict() # _fingerprints[id(system)] is a (weak reference, fingerprint) pair for shared System 'system'
+
+        return
+
+    def _lookup(self, system):
+        """
+        Return the fingerprint of a shared System, or None if the object is not a shared System.
+
+        NOTES
+
+        The caller must hold the lock.
+
+        """
+
+        entry = self._fingerprints.get(id(system))
+        if (entry is None) or (entry[0]() is not system):
+            return None
+        return entry[1]
+
+    def _register(self, system, key):
+        """
+        Register 'system' as the shared System with fingerprint 'key', forgetting it when it is garbage collected.
+
+        NOTES
+
+        The caller must hold the lock.
+
+        """
+
+        token = id(system)
+        def forget(reference):
+            self._lock.acquire()
+            try:
+                entry = self._fingerprints.get(token)
+                if (entry is not None) and (entry[0] is reference):
+                    del self._fingerprints[token]
+            finally:
+                self._lock.release()
+        self._systems[key] = system
+        self._fingerprints[token] = (weakref.ref(system, forget), key)
+
+        return
+
+    def share(self, system, copy_system=True, mm=None):
+        """
+        Return the shared System with the same contents as the given System, registering it if it is new.
+
+        ARGUMENTS
+
+        system (simtk.openmm.System) - the System to share
+
+        OPTIONAL ARGUMENTS
+
+        copy_system (boolean) - if True, a new System is registered as a private deep copy, so later changes by the
+           caller to 'system' do not affect the shared instance; if False, 'system' itself is registered, and the
+           caller must not modify it afterwards (default: True)
+        mm (simtk.openmm API) - OpenMM API implementation providing XmlSerializer (default: simtk.openmm)
+
+        RETURNS
+
+        shared_system (simtk.openmm.System) - the shared System, which must not be modified
+
+        """
+
+        self._lock.acquire()
+        try:
+            if self._lookup(system) is not None:
+                # Already a shared instance.
+                return system
+        finally:
+            self._lock.release()
+
+        key = fingerprint(system, mm=mm)
+
+        self._lock.acquire()
+        try:
+            shared_system = self._systems.get(key)
+            if shared_system is None:
+                if copy_system:
+                    system = copy.deepcopy(system)
+                self._register(system, key)
+                shared_system = system
+            return shared_system
+        finally:
+            self._lock.release()
+
+    def writable(self, system):
+        """
+        Return a private copy of a System that the caller may modify (copy-on-write).
+
+        ARGUMENTS
+
+        system (simtk.openmm.System) - a shared or unshared System
+
+        RETURNS
+
+        writable_system (simtk.openmm.System) - a deep copy of 'system' that is not registered
+
+        NOTES
+
+        Pass the modified System to share() to make it available to other users again.
+
+        """
+
+        return copy.deepcopy(system)
+
+    def fingerprint(self, system, mm=None):
+        """
+        Return the fingerprint of a System, using the cached value for shared Systems.
+
+        ARGUMENTS
+
+        system (simtk.openmm.System) - the System to fingerprint
+
+        OPTIONAL ARGUMENTS
+
+        mm (simtk.openmm API) - OpenMM API implementation providing XmlSerializer (default: simtk.openmm)
+
+        RETURNS
+
+        fingerprint (string) - hexadecimal SHA-1 digest of the XML serialization of the System
+
+        """
+
+        self._lock.acquire()
+        try:
+            key = self._lookup(system)
+        finally:
+            self._lock.release()
+
+        if key is None:
+            key = fingerprint(system, mm=mm)
+        return key
+
+    def is_shared(self, system):
+        """
+        Return True if the given object is a shared System of this registry, which must not be modified.
+
+        """
+
+        self._lock.acquire()
+        try:
+            return self._lookup(system) is not None
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """
+        Forget all shared Systems.  Systems still referenced elsewhere remain valid, but are no longer shared with new users.
+
+        """
+
+        self._lock.acquire()
+        try:
+            self._systems.clear()
+            self._fingerprints.clear()
+        finally:
+            self._lock.release()
+
+        return
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+#=============================================================================================
+# Process-wide registry
+#=============================================================================================
+
+default_registry = SystemRegistry() # registry shared by all ThermodynamicState objects and factories in this process
+
+#=============================================================================================
+# MAIN AND TESTS
+#=============================================================================================
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -36,6 +36,9 @@ import numpy
 import simtk.openmm 
 import simtk.unit as units
 
+import contextpool
+import systemregistry
+
 #=============================================================================================
 # REVISION CONTROL
 #=============================================================================================
@@ -48,6 +51,30 @@ __version__ = "$Revision: $"
 
 kB = units.BOLTZMANN_CONSTANT_kB * units.AVOGADRO_CONSTANT_NA # Boltzmann constant
 
+#=============================================================================================
+# Utility functions
+#=============================================================================================
+
+def _length_array_in_nanometers(values):
+    """
+    Convert coordinates or box vectors to a unitless float64 numpy array in nanometers.
+
+    ARGUMENTS
+
+    values (simtk.unit.Quantity, numpy.array in nm, or nested list/tuple of either) - lengths to convert
+
+    RETURNS
+
+    array (numpy.array of float64) - the values in nanometers
+
+    """
+
+    if units.is_quantity(values):
+        return numpy.array(values / units.nanometers, numpy.float64)
+    if isinstance(values, (list, tuple)):
+        return numpy.array([ _length_array_in_nanometers(value) for value in values ], numpy.float64)
+    return numpy.asarray(values, numpy.float64)
+
 #=============================================================================================
 # Thermodynamic state description
 #=============================================================================================
@@ -82,7 +109,7 @@ class ThermodynamicState(object):
 
     """
     
-    def __init__(self, system=None, temperature=None, pressure=None, mm=None):
+    def __init__(self, system=None, temperature=None, pressure=None, mm=None, share_system=False):
         """
         Initialize the thermodynamic state.
 
@@ -93,7 +120,18 @@ class ThermodynamicState(object):
         pressure (simtk.unit.Quantity compatible with 'atmospheres') - the pressure for constant-pressure systems (default: None)
 
         mm (simtk.openmm API) - OpenMM API implementation to use
-        cache_context (boolean) - if True, will try to cache Context objects
+        share_system (boolean) - if True, use the instance shared through systemregistry.default_registry by all structurally
+           identical Systems instead of a private deep copy; neither 'system' nor the shared System may be modified afterwards
+           (default: False)
+
+        NOTES
+
+        Context objects used to compute potentials are acquired from the process-wide pool contextpool.default_pool,
+        so states sharing a System share Contexts with each other and with ReplicaExchange.
+
+        By default the state holds a private deep copy of the System, which may be modified freely.  With share_system=True,
+        identical states share one System (and therefore one set of pooled Contexts) without copying; the shared System must
+        then not be modified, and writable_system() returns a private copy instead.
 
         """
 
@@ -104,9 +142,9 @@ class ThermodynamicState(object):
 
         self._mm = None             # Cached OpenMM implementation
 
-        self._cache_context = True  # if True, try to cache Context object
-        self._context = None        # cached Context
-        self._integrator = None     # cached Integrator
+        self._cache_context = True  # if True, Context objects are returned to the pool for reuse
+        self._system_registry = systemregistry.default_registry # process-wide registry of shared System objects
+        self._context_pool = contextpool.default_pool # process-wide pool from which Context objects are acquired
 
         # Store OpenMM implementation.
         if mm:
@@ -117,15 +155,20 @@ class ThermodynamicState(object):
         # Store provided values.
         if system is not None:
             # TODO: Check to make sure system object implements OpenMM System API.
-            self.system = copy.deepcopy(system) # TODO: Do this when deep copy works.
-            # self.system = system # we make a shallow copy for now, which can cause trouble later
+            self.system = system
         if temperature is not None:
             self.temperature = temperature
         if pressure is not None:
             self.pressure = pressure
 
-        # If temperature and pressure are specified, make sure MonteCarloBarostat is attached.
+        # Make a private copy of the System, unless it is to be shared.
+        if (self.system is not None) and not share_system:
+            self.system = copy.deepcopy(self.system)
+
+        # If temperature and pressure are specified, make sure MonteCarloBarostat is attached to a private copy of the System.
         if temperature and pressure:
+            if share_system:
+                self.system = self._system_registry.writable(self.system)
             # Try to find barostat.
             barostat = False
             for force_index in range(self.system.getNumForces()):
@@ -143,51 +186,106 @@ class ThermodynamicState(object):
                 barostat = self._mm.MonteCarloBarostat(pressure, temperature)
                 self.system.addForce(barostat)                    
 
+            if share_system:
+                # Share the modified copy, which nobody else has a reference to.
+                self.system = self._system_registry.share(self.system, copy_system=False, mm=self._mm)
+        elif (self.system is not None) and share_system:
+            # Share one instance of the System among all identical states; the caller has promised not to modify it.
+            self.system = self._system_registry.share(self.system, copy_system=False, mm=self._mm)
+
         return
 
-    def _create_context(self, platform=None):
+    def writable_system(self):
         """
-        Create Integrator and Context objects if they do not already exist.
-        
+        Return a System for this state that may be modified without affecting other states (copy-on-write).
+
+        RETURNS
+
+        system (simtk.openmm.System) - a private copy of the System, which replaces the shared one for this state
+
+        NOTES
+
+        If the state was created with share_system=True, the first call replaces the shared System of this state with a
+        private deep copy; otherwise, and on later calls, the state's own System is returned.
+        Modifications are visible to Contexts created afterwards, so this should be called before any energies are computed.
+
         """
 
-        # Check if we already have a Context defined.
-        if self._context:
-            if platform and (platform != self._context.getPlatform()):
-                # Platform differs from the one requested; destroy it.
-                del self._context, self._integrator
-            else:
-                # Cached context is what we expect; do nothing.
-                return
-
-        # Create an integrator.
-        timestep = 1.0 * units.femtosecond
-        self._integrator = self._mm.VerletIntegrator(timestep)        
-            
-        # Create a new OpenMM context.
-        if platform:                
-            self._context = self._mm.Context(self.system, self._integrator, platform)
-        else:
-            self._context = self._mm.Context(self.system, self._integrator)
-            
-        return
+        if self._system_registry.is_shared(self.system):
+            self.system = self._system_registry.writable(self.system)
 
-    def _cleanup_context(self):
-        del self._context, self._integrator
-        self._context = None
-        self._integrator = None
+        return self.system
 
-    def _compute_potential(self, coordinates, box_vectors):
+    def _acquire_context(self, platform=None):
+        """
+        Acquire a Context for this state's System from the context pool.
+
+        OPTIONAL ARGUMENTS
+
+        platform (simtk.openmm.Platform) - the Platform to use, or None for the default (default: None)
+
+        RETURNS
+
+        context (simtk.openmm.Context) - a Context for exclusive use until it is passed to _release_context()
+
+        """
+
+        [context, integrator] = self._context_pool.acquire(self.system, platform=platform, mm=self._mm)
+        return context
+
+    def _release_context(self, context, discard=False):
+        """
+        Return a Context to the context pool.
+
+        ARGUMENTS
+
+        context (simtk.openmm.Context) - the Context to release
+
+        OPTIONAL ARGUMENTS
+
+        discard (boolean) - if True, the Context is destroyed rather than kept for reuse (default: False)
+
+        """
+
+        self._context_pool.release(context, discard=(discard or not self._cache_context))
+        return
+
+    def _compute_potential(self, context, coordinates, box_vectors):
         # Set coordinates and periodic box vectors.
-        self._context.setPositions(coordinates)
-        if box_vectors is not None: self._context.setPeriodicBoxVectors(*box_vectors)                
+        context.setPositions(coordinates)
+        if box_vectors is not None: context.setPeriodicBoxVectors(*box_vectors)                
         
         # Retrieve potential energy.
-        openmm_state = self._context.getState(getEnergy=True)
+        openmm_state = context.getState(getEnergy=True)
         potential_energy = openmm_state.getPotentialEnergy()
 
         return potential_energy
 
+    def _compute_potential_or_retry(self, context, coordinates, box_vectors, platform=None):
+        """
+        Compute the potential energy in the given pooled Context, replacing the Context if it fails.
+
+        RETURNS
+
+        context (simtk.openmm.Context) - the Context that succeeded, which the caller must release
+        potential_energy (simtk.unit.Quantity with units of energy) - the potential energy
+
+        """
+
+        try:
+            potential_energy = self._compute_potential(context, coordinates, box_vectors)
+        except Exception:
+            # Our pooled context failed, so discard it and try another one.
+            self._release_context(context, discard=True)
+            context = self._acquire_context(platform)
+            try:
+                potential_energy = self._compute_potential(context, coordinates, box_vectors)
+            except:
+                self._release_context(context, discard=True)
+                raise
+
+        return [context, potential_energy]
+
     @property
     def kT(self):
         """
@@ -288,21 +386,10 @@ class ThermodynamicState(object):
         if (self.pressure is not None) and (box_vectors is None):
             raise ParameterException("box_vectors must be specified if constant-pressure ensemble.")
 
-        # Make sure we have Context and Integrator objects.
-        self._create_context(platform)
-
-        # Compute energy.
-        try:
-            potential_energy = self._compute_potential(coordinates, box_vectors)
-        except Exception as e:
-            print e # DEBUG
-
-            # Our cached context failed, so try deleting it and creating it anew.
-            self._cleanup_context()
-            self._create_context()
-
-            # Compute energy
-            potential_energy = self._compute_potential(coordinates, box_vectors)            
+        # Acquire a Context from the pool and compute energy.
+        context = self._acquire_context(platform)
+        [context, potential_energy] = self._compute_potential_or_retry(context, coordinates, box_vectors, platform)
+        self._release_context(context)
         
         # Compute inverse temperature.
         beta = 1.0 / (kB * self.temperature)
@@ -312,28 +399,28 @@ class ThermodynamicState(object):
         if self.pressure is not None:
             reduced_potential += beta * self.pressure * self._volume(box_vectors) * units.AVOGADRO_CONSTANT_NA
 
-        # Clean up context if requested, or if we're using Cuda (which can only have one active Context at a time).
-        if (not self._cache_context) or (self._context.getPlatform().getName() == 'Cuda'):
-            self._cleanup_context()
-
         return reduced_potential
 
     def reduced_potential_multiple(self, coordinates_list, box_vectors_list=None, mm=None, platform=None):
         """
         Compute the reduced potential for the given sets of coordinates in this thermodynamic state.
-        This can pontentially be more efficient than repeated calls to reduced_potential.
+        This is more efficient than repeated calls to reduced_potential, since one Context is used for all
+        configurations, unit conversions are performed once per batch, and the pV term is computed for all
+        configurations at once.
 
         ARGUMENTS
 
-        coordinates_list (list of simtk.unit.Quantity of Nx3 numpy.array) - coordinates[n,k] is kth coordinate of particle n
+        coordinates_list (simtk.unit.Quantity of n x natoms x 3 numpy.array, list of n simtk.unit.Quantity of natoms x 3 numpy.array, or n x natoms x 3 numpy.array in nm) - 
+           coordinates_list[i][n,k] is kth coordinate of particle n of configuration i
 
         OPTIONAL ARGUMENTS
         
-        box_vectors - periodic box vectors
+        box_vectors_list (simtk.unit.Quantity of n x 3 x 3 numpy.array, list of n sets of box vectors, or n x 3 x 3 numpy.array in nm) - 
+           box_vectors_list[i][k,:] is periodic box vector k of configuration i
 
         RETURNS
 
-        u_k (K numpy array of float) - the unitless reduced potentials (which can be considered to have units of kT)
+        u_k (n numpy array of float64) - the unitless reduced potentials (which can be considered to have units of kT)
         
         EXAMPLES
 
@@ -349,6 +436,14 @@ class ThermodynamicState(object):
         >>> # compute potential for all sets of coordinates
         >>> potentials = state.reduced_potential_multiple(coordinates_list)
 
+        Compute the reduced potential of a water box at multiple configurations at 298 K and 1 atm.
+
+        >>> [system, coordinates] = testsystems.WaterBox()
+        >>> state = ThermodynamicState(system=system, temperature=298.0*units.kelvin, pressure=1.0*units.atmosphere)
+        >>> coordinates_array = numpy.array([ coordinates / units.nanometers for i in range(3) ])
+        >>> box_vectors_array = numpy.array([ [ vector / units.nanometers for vector in system.getDefaultPeriodicBoxVectors() ] for i in range(3) ])
+        >>> potentials = state.reduced_potential_multiple(coordinates_array, box_vectors_array)
+
         NOTES
 
         The reduced potential is defined as in Ref. [1]
@@ -385,32 +480,34 @@ class ThermodynamicState(object):
         if (self.pressure is not None) and (box_vectors_list is None):
             raise ParameterException("box_vectors must be specified if constant-pressure ensemble.")
 
-        # Make sure we have Context and Integrator objects.
-        self._create_context(platform)
+        # Strip units, converting everything to nanometers once.
+        coordinates_array = _length_array_in_nanometers(coordinates_list)
+        box_vectors_array = None
+        if box_vectors_list is not None:
+            box_vectors_array = _length_array_in_nanometers(box_vectors_list)
 
-        # Allocate storage.
-        K = len(coordinates_list)
-        u_k = numpy.zeros([K], numpy.float64)
+        # Acquire one Context from the pool for all configurations.
+        context = self._acquire_context(platform)
 
-        # Compute energies.
+        # Compute potential energies (in kJ/mol).
+        K = coordinates_array.shape[0]
+        potential_energies = numpy.zeros([K], numpy.float64)
         for k in range(K):
-            # Compute energy
-            if box_vectors_list:
-                potential_energy = self._compute_potential(coordinates_list[k], box_vectors_list[k])
-            else:
-                potential_energy = self._compute_potential(coordinates_list[k], None)
-        
-            # Compute inverse temperature.
-            beta = 1.0 / (kB * self.temperature)
-
-            # Compute reduced potential.
-            u_k[k] = beta * potential_energy
-            if self.pressure is not None:
-                u_k[k] += beta * self.pressure * self._volume(box_vectors) * units.AVOGADRO_CONSTANT_NA
-
-        # Clean up context if requested, or if we're using Cuda (which can only have one active Context at a time).
-        if (not self._cache_context) or (self._context.getPlatform().getName() == 'Cuda'):
-            self._cleanup_context()
+            coordinates = units.Quantity(coordinates_array[k,:,:], units.nanometers)
+            box_vectors = None
+            if box_vectors_array is not None:
+                box_vectors = units.Quantity(box_vectors_array[k,:,:], units.nanometers)
+            [context, potential_energy] = self._compute_potential_or_retry(context, coordinates, box_vectors, platform)
+            potential_energies[k] = potential_energy / units.kilojoules_per_mole
+        self._release_context(context)
+
+        # Compute reduced potentials, with inverse temperature in mol/kJ.
+        beta = units.kilojoules_per_mole / (kB * self.temperature)
+        u_k = beta * potential_energies
+        if self.pressure is not None:
+            # pV for a volume of 1 nm^3 (in kJ/mol), times volumes of all configurations (in nm^3).
+            pressure_volume = self.pressure * units.nanometers**3 * units.AVOGADRO_CONSTANT_NA / units.kilojoules_per_mole
+            u_k += beta * pressure_volume * numpy.linalg.det(box_vectors_array)
 
         return u_k
 
@@ -86,8 +86,76 @@ sys.stderr.write(LongWarning + '\n')
 # METHODS
 #=============================================================================================
 
+correlation_methods = ['direct', 'fft'] # methods available for computing correlation functions
+
+#=============================================================================================
+def _checkMethod(method):
+  """
+  Raise ParameterError if 'method' is not one of the available correlation function methods.
+
+  """
+
+  if method not in correlation_methods:
+    raise ParameterError("Unknown correlation function method '%s'; must be one of %s." % (method, str(correlation_methods)))
+
+  return
 #=============================================================================================
-def statisticalInefficiency(A_n, B_n=None, fast=False, mintime=3):
+def _fluctuationCorrelationFFT(dA_kn, dB_kn=None, N_max=None, symmetric=False):
+  """
+  Compute the unnormalized fluctuation (cross) correlation sums of one or more timeseries by fast Fourier transform.
+
+  REQUIRED ARGUMENTS
+    dA_kn (list of numpy arrays) - dA_kn[k] is the kth fluctuation timeseries of A, with the mean already subtracted
+
+  OPTIONAL ARGUMENTS
+    dB_kn (list of numpy arrays) - dB_kn[k] is the kth fluctuation timeseries of B, of the same length as dA_kn[k];
+       if None, the autocorrelation of A is computed (default: None)
+    N_max (int) - largest time lag to compute (default: longest timeseries length - 1)
+    symmetric (boolean) - if True, sum both orderings, dA[n]*dB[n+t] + dB[n]*dA[n+t] (default: False)
+
+  RETURNS
+    numerator_t (numpy array) - numerator_t[t] is the sum over timeseries k and times n of dA_kn[k][n] * dB_kn[k][n+t],
+       for t = 0, ..., N_max
+    count_t (numpy array) - count_t[t] is the number of products summed at lag t, sum_k max(N_k - t, 0)
+
+  NOTES
+    Each timeseries is zero-padded to at least N_k.max() + N_max + 1 points, so the circular correlation computed by
+    FFT contains no wrapped-around contributions.  Products never span two timeseries.
+
+  """
+
+  K = len(dA_kn)
+  N_k = numpy.array([ dA_kn[k].size for k in range(K) ], numpy.int64)
+  if (N_max is None) or (N_max > N_k.max() - 1):
+    N_max = N_k.max() - 1
+
+  # Choose a power-of-two transform length large enough to avoid wrap-around.
+  size = 1
+  while size < N_k.max() + N_max + 1:
+    size *= 2
+
+  # Accumulate cross power spectra of all timeseries.
+  spectrum = numpy.zeros([size//2 + 1], numpy.complex128)
+  for k in range(K):
+    FA = numpy.fft.rfft(numpy.asarray(dA_kn[k], numpy.float64), size)
+    if dB_kn is None:
+      FB = FA
+    else:
+      FB = numpy.fft.rfft(numpy.asarray(dB_kn[k], numpy.float64), size)
+    if symmetric:
+      spectrum += 2.0 * (numpy.conj(FA) * FB).real
+    else:
+      spectrum += numpy.conj(FA) * FB
+  numerator_t = numpy.fft.irfft(spectrum, size)[0:N_max+1]
+
+  # Count overlapping products at each lag.
+  t = numpy.arange(N_max+1)
+  count_t = numpy.maximum(N_k[:,numpy.newaxis] - t[numpy.newaxis,:], 0).sum(0)
+
+  return (numerator_t, count_t)
+#=============================================================================================
+#=============================================================================================
+def statisticalInefficiency(A_n, B_n=None, fast=False, mintime=3, method='direct'):
   """
   Compute the (cross) statistical inefficiency of (two) timeseries.
 
@@ -104,6 +172,8 @@ def statisticalInefficiency(A_n, B_n=None, fast=False, mintime=3):
        The algorithm terminates after computing the correlation time out to mintime when the
        correlation function furst goes negative.  Note that this time may need to be increased
        if there is a strong initial negative peak in the correlation function.
+    method (string) - 'direct' computes the correlation function one lag at a time; 'fft' computes it for all lags
+       at once by fast Fourier transform in O(N log N) time, giving the same result to within roundoff (default: 'direct')
 
   RETURNS
     g is the estimated statistical inefficiency (equal to 1 + 2 tau, where tau is the correlation time).
@@ -125,9 +195,15 @@ def statisticalInefficiency(A_n, B_n=None, fast=False, mintime=3):
   >>> import testsystems
   >>> A_n = testsystems.generateCorrelatedTimeseries(N=100000, tau=5.0)
   >>> g = statisticalInefficiency(A_n, fast=True)
+
+  Compute the same statistical inefficiency using the FFT method.
+
+  >>> g = statisticalInefficiency(A_n, fast=True, method='fft')
   
   """
 
+  _checkMethod(method)
+
   # Create numpy copies of input arguments.
   A_n = numpy.array(A_n)
   if B_n is not None:  
@@ -160,6 +236,11 @@ def statisticalInefficiency(A_n, B_n=None, fast=False, mintime=3):
   if(sigma2_AB == 0):
     raise ParameterException('Sample covariance sigma_AB^2 = 0 -- cannot compute statistical inefficiency')
 
+  # Compute the normalized fluctuation correlation function at all time lags at once, if requested.
+  if method == 'fft':
+    [numerator_t, count_t] = _fluctuationCorrelationFFT([dA_n], [dB_n], symmetric=True)
+    C_t = numerator_t / (2.0 * count_t * sigma2_AB)
+
   # Accumulate the integrated correlation time by computing the normalized correlation time at
   # increasing values of t.  Stop accumulating if the correlation function goes negative, since
   # this is unlikely to occur unless the correlation function has decayed to the point where it
@@ -169,7 +250,10 @@ def statisticalInefficiency(A_n, B_n=None, fast=False, mintime=3):
   while (t < N-1):
 
     # compute normalized fluctuation correlation function at time t
-    C = numpy.sum( dA_n[0:(N-t)]*dB_n[t:N] + dB_n[0:(N-t)]*dA_n[t:N] ) / (2.0 * float(N-t) * sigma2_AB)
+    if method == 'fft':
+      C = C_t[t]
+    else:
+      C = numpy.sum( dA_n[0:(N-t)]*dB_n[t:N] + dB_n[0:(N-t)]*dA_n[t:N] ) / (2.0 * float(N-t) * sigma2_AB)
     # Terminate if the correlation function has crossed zero and we've computed the correlation
     # function at least out to 'mintime'.
     if (C <= 0.0) and (t > mintime):
@@ -190,7 +274,7 @@ def statisticalInefficiency(A_n, B_n=None, fast=False, mintime=3):
   # Return the computed statistical inefficiency.
   return g
 #=============================================================================================
-def statisticalInefficiencyMultiple(A_kn, fast=False, return_correlation_function=False):
+def statisticalInefficiencyMultiple(A_kn, fast=False, return_correlation_function=False, method='direct'):
   """
   Estimate the statistical inefficiency from multiple stationary timeseries (of potentially differing lengths).
 
@@ -200,6 +284,8 @@ def statisticalInefficiencyMultiple(A_kn, fast=False, return_correlation_functio
   OPTIONAL ARGUMENTS  
     fast can be set to True to give a less accurate but very quick estimate (default False)
     return_correlation_function - if True, will also return estimates of normalized fluctuation correlation function that were computed (default: False)
+    method (string) - 'direct' computes the correlation function one lag at a time; 'fft' computes it for all lags
+       at once by fast Fourier transform in O(N log N) time, giving the same result to within roundoff (default: 'direct')
 
   RETURNS
     g is the statistical inefficiency (equal to 1 + 2 tau, where tau is the integrated autocorrelation time).
@@ -229,8 +315,14 @@ def statisticalInefficiencyMultiple(A_kn, fast=False, return_correlation_functio
 
   >>> [g, Ct] = statisticalInefficiencyMultiple(A_kn, return_correlation_function=True)
 
+  Use the FFT method, which is much faster for long timeseries.
+
+  >>> g = statisticalInefficiencyMultiple(A_kn, method='fft')
+
   """
 
+  _checkMethod(method)
+
   # Convert A_kn into a list of arrays if it is not in this form already.
   if (type(A_kn) == numpy.ndarray):
     A_kn_list = list()
@@ -282,6 +374,10 @@ def statisticalInefficiencyMultiple(A_kn, fast=False, return_correlation_functio
 
   # Initialize storage for correlation function.
   Ct = list() # Ct[n] is a tuple (t, C) of the time lag t and estimate of normalized fluctuation correlation function C
+
+  # Compute the unnormalized correlation function at all time lags at once, if requested.
+  if method == 'fft':
+    [numerator_t, count_t] = _fluctuationCorrelationFFT(dA_kn)
     
   # Accumulate the integrated correlation time by computing the normalized correlation time at
   # increasing values of t.  Stop accumulating if the correlation function goes negative, since
@@ -291,14 +387,18 @@ def statisticalInefficiencyMultiple(A_kn, fast=False, return_correlation_functio
   increment = 1  
   while (t < N_k.max()-1):
     # compute unnormalized correlation function
-    numerator = 0.0
-    denominator = 0.0
-    for k in range(K):
-      if (t >= N_k[k]): continue # skip trajectory if lag time t is greater than its length
-      dA_n = dA_kn[k] # retrieve trajectory
-      x = dA_n[0:(N_k[k]-t)] * dA_n[t:N_k[k]]
-      numerator += numpy.sum(x) # accumulate contribution from trajectory k
-      denominator += float(x.size) # count how many overlapping time segments we've included
+    if method == 'fft':
+      numerator = numerator_t[t]
+      denominator = float(count_t[t])
+    else:
+      numerator = 0.0
+      denominator = 0.0
+      for k in range(K):
+        if (t >= N_k[k]): continue # skip trajectory if lag time t is greater than its length
+        dA_n = dA_kn[k] # retrieve trajectory
+        x = dA_n[0:(N_k[k]-t)] * dA_n[t:N_k[k]]
+        numerator += numpy.sum(x) # accumulate contribution from trajectory k
+        denominator += float(x.size) # count how many overlapping time segments we've included
 
     C = numerator / denominator
 
@@ -333,27 +433,132 @@ def statisticalInefficiencyMultiple(A_kn, fast=False, return_correlation_functio
   # Return the computed statistical inefficiency.
   return g
 #=============================================================================================
-def integratedAutocorrelationTime(A_n, B_n=None, fast=False, mintime=3):
+def statisticalInefficiencies(A_kn, B_kn=None, fast=False, mintime=3):
+  """
+  Compute the (cross) statistical inefficiencies of many timeseries of the same length in one vectorized pass.
+
+  REQUIRED ARGUMENTS  
+    A_kn (K x N array) - A_kn[k,n] is the nth value of timeseries k of observable A.  A 1D array is treated as a single timeseries.
+
+  OPTIONAL ARGUMENTS
+    B_kn (K x N array) - B_kn[k,n] is the nth value of timeseries k of observable B.  If supplied, the statistical
+       inefficiency of timeseries k is computed from the cross-correlation of A_kn[k,:] and B_kn[k,:], as with the
+       B_n argument of statisticalInefficiency() (default: None)
+    fast (boolean) - if True, correlation function lags are thinned as in statisticalInefficiency() (default: False)
+    mintime (int) - minimum amount of correlation function to compute before truncating at the first zero crossing (default: 3)
+
+  RETURNS
+    g_k (numpy array of K floats) - g_k[k] is the statistical inefficiency of timeseries k, with g_k[k] >= 1.0
+
+  NOTES
+    Each g_k[k] equals statisticalInefficiency(A_kn[k,:], B_kn[k,:], fast, mintime) to within roundoff.
+    The correlation functions of all timeseries are computed by fast Fourier transform, a block of rows at a time
+    to bound memory use, and the truncation and summation of the correlation functions is vectorized over rows.
+
+  EXAMPLES
+
+  Compute statistical inefficiencies of several timeseries at once.
+
+  >>> import testsystems
+  >>> A_kn = numpy.array([ testsystems.generateCorrelatedTimeseries(N=10000, tau=tau) for tau in [1.0, 5.0, 10.0] ])
+  >>> g_k = statisticalInefficiencies(A_kn)
+
+  Compute cross statistical inefficiencies.
+
+  >>> B_kn = A_kn + numpy.random.randn(3, 10000)
+  >>> g_k = statisticalInefficiencies(A_kn, B_kn)
+
+  """
+
+  # Create numpy copies of input arguments at high precision.
+  A_kn = numpy.array(A_kn, numpy.float64, ndmin=2)
+  if B_kn is not None:
+    B_kn = numpy.array(B_kn, numpy.float64, ndmin=2)
+    if (A_kn.shape != B_kn.shape):
+      raise ParameterError('A_kn and B_kn must have same dimensions.')
+
+  # Get the number and length of the timeseries.
+  [K, N] = A_kn.shape
+
+  # Compute fluctuations from the mean, and covariances using the estimator that ensures C(0) = 1.
+  dA_kn = A_kn - A_kn.mean(1)[:,numpy.newaxis]
+  if B_kn is None:
+    dB_kn = dA_kn
+  else:
+    dB_kn = B_kn - B_kn.mean(1)[:,numpy.newaxis]
+  sigma2_k = (dA_kn * dB_kn).mean(1)
+  if numpy.any(sigma2_k == 0):
+    raise ParameterError('Sample covariance sigma_AB^2 = 0 for timeseries %s -- cannot compute statistical inefficiency' % str(list(numpy.nonzero(sigma2_k == 0)[0])))
+
+  # Determine the time lags at which the correlation function is summed, and their weights.
+  lags = list()
+  increments = list()
+  t = 1
+  increment = 1
+  while (t < N-1):
+    lags.append(t)
+    increments.append(increment)
+    t += increment
+    if fast: increment += 1
+  g_k = numpy.ones([K], numpy.float64)
+  if len(lags) == 0:
+    return g_k
+  lags = numpy.array(lags)
+  weights = 2.0 * (1.0 - lags / float(N)) * numpy.array(increments, numpy.float64)
+
+  # Choose a transform length that avoids wrap-around, and a number of rows per block that bounds memory use.
+  size = 1
+  while size < 2*N:
+    size *= 2
+  nblock = max(1, 2**22 // size)
+
+  for start in range(0, K, nblock):
+    rows = slice(start, min(start + nblock, K))
+
+    # Compute symmetrized correlation functions of all timeseries in this block at the required lags.
+    FA = numpy.fft.rfft(dA_kn[rows,:], size, axis=1)
+    if B_kn is None:
+      spectrum = 2.0 * (FA * numpy.conj(FA)).real
+    else:
+      FB = numpy.fft.rfft(dB_kn[rows,:], size, axis=1)
+      spectrum = 2.0 * (numpy.conj(FA) * FB).real
+    numerator = numpy.fft.irfft(spectrum, size, axis=1)[:,lags]
+    C = numerator / (2.0 * (N - lags)[numpy.newaxis,:] * sigma2_k[rows,numpy.newaxis])
+
+    # Truncate each correlation function where it first crosses zero after 'mintime'.
+    crossed = (C <= 0.0) & (lags > mintime)[numpy.newaxis,:]
+    stop = numpy.where(crossed.any(1), crossed.argmax(1), len(lags))
+    included = numpy.arange(len(lags))[numpy.newaxis,:] < stop[:,numpy.newaxis]
+
+    # Accumulate contributions to the statistical inefficiencies.
+    g_k[rows] += (C * weights[numpy.newaxis,:] * included).sum(1)
+
+  # g must be at least unity
+  g_k = numpy.maximum(g_k, 1.0)
+
+  return g_k
+#=============================================================================================
+def integratedAutocorrelationTime(A_n, B_n=None, fast=False, mintime=3, method='direct'):
   """
   Estimate the integrated autocorrelation time.
 
   """
   
-  g = statisticalInefficiency(A_n, B_n, fast, mintime)
+  g = statisticalInefficiency(A_n, B_n, fast, mintime, method=method)
   tau = (g-1.0)/2.0
   return tau
 #=============================================================================================
-def integratedAutocorrelationTimeMultiple(A_kn, fast=False):
+def integratedAutocorrelationTimeMultiple(A_kn, fast=False, method='direct'):
   """
   Estimate the integrated autocorrelation time from multiple timeseries.
 
   """
   
-  g = statisticalInefficiencyMultiple(A_kn, fast, False)
+  g = statisticalInefficiencyMultiple(A_kn, fast, False, method=method)
   tau = (g-1.0)/2.0
   return tau
 #=============================================================================================
-def normalizedFluctuationCorrelationFunction(A_n, B_n=None, N_max=None):
+def normalizedFluctuationCorrelationFunction(A_n, B_n=None, N_max=None, method='direct'):
   """
   Compute the normalized fluctuation (cross) correlation function of (two) stationary timeseries.
 
@@ -367,13 +572,15 @@ def normalizedFluctuationCorrelationFunction(A_n, B_n=None, N_max=None):
 
   OPTIONAL ARGUMENTS
     N_max - if specified, will only compute correlation function out to time lag of N_max
+    method (string) - 'direct' computes the correlation function one lag at a time; 'fft' computes it for all lags
+       at once by fast Fourier transform in O(N log N) time, giving the same result to within roundoff (default: 'direct')
 
   RETURNS
     C_n[n] is the normalized fluctuation auto- or cross-correlation function for timeseries A(t) and B(t).
 
   NOTES 
     The same timeseries can be used for both A_n and B_n to get the autocorrelation statistical inefficiency.
-    This procedure may be slow.
+    This procedure may be slow with the 'direct' method.
     The statistical error in C_n[n] will grow with increasing n.  No effort is made here to estimate the uncertainty.
 
   REFERENCES  
@@ -389,8 +596,14 @@ def normalizedFluctuationCorrelationFunction(A_n, B_n=None, N_max=None):
   >>> A_t = testsystems.generateCorrelatedTimeseries(N=10000, tau=5.0)
   >>> C_t = normalizedFluctuationCorrelationFunction(A_t, N_max=25)
 
+  Compute the whole correlation function using the FFT method.
+
+  >>> C_t = normalizedFluctuationCorrelationFunction(A_t, method='fft')
+
   """
 
+  _checkMethod(method)
+
   # If B_n is not specified, set it to be identical to A_n.
   if B_n is None:
     B_n = A_n
@@ -430,15 +643,18 @@ def normalizedFluctuationCorrelationFunction(A_n, B_n=None, N_max=None):
   C_n = numpy.zeros([N_max+1], numpy.float64)  
 
   # Compute normalized correlation funtion.
-  t = 0
-  for t in range(0,N_max+1):
-    # compute normalized fluctuation correlation function at time t
-    C_n[t] = numpy.sum( dA_n[0:(N-t)]*dB_n[t:N] + dB_n[0:(N-t)]*dA_n[t:N] ) / (2.0 * float(N-t) * sigma2_AB)
+  if method == 'fft':
+    [numerator_t, count_t] = _fluctuationCorrelationFFT([dA_n], [dB_n], N_max=N_max, symmetric=True)
+    C_n[:] = numerator_t / (2.0 * count_t * sigma2_AB)
+  else:
+    for t in range(0,N_max+1):
+      # compute normalized fluctuation correlation function at time t
+      C_n[t] = numpy.sum( dA_n[0:(N-t)]*dB_n[t:N] + dB_n[0:(N-t)]*dA_n[t:N] ) / (2.0 * float(N-t) * sigma2_AB)
 
   # Return the computed correlation function
   return C_n
 #=============================================================================================
-def normalizedFluctuationCorrelationFunctionMultiple(A_kn, B_kn=None, N_max=None):
+def normalizedFluctuationCorrelationFunctionMultiple(A_kn, B_kn=None, N_max=None, method='direct'):
   """
   Compute the normalized fluctuation (cross) correlation function of (two) timeseries from multiple timeseries samples.
 
@@ -452,13 +668,15 @@ def normalizedFluctuationCorrelationFunctionMultiple(A_kn, B_kn=None, N_max=None
 
   OPTIONAL ARGUMENTS
     N_max - if specified, will only compute correlation function out to time lag of N_max
+    method (string) - 'direct' computes the correlation function one lag at a time; 'fft' computes it for all lags
+       at once by fast Fourier transform in O(N log N) time, giving the same result to within roundoff (default: 'direct')
 
   RETURNS
     C_n[n] is the normalized fluctuation auto- or cross-correlation function for timeseries A(t) and B(t).
 
   NOTES
     The same timeseries can be used for both A_n and B_n to get the autocorrelation statistical inefficiency.
-    This procedure may be slow.
+    This procedure may be slow with the 'direct' method.
     The statistical error in C_n[n] will grow with increasing n.  No effort is made here to estimate the uncertainty.
 
   REFERENCES  
@@ -476,8 +694,14 @@ def normalizedFluctuationCorrelationFunctionMultiple(A_kn, B_kn=None, N_max=None
   >>> A_kn = [ testsystems.generateCorrelatedTimeseries(N=N, tau=tau) for N in N_k ]
   >>> C_n = normalizedFluctuationCorrelationFunctionMultiple(A_kn, N_max=25)
 
+  Compute the whole correlation function using the FFT method.
+
+  >>> C_n = normalizedFluctuationCorrelationFunctionMultiple(A_kn, method='fft')
+
   """
 
+  _checkMethod(method)
+
   # If B_kn is not specified, define it to be identical with A_kn.
   if B_kn is None:
     B_kn = A_kn  
@@ -544,27 +768,30 @@ def normalizedFluctuationCorrelationFunctionMultiple(A_kn, B_kn=None, N_max=None
   # increasing values of t.  Stop accumulating if the correlation function goes negative, since
   # this is unlikely to occur unless the correlation function has decayed to the point where it
   # is dominated by noise and indistinguishable from zero.
-  t = 0
-  for t in range(0,N_max+1):
-    # compute unnormalized correlation function
-    numerator = 0.0
-    denominator = 0.0
-    for k in range(K):
-      if (t >= N_k[k]): continue # skip this trajectory if t is longer than the timeseries
-      numerator += numpy.sum(dA_kn[k][0:(N_k[k]-t)] * dB_kn[k][t:N_k[k]])
-      denominator += float(N_k[k]-t)
-    C = numerator / denominator
-    
-    # compute normalized fluctuation correlation function at time t
-    C /= sigma2_AB
+  if method == 'fft':
+    [numerator_t, count_t] = _fluctuationCorrelationFFT(dA_kn, dB_kn, N_max=N_max)
+    C_n[:] = numerator_t / (count_t * sigma2_AB)
+  else:
+    for t in range(0,N_max+1):
+      # compute unnormalized correlation function
+      numerator = 0.0
+      denominator = 0.0
+      for k in range(K):
+        if (t >= N_k[k]): continue # skip this trajectory if t is longer than the timeseries
+        numerator += numpy.sum(dA_kn[k][0:(N_k[k]-t)] * dB_kn[k][t:N_k[k]])
+        denominator += float(N_k[k]-t)
+      C = numerator / denominator
 
-    # Store correlation function.
-    C_n[t] = C
+      # compute normalized fluctuation correlation function at time t
+      C /= sigma2_AB
+
+      # Store correlation function.
+      C_n[t] = C
 
   # Return the computed fluctuation correlation function.
   return C_n
 #=============================================================================================
-def subsampleCorrelatedData(A_t, g=None, fast=False, conservative=False, verbose=False):
+def subsampleCorrelatedData(A_t, g=None, fast=False, conservative=False, verbose=False, method='direct'):
   """Determine the indices of an uncorrelated subsample of the data.
 
   REQUIRED ARGUMENTS  
@@ -577,6 +804,7 @@ def subsampleCorrelatedData(A_t, g=None, fast=False, conservative=False, verbose
       g is the statistical inefficiency.  Otherwise, indices are chosen non-uniformly with interval of
       approximately g in order to end up with approximately T/g total indices
     verbose (logical) - if True, some output is printed
+    method (string) - method used to compute the correlation function if g is not provided: 'direct' or 'fft' (default: 'direct')
 
   RETURNS  
     indices (list of int) - the indices of an uncorrelated subsample of the data
@@ -626,7 +854,7 @@ def subsampleCorrelatedData(A_t, g=None, fast=False, conservative=False, verbose
   # Compute the statistical inefficiency for the timeseries.
   if not g:
     if verbose: print "Computing statistical inefficiency..."
-    g = statisticalInefficiency(A_t, A_t, fast = fast)
+    g = statisticalInefficiency(A_t, A_t, fast = fast, method = method)
     if verbose: print "g = %f" % g
 
   if conservative:
@@ -658,6 +886,105 @@ def subsampleCorrelatedData(A_t, g=None, fast=False, conservative=False, verbose
   # Return the list of indices of uncorrelated snapshots.
   return indices
 
+#=============================================================================================
+def detectEquilibration(A_t, fast=False, nskip=1, method='direct', ngrid=None):
+  """
+  Automatically detect the equilibrated region of a timeseries.
+
+  REQUIRED ARGUMENTS  
+    A_t (T array) - A_t[t] is the t-th value of timeseries A(t).  Length is deduced from vector.
+
+  OPTIONAL ARGUMENTS
+    fast (boolean) - if True, the faster (but less accurate) method is used to estimate statistical inefficiencies (default: False)
+    nskip (int) - only every nskip-th start time is tried, reducing the cost by this factor (default: 1)
+    method (string) - method used to compute correlation functions: 'direct' or 'fft' (default: 'direct')
+    ngrid (int) - if specified, start times are searched coarse-to-fine: ngrid evenly spaced start times are tried,
+       then ngrid start times in the interval around the best one, and so on, until the spacing reaches nskip.
+       This tries O(ngrid log T) start times instead of T/nskip; larger values are less likely to miss the maximum
+       of a noisy (T-t)/g_t.  If None, all start times are tried (default: None)
+
+  RETURNS
+    t (int) - start of equilibrated data
+    g (float) - statistical inefficiency of equilibrated data
+    Neff_max (float) - number of uncorrelated samples in the equilibrated data A_t[t:]
+
+  NOTES
+    The start of the equilibrated region is chosen as the time t that maximizes the number of uncorrelated samples
+    in A_t[t:], (T-t)/g_t.  Discarding an initial transient reduces the variance (and hence g_t) of the remaining
+    data by more than it reduces the number of samples, while discarding equilibrated data only loses samples.
+    If the timeseries is constant from some time onwards, its statistical inefficiency is taken to be unity.
+    Whether each suffix A_t[t:] is constant is determined for all t at once from running minima and maxima.
+    With method='fft' and ngrid set, the cost is O(ngrid T log^2 T), which makes million-sample timeseries practical.
+
+  EXAMPLES
+
+  Detect the equilibrated region of a correlated timeseries with an initial transient.
+
+  >>> import testsystems
+  >>> A_t = testsystems.generateCorrelatedTimeseries(N=1000, tau=5.0)
+  >>> A_t[0:100] += numpy.linspace(10.0, 0.0, 100) # add a decaying transient
+  >>> [t, g, Neff_max] = detectEquilibration(A_t)
+
+  Search start times coarse-to-fine, computing correlation functions by FFT.
+
+  >>> [t, g, Neff_max] = detectEquilibration(A_t, method='fft', ngrid=20)
+
+  """
+
+  _checkMethod(method)
+  if (ngrid is not None) and (ngrid < 3):
+    raise ParameterError("ngrid must be at least 3.")
+
+  # Create numpy copy of array.
+  A_t = numpy.array(A_t, numpy.float64)
+
+  # Get the length of the timeseries.
+  T = A_t.size
+
+  # Special case if timeseries is constant.
+  if A_t.std() == 0.0:
+    return (0, 1.0, float(T))
+
+  # Determine which suffixes A_t[t:] are constant, from running extrema of the reversed timeseries.
+  constant_t = (numpy.maximum.accumulate(A_t[::-1])[::-1] == numpy.minimum.accumulate(A_t[::-1])[::-1])
+
+  # Compute the number of uncorrelated samples for candidate start times as they are needed.
+  g_t = numpy.ones([T-1], numpy.float64)
+  Neff_t = numpy.zeros([T-1], numpy.float64)
+  evaluated_t = numpy.zeros([T-1], numpy.bool_)
+  def evaluate(candidates):
+    for t in candidates:
+      if evaluated_t[t]: continue
+      if not constant_t[t]:
+        g_t[t] = statisticalInefficiency(A_t[t:T], fast=fast, method=method)
+      Neff_t[t] = (T-t) / g_t[t]
+      evaluated_t[t] = True
+    return
+
+  if ngrid is None:
+    # Try every nskip-th start time.
+    evaluate(range(0, T-1, nskip))
+  else:
+    # Refine the search interval around the best start time found so far until the spacing reaches nskip.
+    lower = 0
+    upper = T-2
+    while True:
+      stride = max(nskip, int(math.ceil(float(upper - lower) / float(ngrid))))
+      candidates = range(lower, upper+1, stride)
+      evaluate(candidates)
+      best = candidates[int(Neff_t[candidates].argmax())]
+      if stride == nskip:
+        break
+      lower = max(0, best - stride + 1)
+      upper = min(T-2, best + stride - 1)
+
+  # Choose the start time that maximizes the number of uncorrelated samples.
+  t = int(Neff_t.argmax())
+  g = g_t[t]
+  Neff_max = Neff_t[t]
+
+  return (t, g, Neff_max)
+
 #=============================================================================================
 # MAIN AND TESTS
 #=============================================================================================